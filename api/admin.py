@@ -0,0 +1,77 @@
+from flask import jsonify, request as req
+from werkzeug.wsgi import LimitedStream
+import codecs, hmac, os
+
+from lib import exceptions, products_import
+from lib.response_cache import ResponseCache
+
+# Admin endpoints are only enabled if environment variable ADMIN_TOKEN is set,
+# and clients must send it as "Authorization: Bearer <token>". There is no
+# real authentication in this app, but at least regular users cannot reach
+# these.
+
+# The bulk import reads the request body by itself, so it is not bound by
+# MAX_CONTENT_LENGTH (5 MB, meant for pictures). This is its own limit, which
+# can be overriden with environment variable IMPORT_MAX_SIZE (in bytes)
+IMPORT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Content types we understand when "?format=" is not given
+CONTENT_TYPES = {
+    "text/csv": products_import.FORMAT_CSV,
+    "application/x-ndjson": products_import.FORMAT_NDJSON,
+    "application/jsonl": products_import.FORMAT_NDJSON
+}
+
+def check_admin_token():
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        raise exceptions.NotFound
+    given = req.headers.get("Authorization", "")
+    if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+        raise exceptions.Forbidden
+
+def Admin(
+        app,
+        db):
+
+    @app.post("/admin/products/import")
+    def import_products():
+        # Body is the CSV or NDJSON file itself, e.g.
+        # curl --data-binary @products.csv -H "Content-Type: text/csv" ...
+        # Only products referring to pictures already uploaded (column md5)
+        # can be imported here; to import pictures as well, use the command
+        # line (scripts/import_products.py)
+        try:
+            check_admin_token()
+        except (exceptions.NotFound, exceptions.Forbidden) as err:
+            return err.response()
+
+        fmt = req.args.get("format") or CONTENT_TYPES.get(req.mimetype)
+        if fmt not in products_import.FORMATS:
+            return exceptions.BadRequest.response()
+
+        max_size = int(os.getenv("IMPORT_MAX_SIZE", IMPORT_MAX_SIZE))
+        length = req.content_length
+        if length is None or length > max_size:
+            return exceptions.BadRequest.response()
+
+        # We read from the WSGI stream directly, line by line, so the file
+        # is never entirely in memory
+        stream = LimitedStream(req.environ["wsgi.input"], length)
+        lines = codecs.iterdecode(stream, "utf-8")
+
+        try:
+            report = products_import.import_products(
+                db,
+                lines,
+                fmt,
+                upload_folder = app.config["UPLOAD_FOLDER"])
+            ResponseCache().invalidate()
+            return jsonify(report.as_dict())
+
+        except (exceptions.BadRequest, UnicodeDecodeError) as err:
+            exceptions.printerr(err)
+            return exceptions.BadRequest.response()
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
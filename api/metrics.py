@@ -0,0 +1,113 @@
+from flask import Response
+
+from lib import exceptions
+from lib.log import Logging
+from lib.metrics import Collection, RequestMetrics, SnapshotWriter, CONTENT_TYPE
+from lib.query_stats import QueryStats
+from lib.response_cache import ResponseCache
+from api.admin import check_admin_token
+from api.pictures import pic_cache
+
+def collect(db) -> Collection:
+    """Metrics of this process: requests, statements, pool and caches"""
+    collection = Collection()
+    RequestMetrics().collect(collection)
+
+    # Statements are labeled with their key in QueryStats: the name for
+    # statements of the registry, the text otherwise (at most a few hundred)
+    for key, calls, errors, rows, times in QueryStats().snapshot():
+        labels = {"statement": key}
+        collection.counter(
+            "michelangelo_db_statement_calls_total",
+            "Statements run, by statement.",
+            calls, labels)
+        collection.counter(
+            "michelangelo_db_statement_errors_total",
+            "Statements that failed, by statement.",
+            errors, labels)
+        collection.counter(
+            "michelangelo_db_statement_rows_total",
+            "Rows returned or affected, by statement.",
+            rows, labels)
+        collection.histogram(
+            "michelangelo_db_statement_duration_seconds",
+            "Time to run a statement, by statement.",
+            times, labels)
+
+    pool = db.pool_stats()
+    collection.gauge(
+        "michelangelo_db_pool_connections",
+        "Connections of the pool, in use or idle.",
+        pool["inUse"], {"state": "in_use"})
+    collection.gauge(
+        "michelangelo_db_pool_connections",
+        "Connections of the pool, in use or idle.",
+        pool["idle"], {"state": "idle"})
+    collection.gauge(
+        "michelangelo_db_pool_max_connections",
+        "Most connections the pool may open.",
+        pool["maxSize"])
+    collection.gauge(
+        "michelangelo_db_pool_waiting",
+        "Threads waiting for a connection right now.",
+        pool["waiting"])
+    collection.counter(
+        "michelangelo_db_pool_timeouts_total",
+        "Checkouts that gave up waiting for a connection.",
+        pool["timeouts"])
+    collection.histogram(
+        "michelangelo_db_pool_wait_seconds",
+        "Time waited to check out a connection.",
+        db.pool_wait_times())
+
+    caches = {
+        "pictures": pic_cache.get_stats(),
+        "responses": ResponseCache().get_stats()
+    }
+    for name, stats in caches.items():
+        labels = {"cache": name}
+        collection.counter(
+            "michelangelo_cache_hits_total",
+            "Lookups found in the cache.",
+            stats["hits"], labels)
+        collection.counter(
+            "michelangelo_cache_misses_total",
+            "Lookups not found in the cache.",
+            stats["misses"], labels)
+        collection.counter(
+            "michelangelo_cache_invalidations_total",
+            "Invalidations of the cache.",
+            stats["invalidations"], labels)
+
+    collection.counter(
+        "michelangelo_log_dropped_total",
+        "Log records dropped because the writer could not keep up.",
+        Logging().get_stats()["dropped"])
+
+    return collection
+
+def Metrics(
+        app,
+        db):
+
+    # Every process writes its metrics for the others (started by the app,
+    # if METRICS_DIR is set)
+    writer = SnapshotWriter()
+
+    @app.get("/metrics")
+    def get_metrics():
+        # Everything in the Prometheus text format, for all processes of the
+        # app. /status/* have more detail for a single process, as JSON.
+        # Admin only, as those: Prometheus can send the token (authorization
+        # in the scrape config)
+        try:
+            check_admin_token()
+        except (exceptions.NotFound, exceptions.Forbidden) as err:
+            return err.response()
+
+        try:
+            text = writer.gather(collect(db)).render()
+            return Response(text, content_type = CONTENT_TYPE)
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
@@ -1,43 +1,364 @@
-from flask import request as req, jsonify, send_file
+from flask import request as req, jsonify, send_file, Response
+from urllib.parse import quote
 import os
 
-from lib import file_upload, exceptions
+from lib import file_upload, exceptions, jobs
+from lib.db import statement
+from lib.lru_cache import LRUCache
+from lib.response_cache import ResponseCache
+
+# Formats of picture variants, from most to least preferred. JPEG is always
+# acceptable, the others only if the browser explicitly says so in the
+# "Accept" header (browsers also send "*/*", so we cannot rely on that)
+VARIANT_FORMATS = ["avif", "webp", "jpeg"]
+
+# Widths clients can ask for with "?w="
+MAX_WIDTH = 4096
+
+def accepted_formats(accept_header: str) -> list:
+    accept_header = accept_header or ""
+    return [fmt for fmt in VARIANT_FORMATS
+        if fmt == "jpeg" or f"image/{fmt}" in accept_header]
+
+def get_mimetype(path: str) -> str:
+    # Python's mimetypes module does not know about every picture format
+    # we store (e.g. WebP, in older versions), but the extension is always
+    # the mime subtype, see file_upload.save_pic
+    _, extension = os.path.splitext(path)
+    return f"image/{extension[1:].lower()}" if extension else None
+
+# Processed pictures never change (a new upload always gets a new pic_id), so
+# browsers and proxies can keep them for as long as they like
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# While a picture is being processed, we serve the original upload, which
+# will be replaced soon
+PROCESSING_CACHE_CONTROL = "no-cache"
+
+def get_etag_prefix(pic_id: int, width: int, formats: list) -> str:
+    # Everything in the request that determines which file we serve
+    return f"{pic_id}-{width or 0}-{''.join(fmt[0] for fmt in formats)}-"
+
+def get_etag(pic_id: int, width: int, formats: list, pic_md5: str, processed: bool) -> str:
+    """
+    Strong ETag for the file served for this request. Pictures are
+    content-addressed by MD5 hash, so the hash identifies the content, and
+    the prefix identifies which version of it (original, processed or
+    variant) was served
+    """
+    if not processed:
+        return f"{pic_id}-original-{pic_md5}"
+    return get_etag_prefix(pic_id, width, formats) + pic_md5
+
+def cached_by_client(if_none_match, etag_or_prefix: str) -> str:
+    """
+    Returns the ETag sent by the client in "If-None-Match" (if_none_match,
+    e.g. req.if_none_match) that starts with etag_or_prefix, or None. An ETag
+    starting with the prefix was only ever given for a processed (and thus
+    immutable) picture, see get_etag
+    """
+    for etag in if_none_match:
+        if etag.startswith(etag_or_prefix):
+            return etag
+    return None
+
+def set_cache_headers(response, width: int, processed: bool = True):
+    response.headers["Cache-Control"] = \
+        IMMUTABLE_CACHE_CONTROL if processed else PROCESSING_CACHE_CONTROL
+    if width is not None:
+        # The same URL gives different formats to different browsers
+        response.vary.add("Accept")
+    return response
+
+def not_modified(etag: str, width: int, processed: bool = True):
+    response = Response(status = 304)
+    response.set_etag(etag)
+    return set_cache_headers(response, width, processed)
+
+class PicInfo:
+    """
+    Basically a struct with everything needed to serve a picture: its hash
+    (for the ETag), whether it was processed, its file, and its variants as
+    a list of (width, format, path)
+    """
+    def __init__(self, md5: str, processed: bool, path: str, variants: list):
+        self.md5 = md5
+        self.processed = processed
+        self.path = path
+        self.mimetype = get_mimetype(path)
+        self.variants = variants
+
+    def choose(self, width: int, formats: list) -> str:
+        """
+        Returns the path of the smallest variant that is at least width
+        pixels wide, in the best format among formats. If there is none, or
+        no width was asked for, returns the picture itself
+        """
+        if width is not None:
+            candidates = [
+                (var_width, formats.index(var_format), var_path)
+                for var_width, var_format, var_path in self.variants
+                if var_width >= width and var_format in formats
+            ]
+            if candidates:
+                _, _, var_path = min(candidates)
+                return var_path
+
+        return self.path
+
+# A product page shows a dozen pictures, and every one of them used to cost a
+# round trip to the database. Processed pictures never change, so we keep what
+# we need to serve them in memory. Entries are dropped when a picture is
+# deleted; the TTL only bounds how long another process (which cannot tell us
+# about its deletes) might keep pointing us to a file that is gone. Defaults
+# can be overriden with environment variables PIC_CACHE_SIZE and PIC_CACHE_TTL
+# (in seconds)
+PIC_CACHE_SIZE = 10000
+PIC_CACHE_TTL = 300
+
+pic_cache = LRUCache(
+    max_size = int(os.getenv("PIC_CACHE_SIZE", PIC_CACHE_SIZE)),
+    ttl = float(os.getenv("PIC_CACHE_TTL", PIC_CACHE_TTL)))
+
+# Queries run on every request are prepared once per connection, see
+# lib/db.py
+SELECT_PIC_INFO = statement("select_pic_info", """
+    SELECT
+        pics.pic_md5,
+        COALESCE(pic_jobs.job_status, 'done') = 'done',
+        pics.pic_path,
+        ARRAY(
+            SELECT ARRAY[
+                var_width::text,
+                var_format,
+                var_path
+            ]
+            FROM pic_variants
+            WHERE pic_variants.pic_id = pics.pic_id
+        )
+    FROM pics
+    LEFT JOIN pic_jobs
+    ON pics.pic_id = pic_jobs.pic_id
+    WHERE pics.pic_id = $1 ;
+""", ["bigint"])
+
+SELECT_PIC_EXISTS = statement("select_pic_exists", """
+    SELECT pic_id
+    FROM pics
+    WHERE pic_id = $1 ;
+""", ["bigint"])
+
+DECREASE_PIC_REF_COUNT = statement("decrease_pic_ref_count", """
+    SELECT
+        fn_pic_decrease_ref_count($1),
+        ARRAY(
+            SELECT var_path
+            FROM pic_variants
+            WHERE pic_id = $1
+        ) ;
+""", ["bigint"])
+
+INCREASE_PIC_REF_COUNT = statement("increase_pic_ref_count", """
+    SELECT *
+    FROM fn_pic_increase_ref_count($1) ;
+""", ["text"])
+
+UPSERT_PIC = statement("upsert_pic", """
+    SELECT *
+    FROM fn_pic_upsert($1, $2) ;
+""", ["text", "text"])
+
+def get_picture_info(db, pic_id: int) -> PicInfo:
+    """
+    Returns the PicInfo of the picture, from the cache if possible, or None
+    if there is no such picture
+    """
+    info = pic_cache.get(pic_id)
+    if info is not LRUCache.MISSING:
+        return info
+
+    result = db.query(SELECT_PIC_INFO, args = (pic_id,) )
+
+    if not result.row_count:
+        return None
+
+    return cache_picture_info(pic_id, result.rows[0])
+
+def cache_picture_info(pic_id: int, row) -> PicInfo:
+    """PicInfo from a row of SELECT_PIC_INFO, kept in the cache if possible"""
+    pic_md5, processed, path, variants = row
+    info = PicInfo(
+        pic_md5,
+        processed,
+        path,
+        [(int(w), fmt, var_path) for w, fmt, var_path in variants])
+
+    # A picture still being processed will soon point to another file, so
+    # it is not worth keeping
+    if processed:
+        pic_cache.set(pic_id, info)
+
+    return info
+
+def accel_redirect(prefix: str, upload_folder: str, path: str, etag: str):
+    """
+    Instead of sending the file ourselves, we tell Nginx which file to send
+    from its internal location (prefix), which maps to the uploads folder.
+    Flask only spends the time of resolving the picture, and Nginx deals with
+    slow clients, "Range" requests, sendfile, etc. Returns None if the file
+    is not in the uploads folder, so the caller can send it
+    """
+    relative = os.path.relpath(path, upload_folder)
+    if relative.startswith(os.pardir):
+        return None
+
+    # Nginx would answer 404 by itself, and we want a chance to notice the
+    # cache entry was stale
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+
+    response = Response(mimetype = get_mimetype(path))
+    response.headers["X-Accel-Redirect"] = quote(prefix + relative.replace(os.sep, "/"))
+    response.set_etag(etag)
+    return response
 
 # This belongs here (logically) but gets called by products.py
 def decrease_picture_count(db, pic_id):
     try:
         # This will path to the picture if and only if calling the function
-        # resulted in reference count dropping to zero
+        # resulted in reference count dropping to zero. Variants are listed
+        # in the same statement, before they are deleted along with the
+        # picture
 
-        pic_path = db.query("""
-            SELECT *
-            FROM fn_pic_decrease_ref_count(%s::int) ;
-        """, args = (pic_id,) ).single()
+        pic_path, var_paths = db.query(
+            DECREASE_PIC_REF_COUNT,
+            args = (pic_id,) ).rows[0]
         
         if pic_path:
-            os.remove(pic_path)
+            pic_cache.invalidate(pic_id)
+            file_upload.remove_pic_files([pic_path] + var_paths)
 
     except Exception as err:
         exceptions.printerr(err)
         raise
 
+# Used by the bulk deletes, here and in products.py
+def decrease_picture_counts(cur, pic_ids: list) -> list:
+    """
+    Decreases the reference count of many pictures at once, inside the
+    transaction of cursor cur. A picture appearing n times loses n
+    references. Returns (pic_id, pic_path, var_paths) for every picture that
+    got deleted; call remove_deleted_pictures after committing
+    """
+    if not pic_ids:
+        return []
+
+    cur.execute("""
+        SELECT pic_id, pic_path, var_paths
+        FROM fn_pic_decrease_ref_counts
+        (
+            %s::bigint[]
+        ) ;
+    """, (pic_ids,) )
+    return cur.fetchall()
+
+def remove_deleted_pictures(rows: list) -> None:
+    # Files go away in the background, there might be thousands of them
+    paths = []
+    for pic_id, pic_path, var_paths in rows:
+        pic_cache.invalidate(pic_id)
+        paths.append(pic_path)
+        paths.extend(var_paths)
+
+    if paths:
+        file_upload.remove_pic_files_later(paths)
+
 def Pictures(
         app,
         db):
-    
+
+    # Processing of uploaded pictures happens in the background
+    job_queue = jobs.JobQueue(db)
+    if pic_cache.invalidate not in job_queue.on_complete:
+        job_queue.on_complete.append(pic_cache.invalidate)
+
     @app.get("/pictures/<int:id>")
     def get_picture_by_id(id):
+        # By default, we serve the processed picture (at most 600 pixels).
+        # With "?w=", we serve the smallest variant that is at least that
+        # wide, in the best format the browser accepts
         try:
-            result = db.query("""
-                SELECT pic_path
-                FROM pics
-                WHERE pic_id = %s::bigint 
-                LIMIT 1;
-            """, args = (id,) )
-            if result.row_count:
-                return send_file(result.single())
-            else:
+            width = int(req.args["w"]) if "w" in req.args else None
+        except ValueError:
+            return exceptions.BadRequest.response()
+
+        if width is not None and (width < 1 or width > MAX_WIDTH):
+            return exceptions.BadRequest.response()
+
+        formats = accepted_formats(req.headers.get("Accept"))
+
+        # Once processed, a picture never changes, so if the browser already
+        # has it, we do not even need to ask the database
+        client_etag = cached_by_client(req.if_none_match, get_etag_prefix(id, width, formats))
+        if client_etag:
+            return not_modified(client_etag, width)
+
+        try:
+            # If the file is gone, the cache entry was stale (e.g. the
+            # picture was deleted by another process), so we look again
+            for attempt in range(2):
+                info = get_picture_info(db, id)
+                if info is None:
+                    return exceptions.NotFound.response()
+
+                etag = get_etag(id, width, formats, info.md5, info.processed)
+                if cached_by_client(req.if_none_match, etag):
+                    return not_modified(etag, width, info.processed)
+
+                path = info.choose(width, formats)
+                try:
+                    response = None
+                    if app.config.get("ACCEL_REDIRECT"):
+                        response = accel_redirect(
+                            app.config["ACCEL_REDIRECT"],
+                            app.config["UPLOAD_FOLDER"],
+                            path,
+                            etag)
+
+                    if response is None:
+                        # With conditional = True, Flask also takes care of
+                        # "Range" and "If-Range" requests
+                        response = send_file(
+                            path,
+                            mimetype = get_mimetype(path),
+                            conditional = True,
+                            etag = etag)
+                    break
+                except FileNotFoundError:
+                    pic_cache.invalidate(id)
+                    if attempt:
+                        raise
+
+            set_cache_headers(response, width, info.processed)
+            return response
+
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    @app.get("/pictures/<int:id>/status")
+    def get_picture_status(id):
+        # Tells whether the picture was already processed. Possible values
+        # for status are "processing", "done" and "failed"
+        try:
+            result = db.query(SELECT_PIC_EXISTS, (id,) )
+            if not result.row_count:
                 return exceptions.NotFound.response()
+
+            return jsonify({
+                "picId": id,
+                "status": job_queue.status(id)
+            })
         except Exception as err:
             exceptions.printerr(err)
             return exceptions.InternalServerError.response()
@@ -45,15 +366,27 @@ def Pictures(
     @app.delete("/pictures/all")
     def delete_pictures_all():
         try:
+            # Variants are deleted along with the pictures (ON DELETE
+            # CASCADE), but we still need to know their files
             result = db.query("""
                 DELETE
                 FROM pics
-                RETURNING pic_path ;
+                RETURNING
+                    pic_id,
+                    pic_path,
+                    ARRAY(
+                        SELECT var_path
+                        FROM pic_variants
+                        WHERE pic_variants.pic_id = pics.pic_id
+                    ) ;
             """)
 
-            json = result.json()
-            for row in json:
-                os.remove(row["pic_path"])
+            pic_cache.clear()
+            # Their products went with them (ON DELETE CASCADE). Other
+            # processes hear about it through NOTIFY, but this one should
+            # not serve them even for a moment
+            ResponseCache().invalidate()
+            remove_deleted_pictures(result.rows)
 
             return f"Success! {result.row_count} pictures deleted."
 
@@ -64,14 +397,23 @@ def Pictures(
     @app.delete("/pictures/<int:id>")
     def delete_picture(id):
         try:
-            path = db.query("""
+            path, var_paths = db.query("""
                 DELETE
                 FROM pics
                 WHERE pic_id = %s::bigint
-                RETURNING pic_path ;
-            """, (id,) ).single()
+                RETURNING
+                    pic_path,
+                    ARRAY(
+                        SELECT var_path
+                        FROM pic_variants
+                        WHERE pic_variants.pic_id = pics.pic_id
+                    ) ;
+            """, (id,) ).rows[0]
 
-            os.remove(path)
+            pic_cache.invalidate(id)
+            # Same as above, for the products that had this picture
+            ResponseCache().invalidate()
+            file_upload.remove_pic_files([path] + var_paths)
 
             return f"Success! Picture {id} deleted."
 
@@ -79,6 +421,25 @@ def Pictures(
             exceptions.printerr(err)
             return exceptions.InternalServerError.response()
 
+    def insert_picture(pic_path, pic_md5):
+        # Will return pic_ref_count and pic_id
+        result = db.query(UPSERT_PIC, (pic_path, pic_md5) ).json()[0]
+
+        pic_id = result["pic_id"]
+        pic_ref_count = result["pic_ref_count"]
+
+        if pic_ref_count == 1:
+            # This means that the picture was first uploaded now, and
+            # has to be processed. We do not wait for it: until it is
+            # done, the original file will be served
+            job_queue.enqueue(pic_id)
+            return pic_id, jobs.STATUS_PROCESSING
+
+        # Somebody uploaded the same picture at the same time, and was
+        # faster than us. Let's delete file
+        os.remove(pic_path)
+        return pic_id, job_queue.status(pic_id)
+
     @app.post("/pictures")
     def post_picture():
         # It is a bit tricky to handle files and multipart encoding
@@ -88,45 +449,33 @@ def Pictures(
         pic_file = req.files.get("picture")
         if pic_file and len(pic_file.filename):
         
+            # If we already have this picture, we only need to increase its
+            # reference count. This is checked as soon as the upload is
+            # received, so duplicates never become a file in the uploads folder
+            existing = []
+            def increase_ref_count(pic_md5):
+                result = db.query(INCREASE_PIC_REF_COUNT, (pic_md5,) )
+                existing.extend(result.json())
+                return bool(result.row_count)
+
             try:
                 pic_path, pic_md5 = file_upload.save_pic(
                     pic_file,
                     upload_path = app.config["UPLOAD_FOLDER"],
-                    max_size = app.config["MAX_CONTENT_LENGTH"]
+                    max_size = app.config["MAX_CONTENT_LENGTH"],
+                    is_duplicate = increase_ref_count
                 )
 
-                # Will return pic_ref_count and pic_id
-                result = db.query("""
-                    SELECT *
-                    FROM fn_pic_upsert
-                    (
-                        %s::text,
-                        %s::text
-                    ) ;
-                """, (pic_path, pic_md5) ).json()[0]
-
-                pic_ref_count = result["pic_ref_count"]
-
-                if pic_ref_count == 1:
-                    # This means that the picture was first uploaded for this
-                    # product, and has to be updated now
-
-                    # The processing should occur asynchronously, but that will have to
-                    # be implemented later
-                    pic_path = file_upload.process_pic(pic_path)
-
-                    db.query("""
-                        UPDATE pics
-                        SET pic_path = %s::text
-                        WHERE pic_md5 = %s::text ;
-                    """, (pic_path, pic_md5) )
+                if existing:
+                    pic_id = existing[0]["pic_id"]
+                    status = job_queue.status(pic_id)
                 else:
-                    # Picture was already in DB.
-                    # Let's delete file
-                    os.remove(pic_path)
+                    pic_id, status = insert_picture(pic_path, pic_md5)
 
                 json = jsonify({
-                    "md5": pic_md5
+                    "md5": pic_md5,
+                    "picId": pic_id,
+                    "status": status
                 })
                 return json, 200
 
@@ -145,43 +494,35 @@ def Pictures(
         # This will delete all pictures that do not have an associated product.
         # This can be run periodically to clean database.
 
-        # An alternative for the last part of the query is
-        # """
-        # WHERE pics.pics_id IN (SELECT * FROM cte)
-        # """
-        # As far as I tested (not much), they are similar regarding performance.
-        # According to this post (https://pt.stackoverflow.com/questions/417582/diferen%C3%A7a-entre-exists-e-in-no-postgres)
-        # WHERE ... IN should have better performance, because the SELECT statement
-        # is just run once, but in practice they have the same performance, because
-        # Postgres is smart enough to optimize it (as seen with command EXPLAIN)
+        # It used to be written as a LEFT JOIN in a CTE, followed by
+        # "WHERE EXISTS (SELECT FROM cte ...)". NOT EXISTS says the same thing
+        # directly, and Postgres runs it as a single anti-join (check with
+        # EXPLAIN), using index products_pic_id_idx if it is worth it.
 
         try:
             result = db.query("""
-                WITH cte AS
-                (
-                    SELECT
-                        pics.pic_id AS pic_id
-                    FROM pics
-                    LEFT JOIN products
-                    ON pics.pic_id = products.pic_id
-                    WHERE products.prod_id IS NULL 
-                )
                 DELETE
                 FROM pics
-                WHERE EXISTS
+                WHERE NOT EXISTS
                 (
                     SELECT
-                    FROM cte
-                    WHERE pic_id = pics.pic_id
+                    FROM products
+                    WHERE products.pic_id = pics.pic_id
                 )
-                RETURNING pics.pic_path;
+                RETURNING
+                    pics.pic_id,
+                    pics.pic_path,
+                    ARRAY(
+                        SELECT var_path
+                        FROM pic_variants
+                        WHERE pic_variants.pic_id = pics.pic_id
+                    ) ;
             """)
             
-            for row in result.rows:
-                os.remove(row[0])
+            remove_deleted_pictures(result.rows)
             
             return f"Success! {result.row_count} orphan pictures removed."
 
         except Exception as err:
             exceptions.printerr(err)
-            return exceptions.InternalServerError.response()
\ No newline at end of file
+            return exceptions.InternalServerError.response()
@@ -0,0 +1,118 @@
+import lib.asgi as asgi
+import lib.exceptions as exceptions
+import lib.jobs as jobs
+import lib.serialize as serialize
+from lib.lru_cache import LRUCache
+from api.pictures import (
+    MAX_WIDTH,
+    SELECT_PIC_INFO,
+    SELECT_PIC_EXISTS,
+    accel_redirect,
+    accepted_formats,
+    cache_picture_info,
+    cached_by_client,
+    get_etag,
+    get_etag_prefix,
+    get_mimetype,
+    not_modified,
+    pic_cache,
+    set_cache_headers
+)
+
+# Read-only routes of api/pictures.py, for the asynchronous API (see
+# app_async.py).
+# Pictures are what clients on a slow connection spend the longest reading,
+# so they are sent from here, in chunks, as fast as the client takes them.
+# Uploads and deletes go to the Flask app (see lib/asgi.py).
+#
+# Both share the cache of picture info (pic_cache), so a delete in the Flask
+# app is seen right away here.
+
+async def get_picture_info(db, pic_id: int):
+    """Same as get_picture_info in api/pictures.py"""
+    info = pic_cache.get(pic_id)
+    if info is not LRUCache.MISSING:
+        return info
+
+    result = await db.query(SELECT_PIC_INFO, (pic_id,) )
+
+    if not result.row_count:
+        return None
+
+    return cache_picture_info(pic_id, result.rows[0])
+
+def Pictures(
+        app,
+        db,
+        config: dict):
+
+    @app.get("/pictures/<int:id>")
+    async def get_picture_by_id(req, id):
+        # See get_picture_by_id in api/pictures.py
+        try:
+            width = int(req.args["w"]) if "w" in req.args else None
+        except ValueError:
+            return exceptions.BadRequest.response()
+
+        if width is not None and (width < 1 or width > MAX_WIDTH):
+            return exceptions.BadRequest.response()
+
+        formats = accepted_formats(req.headers.get("Accept"))
+
+        client_etag = cached_by_client(req.if_none_match, get_etag_prefix(id, width, formats))
+        if client_etag:
+            return not_modified(client_etag, width)
+
+        try:
+            for attempt in range(2):
+                info = await get_picture_info(db, id)
+                if info is None:
+                    return exceptions.NotFound.response()
+
+                etag = get_etag(id, width, formats, info.md5, info.processed)
+                if cached_by_client(req.if_none_match, etag):
+                    return not_modified(etag, width, info.processed)
+
+                path = info.choose(width, formats)
+                try:
+                    response = None
+                    if config.get("ACCEL_REDIRECT"):
+                        response = accel_redirect(
+                            config["ACCEL_REDIRECT"],
+                            config["UPLOAD_FOLDER"],
+                            path,
+                            etag)
+
+                    if response is None:
+                        # "Range" requests are not supported here. In
+                        # production, Nginx sends the file (see above)
+                        response = asgi.FileResponse(path, mimetype = get_mimetype(path))
+                        response.set_etag(etag)
+                    break
+                except FileNotFoundError:
+                    pic_cache.invalidate(id)
+                    if attempt:
+                        raise
+
+            set_cache_headers(response, width, info.processed)
+            return response
+
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    @app.get("/pictures/<int:id>/status")
+    async def get_picture_status(req, id):
+        # See get_picture_status in api/pictures.py
+        try:
+            result = await db.query(SELECT_PIC_EXISTS, (id,) )
+            if not result.row_count:
+                return exceptions.NotFound.response()
+
+            return serialize.response({
+                "picId": id,
+                "status": jobs.client_status(await db.query(jobs.SELECT_JOB_STATUS, (id,) ))
+            })
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
@@ -1,49 +1,214 @@
-from flask import jsonify, request as req, Response
-import math, os, re
-from werkzeug.utils import secure_filename
+from flask import jsonify, json, request as req, Response
+import csv, io, itertools, logging, math, re
 
 import lib.exceptions as exceptions
+import lib.pagination as pagination
+import lib.product_query as product_query
+import lib.response_cache as response_cache
+import lib.serialize as serialize
+from lib.db import statement
+import lib.validation as validation
 import api.pictures as pictures
-import lib.file_upload as file_upload
 
-# Using compiled version of regex for readability and (insignificant)
-# performance boost
-REGEX_MD5 = re.compile(r"^[0-9a-f]{32}$")
+logger = logging.getLogger(__name__)
+
+# Columns returned to clients. We list them explicitly instead of using
+# "SELECT *", so that adding a column to the table does not change the API
+PRODUCT_COLUMNS = """
+    prod_id,
+    prod_name,
+    prod_descr,
+    pic_id,
+    prod_price,
+    prod_instock,
+    prod_created
+"""
+
+# Queries run on every request are prepared once per connection, see
+# lib/db.py. List pages are built by ProductQuery, and prepared by their text
+SELECT_PRODUCT = statement("select_product", f"""
+    SELECT {PRODUCT_COLUMNS}
+    FROM products
+    WHERE prod_id = $1
+    LIMIT 1 ;
+""", ["bigint"])
+
+SELECT_PRODUCTS_COUNT = statement("select_products_count", """
+    SELECT prod_count
+    FROM products_count ;
+""")
+
+SELECT_PIC_ID = statement("select_pic_id", """
+    SELECT pic_id
+    FROM pics
+    WHERE pic_md5 = $1
+    LIMIT 1 ;
+""", ["text"])
+
+INSERT_PRODUCT = statement("insert_product", """
+    INSERT INTO products
+    (
+        prod_name,
+        prod_descr,
+        pic_id,
+        prod_price,
+        prod_instock
+    )
+    VALUES ($1, $2, $3, $4, $5)
+    RETURNING prod_id ;
+""", ["text", "text", "bigint", "bigint", "bigint"])
+
+UPDATE_PRODUCT = statement("update_product", """
+    UPDATE products
+    SET
+        prod_name = $1,
+        prod_descr = $2,
+        prod_price = $3,
+        prod_instock = $4
+    WHERE
+        prod_id = $5 ;
+""", ["text", "text", "bigint", "bigint", "bigint"])
+
+DELETE_PRODUCT = statement("delete_product", """
+    DELETE
+    FROM products
+    WHERE prod_id = $1
+    RETURNING pic_id ;
+""", ["bigint"])
+
+# GET /products/export can give any of these formats
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+
+# Rows serialized together in a single chunk of the exported file. A write
+# to the socket for every row would be too many
+EXPORT_CHUNK_ROWS = 500
+
+# Longest search we accept, in characters, and results per page by default
+SEARCH_MAX_LENGTH = 200
+SEARCH_PER_PAGE = 20
+
+# Results of a search are the best this many matches at most. Users with that
+# many results should refine their search anyway. Ranking still looks at every
+# match (a search for a common word, "hat", can match a good part of the
+# catalog), but only the best ones are kept and sorted, so that pages after
+# the first (see the cursor) always come from the same candidates
+SEARCH_MAX_CANDIDATES = 1000
+
+REGEX_WORD = re.compile(r"\w+")
+
+def build_tsquery(search: str) -> str:
+    """
+    Turns what the user typed into a tsquery: every word must be present,
+    and the last one may be incomplete (prefix search, as the user types).
+    Only letters and digits survive, so users cannot inject tsquery syntax.
+    Returns None if there are no words at all
+    """
+    words = REGEX_WORD.findall(search.lower())
+    if not words:
+        return None
+    return " & ".join(words[:-1] + [words[-1] + ":*"])
+
+def search_query(search: str, tsquery: str, after: tuple, limit: int, trigram: bool) -> tuple:
+    """
+    Query and arguments of a search (see search_products), shared with
+    api/products_async.py. after is the (score, prod_id) of the cursor, if
+    any, and trigram tells whether pg_trgm is available
+    """
+    if trigram:
+        score = "TS_RANK_CD(prod_tsv, query) + WORD_SIMILARITY(%s, prod_name)"
+        condition = "prod_tsv @@ query OR %s <%% prod_name"
+        args = (search, tsquery, search)
+    else:
+        score = "TS_RANK_CD(prod_tsv, query)"
+        condition = "prod_tsv @@ query"
+        args = (tsquery,)
+
+    args += (SEARCH_MAX_CANDIDATES,)
+
+    keyset = ""
+    if after:
+        keyset = "WHERE (score, prod_id) < (%s::real, %s::bigint)"
+        args += after
+
+    # Candidates are sorted the same way as results, so they are the best
+    # ones, and the same on every page
+    return f"""
+        SELECT {PRODUCT_COLUMNS}, score
+        FROM
+        (
+            SELECT {PRODUCT_COLUMNS}, {score} AS score
+            FROM products, TO_TSQUERY('english', %s) AS query
+            WHERE {condition}
+            ORDER BY score DESC, prod_id DESC
+            LIMIT %s
+        ) AS matches
+        {keyset}
+        ORDER BY score DESC, prod_id DESC
+        LIMIT %s ;""", args + (limit + 1,)
+
+def estimate_rows(plan) -> int:
+    """Rows the planner expects a query to return, from EXPLAIN (FORMAT JSON)"""
+    # psycopg2 parses the json column, but let us not depend on that
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+def get_column_names(columns: str) -> list:
+    return [column.strip() for column in columns.split(",")]
+
+def export_header(fmt: str, columns: list) -> str:
+    """What the exported file starts with, before any row"""
+    return format_csv([columns]) if fmt == "csv" else ""
+
+def export_rows(rows: list, fmt: str, columns: list):
+    """
+    A chunk of the exported file, with the given rows, as text (CSV) or
+    bytes (NDJSON)
+    """
+    if fmt == "csv":
+        return format_csv(rows)
+    # Same serialization as the rest of the API, see lib/serialize.py
+    return serialize.dumps_lines(columns, rows)
+
+def format_csv(rows: list) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+def export_chunks(rows, fmt: str, columns: list):
+    """
+    Generator of the exported file, in chunks. rows can be any iterable
+    (e.g. from DB.stream), it is consumed as we go
+    """
+    header = export_header(fmt, columns)
+    if header:
+        yield header
+
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_ROWS))
+        if not chunk:
+            return
+        yield export_rows(chunk, fmt, columns)
 
 def validate_post_data(db, form_data, upload_folder):
-    pic_path = None
+    pic_md5 = None
     try:
-        prod_name = form_data["prodName"]
-        if len(prod_name) == 0:
-            raise ValueError("Name must be non-empty string")
-
-        prod_price = math.floor(float(form_data["prodPrice"]) * 100)
-        prod_instock = int(form_data["prodInStock"])
+        if not isinstance(form_data, dict):
+            raise exceptions.BadRequest("Expected a JSON object.")
 
-        # Not mandatory fields
-        prod_descr = form_data.get("prodDescr", None)
+        # Rules are shared with the bulk import, see lib/validation.py
         pic_md5 = form_data.get("md5", None)
-       
-        if pic_md5 and not REGEX_MD5.search(pic_md5):
-            raise exceptions.BadRequest("Field 'MD5 hash' has invalid value.")
-
-        if prod_price <= 0 or prod_instock < 0:
-            raise exceptions.BadRequest("Numeric fields contain invalid value.")
+        return validation.validate_product_fields(form_data)
 
-        return prod_name, prod_descr, prod_price, prod_instock, pic_md5
-
-    except (KeyError, ValueError, exceptions.BadRequest) as orig_exc:
+    except exceptions.BadRequest as orig_exc:
         # A required field is not present, cannot be cast into required
         # type, or supplied file name is invalid
         try:
-            print("now we will delete the picture")
-            pic_id = db.query("""
-                SELECT pic_id
-                FROM pics
-                WHERE pic_md5 = %s::text
-                LIMIT 1 ;
-            """, (pic_md5,) ).single()
-            print(f"pic_md5 is {pic_md5}")
+            pic_id = db.query(SELECT_PIC_ID, (pic_md5,) ).single()
             pictures.decrease_picture_count(db, pic_id)
 
         except Exception as err:
@@ -52,8 +217,10 @@ def validate_post_data(db, form_data, upload_folder):
             # consider this situation
             pass
 
-        # We raise another exception here, to be caught by main function
-        exceptions.printerr(orig_exc)
+        # We raise another exception here, to be caught by main function.
+        # Bad requests are the client's doing, and can come in numbers, so
+        # they are only logged once in a while
+        logger.info("Invalid product: %s", orig_exc, extra = {"sample": "invalid_product"})
         raise exceptions.BadRequest from orig_exc
 
 def validate_patch_data(form_data):
@@ -74,18 +241,13 @@ def validate_patch_data(form_data):
 
     except (KeyError, ValueError) as orig_exc:
         # A required field is not present, cannot be cast into required type
-        exceptions.printerr(orig_exc)
+        logger.info("Invalid product: %r", orig_exc, extra = {"sample": "invalid_product"})
         raise exceptions.BadRequest from orig_exc
 
 def delete_product(db, id):
     # This is a function called by delete_product_single and selete_product_all
     try:
-        result = db.query("""
-            DELETE
-            FROM products
-            WHERE prod_id = %s::bigint
-            RETURNING pic_id ; """,
-            args = (id,) )
+        result = db.query(DELETE_PRODUCT, args = (id,) )
 
         if not result.row_count:
             raise exceptions.BadRequest("Product did not exist")
@@ -100,17 +262,102 @@ def delete_product(db, id):
 
     return pic_id
 
+# Maximum number of ids accepted by DELETE /products
+MAX_BULK_DELETE = 10000
+
+def delete_products(db, prod_ids: list = None):
+    """
+    Deletes the given products (all of them, if prod_ids is None) and drops
+    one reference to each of their pictures, with one statement for each, in
+    a single transaction. Returns (products deleted, pictures deleted)
+    """
+    with db.transaction() as cur:
+        if prod_ids is None:
+            cur.execute("""
+                WITH deleted AS
+                (
+                    DELETE
+                    FROM products
+                    RETURNING pic_id
+                )
+                SELECT
+                    COUNT(*),
+                    ARRAY_REMOVE(ARRAY_AGG(pic_id), NULL)
+                FROM deleted ;
+            """)
+        else:
+            cur.execute("""
+                WITH deleted AS
+                (
+                    DELETE
+                    FROM products
+                    WHERE prod_id = ANY(%s::bigint[])
+                    RETURNING pic_id
+                )
+                SELECT
+                    COUNT(*),
+                    ARRAY_REMOVE(ARRAY_AGG(pic_id), NULL)
+                FROM deleted ;
+            """, (prod_ids,) )
+
+        deleted_products, pic_ids = cur.fetchone()
+        deleted_pics = pictures.decrease_picture_counts(cur, pic_ids)
+
+    # Only after committing, otherwise we might remove files of pictures
+    # that are still there after a rollback
+    pictures.remove_deleted_pictures(deleted_pics)
+    return deleted_products, len(deleted_pics)
+
+def parse_prod_ids(json_data) -> list:
+    # We expect a JSON list of integers, e.g. [1, 2, 3]
+    if type(json_data) != list or not json_data:
+        raise exceptions.BadRequest("Expected a non-empty list of product ids.")
+    if len(json_data) > MAX_BULK_DELETE:
+        raise exceptions.BadRequest(f"At most {MAX_BULK_DELETE} products at once.")
+    if any(type(prod_id) != int for prod_id in json_data):
+        raise exceptions.BadRequest("Product ids must be integers.")
+    return json_data
+
 def Products(
         app,
         db):
 
+    # Responses of the list and of single products are cached, see
+    # lib/response_cache.py. Every write below drops what it changed, and
+    # writes from elsewhere are notified to the listener (started by the
+    # app, in each process)
+    cache = response_cache.ResponseCache()
+
     @app.get("/products")
+    @cache.cached()
     def get_list_products():
         # This number is defined here and in the front-end
         # Perhaps in the future I will create some environment variable
         # to merge both
         PRODUCTS_PER_PAGE = 8
 
+        # There are two ways of paginating. The original one uses "page", and
+        # is what the front-end uses. It is simple, but OFFSET has to walk
+        # through all the previous rows, so deep pages get slower and slower.
+        #
+        # The other one (keyset pagination) is opt-in, by passing "after"
+        # (a prod_id), "cursor" (the token returned as "next" by the previous
+        # page) or "limit". It seeks directly into an index, so every page
+        # costs the same. It returns an object instead of a list, so we do
+        # not break existing clients.
+        #
+        # Both can be filtered and sorted, see lib/product_query.py
+        try:
+            query = product_query.ProductQuery(req.args)
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        if any(arg in req.args for arg in ("after", "cursor", "limit")):
+            try:
+                return get_list_products_keyset(query, PRODUCTS_PER_PAGE)
+            except exceptions.BadRequest as err:
+                return err.response()
+
         # If the query parameter is not defined, then req.args.get returns 
         # None and trying to cast into integer gives TypeError. We will use
         # 0 as a default value
@@ -125,34 +372,210 @@ def Products(
             return exceptions.BadRequest.response()
 
         try:
-            result = db.query("""
-                SELECT * FROM products
-                OFFSET %s
-                LIMIT %s ;""",
-                (offset, PRODUCTS_PER_PAGE))
-            return jsonify(result.json())
+            # Without ORDER BY, Postgres is free to return rows in any order,
+            # and the same product could show up in two different pages
+            result = db.query(*query.select(
+                PRODUCT_COLUMNS,
+                limit = PRODUCTS_PER_PAGE,
+                offset = offset),
+                prepare = True)
+
+            # Rows go straight from tuples to bytes, see lib/serialize.py
+            return serialize.rows_response(result.columns, result.rows)
         except Exception as err:
             exceptions.printerr(err)
             return exceptions.InternalServerError.response()
-        
+
+    def get_list_products_keyset(query, default_limit):
+        limit = pagination.parse_limit(req.args.get("limit"), default_limit)
+
+        try:
+            # We ask for one more row than necessary, just to know whether
+            # there is a next page
+            result = db.query(
+                *query.select(PRODUCT_COLUMNS, limit = limit + 1),
+                prepare = True)
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        rows = result.json()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = query.next_cursor(rows[-1])
+
+        return serialize.response({
+            "products": rows,
+            "next": next_cursor
+        })
+
+    @app.get("/products/export")
+    def export_products():
+        # Dumps the catalog, as NDJSON (default) or CSV, with the same
+        # filters and sort order as the list, as well as "after" (or
+        # "cursor") and "limit", which is not capped here. Rows are read
+        # from a server-side cursor and written to the client as they
+        # arrive, so memory does not grow with the size of the catalog
+        fmt = req.args.get("format", "ndjson")
+        if fmt not in EXPORT_FORMATS:
+            return exceptions.BadRequest.response()
+
+        try:
+            query = product_query.ProductQuery(req.args)
+            limit = int(req.args["limit"]) if "limit" in req.args else None
+            if limit is not None and limit < 1:
+                raise exceptions.BadRequest("Invalid limit.")
+        except ValueError:
+            return exceptions.BadRequest.response()
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        rows = db.stream(*query.select(PRODUCT_COLUMNS, limit = limit))
+
+        # Once the response started, we cannot change its status anymore. So
+        # we run the query (and fetch the first rows) right away, and if
+        # something goes wrong the client still gets a proper error
+        try:
+            first = list(itertools.islice(rows, 1))
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        def body():
+            # If the client goes away, the server closes the response, and
+            # we close the cursor and give the connection back right away,
+            # not whenever the generator is collected (chain cannot close
+            # what it chains)
+            try:
+                yield from export_chunks(
+                    itertools.chain(first, rows),
+                    fmt,
+                    get_column_names(PRODUCT_COLUMNS))
+            finally:
+                rows.close()
+
+        response = Response(body(), mimetype = EXPORT_FORMATS[fmt])
+        response.headers["Content-Disposition"] = \
+            f"attachment; filename=products.{fmt}"
+        return response
+
+    # Whether typo-tolerant search is available (extension pg_trgm and its
+    # index, see sql/04-products-search.sql). We only check it once
+    trigram_search = []
+
+    def has_trigram_search():
+        if not trigram_search:
+            trigram_search.append(db.query("""
+                SELECT EXISTS
+                (
+                    SELECT
+                    FROM pg_indexes
+                    WHERE indexname = 'products_name_trgm_idx'
+                ) ;
+            """).single())
+        return trigram_search[0]
+
+    @app.get("/products/search")
+    def search_products():
+        # Ranked search over name and description: "?q=pirate hat". Products
+        # containing all the words (the last one may be incomplete) come
+        # first, weighted by where the words appear. If pg_trgm is installed,
+        # names that look like the search (typos included) are found too.
+        #
+        # Answers {"products": [...], "next": "<cursor>"}, like keyset
+        # pagination of the list. The cursor holds the score and prod_id of
+        # the last product, which is exactly how results are sorted
+        search = req.args.get("q", "")
+        tsquery = build_tsquery(search)
+        if tsquery is None or len(search) > SEARCH_MAX_LENGTH:
+            return exceptions.BadRequest.response()
+
+        try:
+            limit = pagination.parse_limit(req.args.get("limit"), SEARCH_PER_PAGE)
+            after = None
+            if "cursor" in req.args:
+                after = pagination.decode_cursor(req.args["cursor"])
+                if len(after) != 2:
+                    raise exceptions.BadRequest("Invalid cursor.")
+                after = (float(after[0]), int(after[1]))
+        except (TypeError, ValueError):
+            return exceptions.BadRequest.response()
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        try:
+            result = db.query(
+                *search_query(search, tsquery, after, limit, has_trigram_search()),
+                prepare = True)
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        rows = result.json()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = pagination.encode_cursor([rows[-1]["score"], rows[-1]["prod_id"]])
+
+        for row in rows:
+            del row["score"]
+
+        return serialize.response({
+            "products": rows,
+            "next": next_cursor
+        })
 
     @app.get("/products/count")
     def get_products_count():
+        # COUNT(*) has to visit every row, which gets slow as the catalog
+        # grows. The total is kept up to date by triggers instead (see
+        # sql/06-products-count.sql), so it is a single-row lookup.
+        #
+        # Filtered counts (same filters as GET /products) are estimated by
+        # the planner, from table statistics, unless the client asks for
+        # exact=1. Estimates are flagged with header X-Count-Estimated, the
+        # body is always just the number
         try:
-            result = db.query("SELECT COUNT(*) FROM products;")
-            return jsonify(result.json()[0]["count"])
-        except:
+            query = product_query.ProductQuery(req.args)
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        where, args = query.where(keyset = False)
+        exact = req.args.get("exact") in ("1", "true")
+
+        try:
+            total = db.query(SELECT_PRODUCTS_COUNT).single()
+            if not where:
+                return jsonify(total)
+
+            if exact:
+                count = db.query(
+                    f"SELECT COUNT(*) FROM products {where} ;",
+                    args,
+                    prepare = True).single()
+                return jsonify(count)
+
+            plan = db.query(f"""
+                EXPLAIN (FORMAT JSON)
+                SELECT 1 FROM products {where} ;
+            """, args).single()
+            # Statistics can be a bit behind, but we know for sure there
+            # are no more than the total
+            response = jsonify(min(estimate_rows(plan), total))
+            response.headers["X-Count-Estimated"] = "1"
+            return response
+        except Exception as err:
+            exceptions.printerr(err)
             return exceptions.InternalServerError.response()
 
     @app.get("/products/<int:id>")
+    @cache.cached(id_arg = "id")
     def get_product_by_id(id):
         try:
-            result = db.query("""
-            SELECT * FROM products
-            WHERE prod_id = %s
-            LIMIT 1 ; """, (id,) )
+            result = db.query(SELECT_PRODUCT, (id,) )
             if len(result.rows):
-                return jsonify(result.json()[0])
+                return serialize.response(result.json()[0])
             else:
                 return exceptions.NotFound.response()
         except:
@@ -173,40 +596,21 @@ def Products(
             prod_name, prod_descr, prod_price, prod_instock, pic_md5 = \
                     validate_post_data(db, form_data, app.config["UPLOAD_FOLDER"])
         except exceptions.BadRequest as err:
-            exceptions.printerr(err)
             return err.response()
 
-        # Save picture to database (thus far, it was only in disk)
+        # Picture was already saved to database and its processing was
+        # enqueued when it was uploaded, we only need its id
         pic_id = None
         if pic_md5:
             try:
-                result = db.query("""
-                    SELECT pic_id, pic_path, pic_ref_count
-                    FROM pics
-                    WHERE pic_md5 = %s::text
-                    LIMIT 1 ;
-                """, (pic_md5, ) ).json()[0]
-
-                pic_id = result["pic_id"]
-                pic_path = result["pic_path"]
-                pic_ref_count = result["pic_ref_count"]
-
-                if pic_ref_count == 1:
-                    # This means that the picture was first uploaded for this
-                    # product, and has to be updated now
-
-                    # The processing should occur asynchronously, but that will have to
-                    # be implemented later
-                    pic_path = file_upload.process_pic(pic_path)
-
-                    db.query("""
-                        UPDATE pics
-                        SET pic_path = %s::text
-                        WHERE pic_id = %s::bigint ;
-                    """, (pic_path, pic_id) )
+                result = db.query(SELECT_PIC_ID, (pic_md5, ) )
+
+                if not result.row_count:
+                    return exceptions.BadRequest.response()
+
+                pic_id = result.single()
                 
             except Exception as err:
-                os.remove(pic_path)
                 exceptions.printerr(err)
                 return exceptions.InternalServerError.response()
 
@@ -215,35 +619,21 @@ def Products(
         # the server side
 
         try:
-            result = db.query("""
-                INSERT INTO products
-                (
-                    prod_name,
-                    prod_descr,
-                    pic_id,
-                    prod_price,
-                    prod_instock
-                )
-                VALUES
-                (
-                    %s::text,
-                    %s::text,
-                    %s::bigint,
-                    %s::bigint,
-                    %s::bigint
-                ) RETURNING * ; """,
+            result = db.query(INSERT_PRODUCT,
                 args = ( prod_name, prod_descr, pic_id, prod_price, prod_instock )
             )
 
+            prod_id = result.json()[0]["prod_id"]
+            cache.invalidate([prod_id])
             return jsonify({
                 "picId": pic_id,
-                "prodId": result.json()[0]["prod_id"]
+                "prodId": prod_id
                 })
         
         except Exception as err:
             exceptions.printerr(err)
-            if pic_path:
-                print("We will also need to decrease file count")
+            if pic_id:
+                # We will also need to decrease file count
                 try:
                     pictures.decrease_picture_count(db, pic_id)
                 except:
@@ -254,16 +644,33 @@ def Products(
     @app.delete("/products/all")
     def delete_products_all():
         try:
-            result = db.query("""
-                SELECT prod_id
-                FROM products; """).json()
+            deleted_products, deleted_pics = delete_products(db)
+            cache.invalidate()
+            return jsonify({
+                "deletedProducts": deleted_products,
+                "deletedPics": deleted_pics
+            })
+
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
 
-            deleted_pics = 0
-            for row in result:
-                prod_id = row["prod_id"]
-                deleted_pics += bool(delete_product(db, prod_id))
+    @app.delete("/products")
+    def delete_products_list():
+        # Same as above, but only for the products whose ids are given as a
+        # JSON list in the body of the request
+        try:
+            prod_ids = parse_prod_ids(req.get_json(silent = True))
+        except exceptions.BadRequest as err:
+            return err.response()
 
-            return jsonify({ "deletedPics" : deleted_pics })
+        try:
+            deleted_products, deleted_pics = delete_products(db, prod_ids)
+            cache.invalidate(prod_ids)
+            return jsonify({
+                "deletedProducts": deleted_products,
+                "deletedPics": deleted_pics
+            })
 
         except Exception as err:
             exceptions.printerr(err)
@@ -273,6 +680,7 @@ def Products(
     def delete_product_single(id):
         try:
             pic_id = delete_product(db, id)
+            cache.invalidate([id])
             return jsonify({ "picId" : pic_id })
         except exceptions.BadRequest as err:
             return err.response()
@@ -282,7 +690,6 @@ def Products(
         
     @app.patch("/products/<int:id>")
     def patch_product(id):
-        print(req.get_json())
         try:
             prod_id, prod_name, prod_descr, prod_price, prod_instock = \
                 validate_patch_data(req.get_json())
@@ -290,17 +697,9 @@ def Products(
             return err.response()
         
         try:
-            db.query("""
-                UPDATE products
-                SET
-                    prod_name = %s::text,
-                    prod_descr = %s::text,
-                    prod_price = %s::bigint,
-                    prod_instock = %s::bigint
-                WHERE
-                    prod_id = %s::bigint ;
-            """,
+            db.query(UPDATE_PRODUCT,
             args = (prod_name, prod_descr, prod_price, prod_instock, prod_id) )
+            cache.invalidate([prod_id])
             return ""
         except Exception as err:
             exceptions.printerr(err)
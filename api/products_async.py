@@ -0,0 +1,245 @@
+import lib.asgi as asgi
+import lib.exceptions as exceptions
+import lib.pagination as pagination
+import lib.product_query as product_query
+import lib.serialize as serialize
+from api.products import (
+    PRODUCT_COLUMNS,
+    SELECT_PRODUCT,
+    SELECT_PRODUCTS_COUNT,
+    EXPORT_FORMATS,
+    EXPORT_CHUNK_ROWS,
+    SEARCH_MAX_LENGTH,
+    SEARCH_PER_PAGE,
+    build_tsquery,
+    estimate_rows,
+    export_header,
+    export_rows,
+    get_column_names,
+    search_query
+)
+
+# Read-only routes of api/products.py, for the asynchronous API (see
+# app_async.py). They take the same parameters (parsed and validated by the
+# same code, lib/product_query.py and lib/pagination.py), run the same
+# queries and give the same JSON. They do not go through the response cache
+# (lib/response_cache.py), so there is no ETag, 304 or gzip here. Writes are not here, they go to the Flask app (see
+# lib/asgi.py), which validates them with lib/validation.py as always.
+#
+# Responses are not cached here (see lib/response_cache.py): while a request
+# waits for Postgres, the event loop is busy with the others anyway.
+
+PRODUCTS_PER_PAGE = 8
+
+async def export_async(rows, first: list, fmt: str, columns: list):
+    """
+    Same as export_chunks, for rows from AsyncDB.stream, of which the first
+    ones were already fetched
+    """
+    header = export_header(fmt, columns)
+    if header:
+        yield header
+
+    chunk = list(first)
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == EXPORT_CHUNK_ROWS:
+            yield export_rows(chunk, fmt, columns)
+            chunk = []
+    if chunk:
+        yield export_rows(chunk, fmt, columns)
+
+def Products(
+        app,
+        db):
+
+    @app.get("/products")
+    async def get_list_products(req):
+        # See get_list_products in api/products.py
+        try:
+            query = product_query.ProductQuery(req.args)
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        if any(arg in req.args for arg in ("after", "cursor", "limit")):
+            try:
+                return await get_list_products_keyset(req, query, PRODUCTS_PER_PAGE)
+            except exceptions.BadRequest as err:
+                return err.response()
+
+        try:
+            offset = PRODUCTS_PER_PAGE * int(req.args.get("page"))
+        except TypeError:
+            offset = 0
+        except ValueError:
+            return exceptions.BadRequest.response()
+
+        try:
+            result = await db.query(*query.select(
+                PRODUCT_COLUMNS,
+                limit = PRODUCTS_PER_PAGE,
+                offset = offset))
+            return serialize.rows_response(get_column_names(PRODUCT_COLUMNS), result.rows)
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    async def get_list_products_keyset(req, query, default_limit):
+        limit = pagination.parse_limit(req.args.get("limit"), default_limit)
+
+        try:
+            result = await db.query(*query.select(PRODUCT_COLUMNS, limit = limit + 1))
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        rows = result.json()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = query.next_cursor(rows[-1])
+
+        return serialize.response({
+            "products": rows,
+            "next": next_cursor
+        })
+
+    @app.get("/products/export")
+    async def export_products(req):
+        # See export_products in api/products.py. The client can take as
+        # long as it likes to read the file: we only fetch more rows once it
+        # read the previous ones, and no thread waits in the meantime
+        fmt = req.args.get("format", "ndjson")
+        if fmt not in EXPORT_FORMATS:
+            return exceptions.BadRequest.response()
+
+        try:
+            query = product_query.ProductQuery(req.args)
+            limit = int(req.args["limit"]) if "limit" in req.args else None
+            if limit is not None and limit < 1:
+                raise exceptions.BadRequest("Invalid limit.")
+        except ValueError:
+            return exceptions.BadRequest.response()
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        rows = db.stream(*query.select(PRODUCT_COLUMNS, limit = limit))
+
+        # Errors must happen before the response starts, see api/products.py
+        try:
+            first = [await rows.__anext__()]
+        except StopAsyncIteration:
+            first = []
+        except Exception as err:
+            await rows.aclose()
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        response = asgi.StreamingResponse(
+            export_async(rows, first, fmt, get_column_names(PRODUCT_COLUMNS)),
+            mimetype = EXPORT_FORMATS[fmt])
+        response.headers["Content-Disposition"] = \
+            f"attachment; filename=products.{fmt}"
+        return response
+
+    # Whether typo-tolerant search is available, see api/products.py
+    trigram_search = []
+
+    async def has_trigram_search():
+        if not trigram_search:
+            trigram_search.append((await db.query("""
+                SELECT EXISTS
+                (
+                    SELECT
+                    FROM pg_indexes
+                    WHERE indexname = 'products_name_trgm_idx'
+                ) ;
+            """)).single())
+        return trigram_search[0]
+
+    @app.get("/products/search")
+    async def search_products(req):
+        # See search_products in api/products.py
+        search = req.args.get("q", "")
+        tsquery = build_tsquery(search)
+        if tsquery is None or len(search) > SEARCH_MAX_LENGTH:
+            return exceptions.BadRequest.response()
+
+        try:
+            limit = pagination.parse_limit(req.args.get("limit"), SEARCH_PER_PAGE)
+            after = None
+            if "cursor" in req.args:
+                after = pagination.decode_cursor(req.args["cursor"])
+                if len(after) != 2:
+                    raise exceptions.BadRequest("Invalid cursor.")
+                after = (float(after[0]), int(after[1]))
+        except (TypeError, ValueError):
+            return exceptions.BadRequest.response()
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        try:
+            result = await db.query(
+                *search_query(search, tsquery, after, limit, await has_trigram_search()))
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+        rows = result.json()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = pagination.encode_cursor([rows[-1]["score"], rows[-1]["prod_id"]])
+
+        for row in rows:
+            del row["score"]
+
+        return serialize.response({
+            "products": rows,
+            "next": next_cursor
+        })
+
+    @app.get("/products/count")
+    async def get_products_count(req):
+        # See get_products_count in api/products.py
+        try:
+            query = product_query.ProductQuery(req.args)
+        except exceptions.BadRequest as err:
+            return err.response()
+
+        where, args = query.where(keyset = False)
+        exact = req.args.get("exact") in ("1", "true")
+
+        try:
+            total = (await db.query(SELECT_PRODUCTS_COUNT)).single()
+            if not where:
+                return serialize.response(total)
+
+            if exact:
+                count = (await db.query(
+                    f"SELECT COUNT(*) FROM products {where} ;",
+                    args)).single()
+                return serialize.response(count)
+
+            plan = (await db.query(f"""
+                EXPLAIN (FORMAT JSON)
+                SELECT 1 FROM products {where} ;
+            """, args)).single()
+            response = serialize.response(min(estimate_rows(plan), total))
+            response.headers["X-Count-Estimated"] = "1"
+            return response
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    @app.get("/products/<int:id>")
+    async def get_product_by_id(req, id):
+        try:
+            result = await db.query(SELECT_PRODUCT, (id,) )
+            if len(result.rows):
+                return serialize.response(result.json()[0])
+            else:
+                return exceptions.NotFound.response()
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
@@ -0,0 +1,77 @@
+from flask import jsonify
+
+from lib import exceptions
+from lib.db import statements
+from lib.query_stats import QueryStats
+from lib.response_cache import ResponseCache
+from api.admin import check_admin_token
+from api.pictures import pic_cache
+
+# These show the text of every statement, and the internals of the pool and
+# caches, so they are admin endpoints, see api/admin.py
+
+def Status(
+        app,
+        db):
+
+    @app.get("/status/pool")
+    def get_pool_stats():
+        # Connections in use and idle, and how long requests had to wait for
+        # one. Useful for sizing the pool (POSTGRES_POOL_MAX) under load
+        try:
+            check_admin_token()
+        except (exceptions.NotFound, exceptions.Forbidden) as err:
+            return err.response()
+
+        try:
+            return jsonify(db.pool_stats())
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    @app.get("/status/cache")
+    def get_cache_stats():
+        # Hits and misses of the in-memory picture cache and of the
+        # response cache. A low hit ratio for pictures means PIC_CACHE_SIZE
+        # is too small for the catalog
+        try:
+            check_admin_token()
+        except (exceptions.NotFound, exceptions.Forbidden) as err:
+            return err.response()
+
+        try:
+            return jsonify({
+                "pictures": pic_cache.get_stats(),
+                "responses": ResponseCache().get_stats()
+            })
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
+
+    @app.get("/status/queries")
+    def get_query_stats():
+        # Calls, rows and latency histogram of every statement, those which
+        # took the most time first, along with how long requests waited for
+        # a connection. Statements from the registry (lib/db.py) are listed
+        # by name, with their SQL, even if they never ran
+        try:
+            check_admin_token()
+        except (exceptions.NotFound, exceptions.Forbidden) as err:
+            return err.response()
+
+        try:
+            stats = QueryStats().get_stats()
+            registry = {st.name: st.sql for st in statements()}
+
+            seen = set()
+            for entry in stats["statements"]:
+                if entry["statement"] in registry:
+                    entry["sql"] = registry[entry["statement"]]
+                    seen.add(entry["statement"])
+
+            stats["unused"] = sorted(name for name in registry if name not in seen)
+            stats["pool"] = db.pool_stats()
+            return jsonify(stats)
+        except Exception as err:
+            exceptions.printerr(err)
+            return exceptions.InternalServerError.response()
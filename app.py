@@ -1,20 +1,34 @@
 #!/usr/bin/env python3
 
-import os
-from flask import Flask, send_file
+import logging, os
+from flask import Flask, request, send_file
 from dotenv import load_dotenv
-from waitress import serve
 
 from lib.singleton import Singleton
 import lib.db as db
+import lib.jobs as jobs
+import lib.log as log
+import lib.metrics as metrics
+import lib.response_cache as response_cache
+import lib.server as server
+
+logger = logging.getLogger(__name__)
 
 class App (metaclass = Singleton):
 	STATIC_URL_PATH = "/static"
 	STATIC_FOLDER = "client/build/static"
 	UPLOAD_FOLDER = "uploads"
+
+	# Internal Nginx location that serves the uploads folder, see
+	# instructions_nginx in install.py
+	ACCEL_REDIRECT_PREFIX = "/michelangelo-uploads/"
 	REACT_MAIN_PAGE = "client/build/index.html"
 	REACT_FAVICON = "client/build/favicon.ico"
 	REACT_MANIFEST = "client/build/manifest.json"
+
+	# Only the process holding a lock on this file (in UPLOAD_FOLDER)
+	# processes pictures, see JobQueue.start
+	JOBS_LOCK_FILE = ".jobs.lock"
 	DEFAULT_PORT = 5000
 
 	# We will allow a maximum payload size of 5 MB
@@ -25,6 +39,7 @@ class App (metaclass = Singleton):
 				running_as_main: bool,
 				port: int = DEFAULT_PORT,
 				nginx_static: bool = False,
+				nginx_accel: bool = False,
 				app_name: str = ""):
 		'''
 		flask_env contains the value for environment variable "FLASK_ENV", it
@@ -37,27 +52,48 @@ class App (metaclass = Singleton):
 
 		nginx_static determines whether Nginx will serve static folder
 		(recommended for production, but might cause issues, so default is false)
+
+		nginx_accel determines whether Nginx will send uploaded pictures. Flask
+		only tells Nginx which file to send, with header "X-Accel-Redirect"
+		(production only, and Nginx must be configured for it, so default is
+		false)
 		'''
+		# Everything is logged through a queue, written by a background thread
+		log.Logging().start()
+
 		# If no "FLASK_ENV" environment variable was given, we will assume
 		# we are running in development mode
 		self.production_mode = (flask_env == "production")
 		self.running_as_main = running_as_main
-		self.port = port or self.DEFAULT_PORT
+		self.port = int(port or self.DEFAULT_PORT)
+		self.pid = os.getpid()
 		self.app_name = app_name
 
+		# Relative to the working directory, can be overriden with
+		# environment variable UPLOAD_FOLDER (e.g. by scripts/benchmark.py)
+		self.UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", self.UPLOAD_FOLDER)
+
 		self.app = Flask(__name__)
 		self.app.config["UPLOAD_FOLDER"] = self.UPLOAD_FOLDER
 		self.app.config["MAX_CONTENT_LENGTH"] = self.MAX_CONTENT_LENGTH
+		self.app.config["ACCEL_REDIRECT"] = \
+			self.ACCEL_REDIRECT_PREFIX if self.production_mode and nginx_accel else None
 
 		self.configure_static(nginx_static)
-		print(f"app_name is \"{self.app_name}\"")
-		print(f"static_url_path is {self.app.static_url_path}")
-		print(f"static_folder is {self.app.static_folder}")
+		logger.info("app_name is \"%s\"", self.app_name)
+		logger.info("static_url_path is %s", self.app.static_url_path)
+		logger.info("static_folder is %s", self.app.static_folder)
 
 		# It is necessary to connect to DB before configuring routes, because
 		# each route will receive DB as argument
 		self.db = db.DB()
 
+		# Uploaded pictures are processed in the background, by a pool of
+		# worker processes, see start_background
+		self.jobs = jobs.JobQueue(self.db)
+
+		self.configure_request_ids()
+		self.configure_metrics()
 		self.configure_routes()
 		self.configure_favicon()
 		self.configure_manifest()
@@ -66,6 +102,31 @@ class App (metaclass = Singleton):
 		self.listen()
 
 
+	def start_background(self):
+		# Threads (and processes) working in the background. Threads do not
+		# survive a fork, so every process of the app starts its own, see
+		# after_fork
+
+		os.makedirs(self.UPLOAD_FOLDER, exist_ok = True)
+		self.jobs.start(os.path.join(self.UPLOAD_FOLDER, self.JOBS_LOCK_FILE))
+
+		# Notifications of changes to products, which drop cached responses
+		response_cache.ResponseCache().listen(self.db.connect)
+
+		import api.metrics
+		metrics.SnapshotWriter().start(lambda: api.metrics.collect(self.db))
+
+	def after_fork(self):
+		# Called in every worker process of the production server, as soon
+		# as it starts (by lib/server.py, or by gunicorn, see gunicorn.conf.py).
+		# Connections to the database cannot be shared with the parent either
+
+		log.Logging().start()
+		if os.getpid() != self.pid:
+			self.db.reset_pool()
+		metrics.RequestMetrics().threads = server.Server().threads
+		self.start_background()
+
 	def configure_static(self, nginx_static):
 		# If this is production mode and we are serving static files from Nginx,
 		# then we don't have to serve static files from Flask
@@ -77,15 +138,48 @@ class App (metaclass = Singleton):
 			self.app.static_url_path = self.STATIC_URL_PATH
 			self.app.static_folder = self.STATIC_FOLDER
 
+	def configure_request_ids(self):
+		# Every request gets an id (or keeps the one Nginx gave it), which is
+		# in every line it logs and in header X-Request-Id of the response,
+		# so a complaint about a response can be traced back to its logs
+
+		@self.app.before_request
+		def start_request():
+			log.start_request(request.headers.get("X-Request-Id"))
+
+		@self.app.after_request
+		def add_request_id(response):
+			response.headers["X-Request-Id"] = log.request_id.get()
+			return response
+
+		@self.app.teardown_request
+		def end_request(exc):
+			log.end_request()
+
+	def configure_metrics(self):
+		# Every request is timed and counted, by route, see GET /metrics. The
+		# middleware sees requests before Flask does, so Flask tells it which
+		# route was matched
+
+		self.app.wsgi_app = metrics.Middleware(self.app.wsgi_app, metrics.RequestMetrics())
+
+		@self.app.before_request
+		def record_route():
+			if request.url_rule is not None:
+				request.environ[metrics.Middleware.ROUTE_KEY] = request.url_rule.rule
+
 	def configure_routes(self):
 		# The idea here is: every module (Products, Pictures, etc) should be
 		# independent, and receive only what is strictly necessary for it to
 		# operate — the app and the DB handlers
-		import api.products, api.pictures
+		import api.products, api.pictures, api.status, api.admin, api.metrics
 
 		routes = [
 			api.products.Products,
-			api.pictures.Pictures
+			api.pictures.Pictures,
+			api.status.Status,
+			api.admin.Admin,
+			api.metrics.Metrics
 		]
 		
 		for route in routes:
@@ -99,7 +193,9 @@ class App (metaclass = Singleton):
 		@self.app.get("/", defaults = {"path": ""})
 		@self.app.get("/<path:path>")
 		def front_end(path):
-			print(f"You tried to reach {path}, redirecting to React main page")
+			# Every page of the front end comes through here, so this is sampled
+			logger.info("Redirecting to React main page",
+				extra = {"path": path, "sample": "front_end"})
 			return send_file(self.REACT_MAIN_PAGE)
 
 	def configure_favicon(self):
@@ -127,16 +223,34 @@ class App (metaclass = Singleton):
 		# time). It is not necessary to call app.run() if "flask run" is used,
 		# and doing so causes the line to be ignored.
 
-		if self.production_mode:
-			print(f"Starting production server in port {self.port}.")
-			serve(self.app, host = "localhost", port = self.port)
+		#
+		# In production, the server may run several worker processes, which
+		# start their background work themselves once forked (see
+		# lib/server.py). Gunicorn does the same, see gunicorn.conf.py, and so
+		# does the asynchronous server, see app_async.py
+
+		if os.getenv("WEB_PREFORK"):
+			logger.info("Waiting for the server to start workers (gunicorn.conf.py or app_async.py).")
+
+		elif self.production_mode:
+			logger.info("Starting production server in port %s.", self.port)
+			production_server = server.Server()
+
+			# Metrics of all workers are added up through files
+			writer = metrics.SnapshotWriter()
+			if production_server.is_preforked() and not writer.directory:
+				writer.directory = production_server.metrics_dir()
+
+			production_server.serve(self.app, "localhost", self.port, self.after_fork)
 
 		elif self.running_as_main:
-			print(f"Starting development server in port {self.port}.")
+			logger.info("Starting development server in port %s.", self.port)
+			self.start_background()
 			self.app.run(port = self.port)
 
 		else:
-			print(f"Starting development server. Check parent process for port number")
+			logger.info("Starting development server. Check parent process for port number")
+			self.start_background()
 
 
 ################################################################################
@@ -147,15 +261,21 @@ class App (metaclass = Singleton):
 # ./run_dev.sh and ./run_prod.sh . In any case, it is safer to cover
 # all possible scenarios here
 
-load_dotenv()
-flask_env = os.environ.get("FLASK_ENV", None)
-port = os.environ.get("PORT", None)
-app_name = os.environ.get("APP_NAME", None)
-app_singleton = App(
-	flask_env,
-	__name__ == "__main__",
-	port = port,
-	app_name = app_name)
-
-# This is required in order to have "flask run"
-app = app_singleton.app
+# Picture workers (see lib/jobs.py) are started by multiprocessing, which
+# runs the main script again in them, as "__mp_main__". They only need the
+# function they run, not another server with its connections to the database
+if __name__ != "__mp_main__":
+	load_dotenv()
+	flask_env = os.environ.get("FLASK_ENV", None)
+	port = os.environ.get("PORT", None)
+	app_name = os.environ.get("APP_NAME", None)
+	nginx_accel = os.environ.get("NGINX_ACCEL", "").lower() in ("1", "true", "yes")
+	app_singleton = App(
+		flask_env,
+		__name__ == "__main__",
+		port = port,
+		nginx_accel = nginx_accel,
+		app_name = app_name)
+
+	# This is required in order to have "flask run"
+	app = app_singleton.app
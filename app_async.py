@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Asynchronous variant of the API, for ASGI servers. Products and pictures are
+# read by coroutines (see api/products_async.py and api/pictures_async.py),
+# so a client on a slow connection costs a bit of memory instead of a thread.
+# Every other route (uploads, writes, admin, the front end) is served by the
+# Flask app of app.py, in a few threads, see lib/asgi.py. Run it with:
+#
+#     python3 app_async.py
+#
+# or with any ASGI server, e.g. "uvicorn app_async:app --port 5000". Both need
+# asyncpg and uvicorn (pip install asyncpg uvicorn). The same environment
+# variables apply, with WEB_WORKERS processes, each with a single event loop
+# and WEB_THREADS threads for the Flask app.
+
+import logging, os, resource
+
+logger = logging.getLogger(__name__)
+
+# Connections a process accepts at once, can be overriden with environment
+# variable ASYNC_CONNECTION_LIMIT. Beyond that, clients get 503
+ASYNC_CONNECTION_LIMIT = 10000
+
+async def startup():
+    # Same as a worker process of the production server
+    app_singleton.after_fork()
+    await db.start()
+
+async def shutdown():
+    await db.close()
+    app_singleton.jobs.stop()
+
+def raise_file_limit(connections: int) -> None:
+    # Every connection is a file descriptor, and the default limit (often
+    # 1024) is below what we want to accept
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = connections + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+        if new < wanted:
+            logger.warning("Open files are limited to %s, fewer than the connections allowed", new)
+
+# As in app.py, picture workers run this file again as "__mp_main__", and
+# must not build another app. ASGI servers (and uvicorn's worker processes)
+# import it as "app_async", so they are not affected
+if __name__ != "__mp_main__":
+    # Tells app.py not to serve by itself. Its background work is started by
+    # startup() above, in every process of the server
+    os.environ["WEB_PREFORK"] = "1"
+
+    from app import app_singleton
+    import api.pictures_async, api.products_async
+    import lib.asgi as asgi
+    import lib.db_async as db_async
+    import lib.server as server
+
+    flask_app = app_singleton.app
+    db = db_async.AsyncDB()
+
+    app = asgi.App(fallback = asgi.WsgiFallback(
+        flask_app,
+        threads = server.Server().threads,
+        max_body = flask_app.config["MAX_CONTENT_LENGTH"]))
+
+    api.products_async.Products(app, db)
+    api.pictures_async.Pictures(app, db, flask_app.config)
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        raise ImportError("The asynchronous API needs uvicorn, run: pip install uvicorn")
+
+    web = server.Server()
+    connection_limit = int(os.getenv("ASYNC_CONNECTION_LIMIT", ASYNC_CONNECTION_LIMIT))
+    raise_file_limit(connection_limit)
+
+    logger.info("Starting asynchronous server in port %s.", app_singleton.port)
+    uvicorn.run(
+        "app_async:app",
+        host = "localhost",
+        port = app_singleton.port,
+        workers = web.workers,
+        backlog = web.backlog,
+        limit_concurrency = connection_limit,
+        timeout_graceful_shutdown = web.graceful_timeout,
+        # Logging is ours, see lib/log.py
+        log_config = None,
+        access_log = False)
@@ -3,11 +3,23 @@ import React from 'react';
 import * as myPath from "../js/myPath";
 import "./Image.css";
 
-function ImageTag(id, alt, loading = "eager")
+/* Widths of the picture variants generated by the back-end. With "sizes",
+the browser picks the smallest variant that looks sharp on the screen.
+These must be the same as PIC_VARIANT_WIDTHS of the server (default in
+lib/jobs.py): a width that has no variant is answered with a bigger one (or
+the original), which the browser downloads thinking it is smaller. */
+const VARIANT_WIDTHS = [160, 320, 480];
+
+function ImageTag(id, alt, loading = "eager", sizes = undefined)
     {
         let src = myPath.linkTo(`/pictures/${id}`);
+        let srcSet = sizes ?
+            VARIANT_WIDTHS.map(w => `${src}?w=${w} ${w}w`).join(", ") :
+            undefined;
         return id ?
         <img src={src}
+        srcSet={srcSet}
+        sizes={sizes}
         title={alt}
         alt={alt}
         loading={loading}
@@ -31,7 +43,7 @@ function Image(props)
     className="pic-box"
     style={style}
     >
-        {ImageTag(props.id, props.alt, props.loading)}
+        {ImageTag(props.id, props.alt, props.loading, props.sizes)}
     </div>
     );
 }
@@ -67,9 +67,13 @@ function ProductList(props)
                 <div className="center">
                     <div className="pic-box">
                         <a href={myPath.linkTo(`/view/${prod.prod_id}`)}>
+                            {/* sizes is about the width of a .card (see
+                            Products.css), the browser picks the variant
+                            from it, see Image.jsx */}
                             <Image
                             id={prod.pic_id}
                             alt={prod.prod_descr}
+                            sizes="270px"
                             loading={keyIndex - keyFirst > 3 ? "lazy" : "eager"} />
                         </a>
                     </div>
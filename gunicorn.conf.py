@@ -0,0 +1,47 @@
+# Settings for running the app with gunicorn instead of "python3 app.py",
+# e.g. where gunicorn is already how Python apps are deployed:
+#
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# gunicorn is optional, and not needed otherwise (pip install gunicorn, see
+# requirements.txt).
+#
+# The same environment variables apply (WEB_WORKERS, WEB_THREADS, etc., see
+# lib/server.py). Like our own server, each worker starts its background work
+# and its connections to the database after being forked.
+
+import os
+
+# Tells app.py that it will be forked, so it must not start anything yet
+os.environ["WEB_PREFORK"] = "1"
+
+from lib.server import Server
+from lib.metrics import SnapshotWriter
+
+web = Server()
+
+bind = f"localhost:{os.getenv('PORT', 5000)}"
+workers = web.workers
+threads = web.threads
+worker_class = "gthread"
+worker_connections = web.connection_limit
+backlog = web.backlog
+# A request gets as long as waitress would give it before the worker is
+# restarted. keepalive (how long an idle connection waits for the next
+# request) has nothing to do with it, and keeps gunicorn's default
+timeout = web.channel_timeout
+graceful_timeout = web.graceful_timeout
+
+# The app is loaded once, in the master, and forked
+preload_app = True
+
+# Metrics of all workers are added up through files
+os.environ.setdefault("METRICS_DIR", web.metrics_dir())
+
+def post_fork(server, worker):
+    from app import app_singleton
+    app_singleton.after_fork()
+
+def child_exit(server, worker):
+    # Same as lib/server.py when it reaps a worker
+    SnapshotWriter().remove(worker.pid)
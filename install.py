@@ -233,6 +233,28 @@ location /michelangelo/ {
 
 }
 
+-----"""
+    print(block)
+
+    # Optional, this must match App.ACCEL_REDIRECT_PREFIX in app.py
+    print("\nOptionally, Nginx can also send uploaded pictures itself, so that Python " +
+        "is not busy while slow clients download them. Add the following directive " +
+        "as well, and set NGINX_ACCEL=1 in .env:")
+    block = f"""-----
+
+location /michelangelo-uploads/ {{
+    internal;
+    alias {rel_path('uploads')}/;
+
+    # Flask already checked "If-None-Match" and decided which file to send.
+    # Content-Type and Cache-Control are kept by Nginx, ETag and Vary are not
+    etag off;
+    add_header ETag $upstream_http_etag;
+    add_header Vary $upstream_http_vary;
+    sendfile on;
+    tcp_nopush on;
+}}
+
 -----"""
     print(block)
 
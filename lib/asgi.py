@@ -0,0 +1,372 @@
+import asyncio, logging, os, re, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, Callable
+from urllib.parse import parse_qsl
+
+from flask import Response
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import parse_etags
+
+import lib.exceptions as exceptions
+import lib.log as log
+import lib.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# A small ASGI application, for the asynchronous variant of the API (see
+# app_async.py). With waitress, every request holds a thread until its response is
+# completely written, so a few clients on a slow connection are enough to
+# keep all threads busy. Here, a request is a coroutine: while it waits for
+# the database or for the client to read, the event loop serves the others,
+# and thousands of slow clients only cost memory.
+#
+# Handlers are coroutines, registered like Flask views, with the same URLs:
+#
+#     @app.get("/products/<int:id>")
+#     async def get_product_by_id(request, id):
+#         ...
+#
+# and return the same responses as Flask views (flask.Response, e.g. from
+# lib/serialize.py or exceptions.X.response()), or a StreamingResponse, whose
+# body is written as it is produced. Requests without a handler go to the
+# fallback (the Flask app, see WsgiFallback), so every route of the API is
+# served, the slow ones in threads.
+
+REGEX_VARIABLE = re.compile(r"<int:(\w+)>")
+
+def compile_path(path: str) -> re.Pattern:
+    """Regex for a URL rule, e.g. "/products/<int:id>" (only int variables)"""
+    parts = REGEX_VARIABLE.split(path)
+    # Every odd part is the name of a variable
+    regex = "".join(
+        f"(?P<{part}>\\d+)" if index % 2 else re.escape(part)
+        for index, part in enumerate(parts))
+    return re.compile(f"^{regex}$")
+
+class Request:
+    """What handlers need to know about the request"""
+    def __init__(self, scope: dict, receive: Callable):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(
+            scope["query_string"].decode("latin-1"),
+            keep_blank_values = True))
+        self.headers = Headers([
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope["headers"]])
+
+    @property
+    def if_none_match(self):
+        return parse_etags(self.headers.get("If-None-Match"))
+
+    async def chunks(self):
+        """Asynchronous generator of the chunks of the body, as they arrive"""
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionResetError("Client disconnected")
+            if message.get("body"):
+                yield message["body"]
+            if not message.get("more_body"):
+                return
+
+class StreamingResponse (Response):
+    """
+    A response whose body is an asynchronous iterable of chunks (bytes or
+    str), sent as they come. Everything else (headers, ETag, etc) is a
+    regular flask.Response
+    """
+    def __init__(self, chunks: AsyncIterable, **kwargs):
+        super().__init__(**kwargs)
+        self.chunks = chunks
+
+class FileResponse (StreamingResponse):
+    """
+    Sends a file in chunks, read in a thread so the event loop does not wait
+    for the disk. Raises FileNotFoundError right away if there is no file
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path: str, **kwargs):
+        file = open(path, "rb")
+        super().__init__(self.read(file), **kwargs)
+        self.content_length = os.fstat(file.fileno()).st_size
+
+    async def read(self, file):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, file.read, self.CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            file.close()
+
+def encode_headers(headers) -> list:
+    return [(name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, value in headers]
+
+class Disconnect:
+    """
+    Tells whether the client went away while we were sending a streamed
+    response. ASGI servers silently drop what is sent after that, and we
+    would read the whole export from the database for nobody
+    """
+    def __init__(self, receive: Callable):
+        self.receive = receive
+        self.task = asyncio.ensure_future(self.wait())
+
+    async def wait(self):
+        while (await self.receive())["type"] != "http.disconnect":
+            pass
+
+    @property
+    def happened(self) -> bool:
+        return self.task.done()
+
+    def cancel(self) -> None:
+        self.task.cancel()
+
+async def send_response(send: Callable, receive: Callable, response: Response, head: bool) -> int:
+    """Sends a flask.Response (or StreamingResponse). Returns the size of the body"""
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": encode_headers(response.headers.items())
+    })
+
+    if not isinstance(response, StreamingResponse):
+        body = b"" if head else response.get_data()
+        await send({"type": "http.response.body", "body": body})
+        return len(body)
+
+    size = 0
+    chunks = response.chunks
+    disconnect = Disconnect(receive)
+    try:
+        if not head:
+            async for chunk in chunks:
+                if disconnect.happened:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                # Waits while the client does not keep up, so a slow client
+                # does not make us buffer the whole body
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                size += len(chunk)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnect.cancel()
+        # Releases what the generator holds (e.g. a database connection)
+        # even if we stopped early
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+    return size
+
+class WsgiFallback:
+    """
+    Serves requests with a WSGI app (the Flask app) in a pool of threads.
+    The body of the request is read before, and the response written after,
+    without a thread, so slow clients do not hold one here either. Bodies
+    larger than max_body are refused without reading them
+    """
+    # Bodies larger than this go to a temporary file instead of memory
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, wsgi_app: Callable, threads: int, max_body: int):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix = "wsgi")
+
+    async def read_body(self, request: Request):
+        """The body in a file, or None if it is too large"""
+        length = request.headers.get("Content-Length", type = int)
+        if length is not None and length > self.max_body:
+            return None
+
+        body = tempfile.SpooledTemporaryFile(self.SPOOL_SIZE)
+        size = 0
+        async for chunk in request.chunks():
+            size += len(chunk)
+            if size > self.max_body:
+                body.close()
+                return None
+            body.write(chunk)
+        body.seek(0)
+        return body
+
+    def get_environ(self, request: Request, body, size: int) -> dict:
+        scope = request.scope
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            # WSGI wants the bytes of the path, as latin-1
+            "PATH_INFO": request.path.encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "CONTENT_LENGTH": str(size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace("-", "_")
+            if key == "CONTENT_TYPE":
+                environ[key] = value
+            elif key != "CONTENT_LENGTH":
+                key = "HTTP_" + key
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def __call__(self, request: Request, send: Callable) -> None:
+        body = await self.read_body(request)
+        if body is None:
+            response = Response("Request entity too large", 413)
+            await send_response(send, request.receive, response, False)
+            return
+
+        loop = asyncio.get_running_loop()
+        def run(function, *args):
+            return loop.run_in_executor(self.executor, function, *args)
+
+        started = []
+        def start_response(status: str, headers: list, exc_info = None):
+            started[:] = [int(status.split(" ", 1)[0]), headers]
+
+        try:
+            size = body.seek(0, os.SEEK_END)
+            body.seek(0)
+            result = await run(self.wsgi_app, self.get_environ(request, body, size), start_response)
+            try:
+                # The body is produced in the thread too, one chunk at a time
+                iterator = iter(result)
+                chunk = await run(next, iterator, None)
+                status, headers = started
+                await send({
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": encode_headers(headers)
+                })
+                while chunk is not None:
+                    if chunk and request.method != "HEAD":
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    chunk = await run(next, iterator, None)
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(result, "close"):
+                    await run(result.close)
+        finally:
+            body.close()
+
+class App:
+    """
+    ASGI application. Requests matching a handler are served by it, the
+    others by the fallback (or answered 404, without one)
+    """
+    def __init__(self, fallback: Callable = None):
+        self.fallback = fallback
+        # (method, regex, rule, handler)
+        self.routes = []
+        # Coroutines run when the server starts and stops, e.g. to connect
+        # to the database within the event loop
+        self.on_startup = []
+        self.on_shutdown = []
+        self.metrics = metrics.RequestMetrics()
+
+    def route(self, method: str, rule: str) -> Callable:
+        def decorator(handler):
+            self.routes.append((method, compile_path(rule), rule, handler))
+            return handler
+        return decorator
+
+    def get(self, rule: str) -> Callable:
+        return self.route("GET", rule)
+
+    def post(self, rule: str) -> Callable:
+        return self.route("POST", rule)
+
+    def patch(self, rule: str) -> Callable:
+        return self.route("PATCH", rule)
+
+    def delete(self, rule: str) -> Callable:
+        return self.route("DELETE", rule)
+
+    def match(self, method: str, path: str):
+        """(rule, handler, URL variables) of the handler for the request, or None"""
+        # Like Flask, GET handlers also answer HEAD
+        if method == "HEAD":
+            method = "GET"
+        for route_method, regex, rule, handler in self.routes:
+            if route_method != method:
+                continue
+            found = regex.match(path)
+            if found:
+                return rule, handler, {name: int(value) for name, value in found.groupdict().items()}
+        return None
+
+    async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            hooks = self.on_startup if message["type"] == "lifespan.startup" else self.on_shutdown
+            try:
+                for hook in hooks:
+                    await hook()
+            except Exception as err:
+                logger.exception("Could not %s: %s", message["type"].split(".")[-1], err)
+                await send({"type": message["type"] + ".failed", "message": str(err)})
+                return
+            await send({"type": message["type"] + ".complete"})
+            if message["type"] == "lifespan.shutdown":
+                return
+
+    async def handle(self, scope: dict, receive: Callable, send: Callable) -> None:
+        request = Request(scope, receive)
+        found = self.match(request.method, request.path)
+
+        if found is None:
+            if self.fallback is not None:
+                # The Flask app does its own request ids and metrics
+                await self.fallback(request, send)
+            else:
+                await send_response(send, receive, exceptions.NotFound.response(), False)
+            return
+
+        rule, handler, variables = found
+        start = time.perf_counter()
+        status = "500"
+        size = 0
+        self.metrics.started()
+        # Every request runs in its own task, with its own context, so the id
+        # does not leak into other requests
+        request_id = log.start_request(request.headers.get("X-Request-Id"))
+        try:
+            try:
+                response = await handler(request, **variables)
+            except Exception as err:
+                exceptions.printerr(err)
+                response = exceptions.InternalServerError.response()
+
+            response.headers["X-Request-Id"] = request_id
+            status = str(response.status_code)
+            size = await send_response(send, receive, response, request.method == "HEAD")
+        finally:
+            self.metrics.finished(request.method, rule, status, time.perf_counter() - start, size)
+            log.end_request()
@@ -0,0 +1,376 @@
+import http.client, json, math, os, platform, random, subprocess, threading, time, uuid
+from typing import Callable, Dict, List
+
+# Load generator for the benchmark suite (see scripts/benchmark.py). Simulated
+# clients (threads, each with its own keep-alive connection) run operations
+# of a scenario against a running server, as fast as they can, for a given
+# duration. Every operation is timed, and the results of a run are summed up
+# as throughput, error rate and latency percentiles, in a dictionary that is
+# written as JSON. Two of those (e.g. from two commits) can be compared, to
+# flag regressions.
+#
+# An operation is a function (session, rng) -> None, which makes one or more
+# requests with session.request(). Requests answered with status 400 or
+# above, and requests that fail, make the operation count as an error.
+
+# Version of the JSON output, bumped if its meaning changes
+FORMAT_VERSION = 1
+
+PERCENTILES = [50, 90, 95, 99]
+
+# Products per page of GET /products, as in api/products.py
+PRODUCTS_PER_PAGE = 8
+
+class RequestFailed(Exception):
+    pass
+
+class Session:
+    """A simulated client, with a keep-alive connection to the server"""
+    def __init__(self, host: str, port: int, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+        # Status -> count, of the current operation
+        self.statuses = {}
+        self.failed = False
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        """Returns (status, body). Failures are counted, then raised"""
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+        try:
+            self.conn.request(method, path, body = body, headers = headers or {})
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as err:
+            # The server may have closed a keep-alive connection, we start
+            # over with a new one
+            self.close()
+            self.failed = True
+            raise RequestFailed(f"{method} {path}: {err!r}") from err
+
+        status = response.status
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status >= 400:
+            self.failed = True
+        if response.will_close:
+            self.close()
+        return status, data
+
+    def get_json(self, path: str):
+        status, data = self.request("GET", path)
+        if status != 200:
+            raise RequestFailed(f"GET {path}: status {status}")
+        return json.loads(data)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+########## Statistics
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values, which must be sorted"""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+def summarize(latencies: List[float], errors: int, statuses: dict, elapsed: float) -> dict:
+    """Summary of a run: latencies of the operations (in seconds) and errors"""
+    latencies = sorted(latencies)
+    operations = len(latencies)
+    summary = {
+        "operations": operations,
+        "errors": errors,
+        "errorRate": errors / operations if operations else 0.0,
+        "throughput": operations / elapsed if elapsed else 0.0,
+        "elapsed": elapsed,
+        "latencyMs": {
+            "mean": 1000 * sum(latencies) / operations if operations else 0.0,
+            "max": 1000 * latencies[-1] if latencies else 0.0
+        },
+        "statuses": {str(status): count for status, count in sorted(statuses.items())}
+    }
+    for p in PERCENTILES:
+        summary["latencyMs"][f"p{p}"] = 1000 * percentile(latencies, p)
+    return summary
+
+########## Runner
+
+def run(
+        host: str,
+        port: int,
+        operation: Callable,
+        concurrency: int,
+        duration: float,
+        warmup: float = 0.0,
+        seed: int = 0,
+        timeout: float = 30.0) -> dict:
+    """
+    Runs operation with concurrency clients for warmup + duration seconds,
+    and returns the summary of what happened after the warmup
+    """
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    statuses = {}
+
+    def client(number: int):
+        # Each client has its own generator, so a run is the same sequence
+        # of requests every time (timing aside)
+        rng = random.Random(f"{seed}-{number}")
+        session = Session(host, port, timeout)
+        own_latencies = []
+        own_errors = 0
+        own_statuses = {}
+        try:
+            while True:
+                began = time.perf_counter()
+                if began >= deadline:
+                    break
+                session.failed = False
+                session.statuses = {}
+                try:
+                    operation(session, rng)
+                except Exception:
+                    session.failed = True
+                ended = time.perf_counter()
+
+                # Operations of the warmup, and those cut by the deadline,
+                # are not reported
+                if began >= measure_from and ended <= deadline:
+                    own_latencies.append(ended - began)
+                    own_errors += session.failed
+                    for status, count in session.statuses.items():
+                        own_statuses[status] = own_statuses.get(status, 0) + count
+        finally:
+            session.close()
+            with lock:
+                latencies.extend(own_latencies)
+                errors[0] += own_errors
+                for status, count in own_statuses.items():
+                    statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target = client, args = (n,), daemon = True)
+        for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, errors[0], statuses, duration)
+
+########## Scenarios
+
+class Context:
+    """
+    What scenarios need to know about the catalog, found through the API
+    itself (see discover), so a run works against any server
+    """
+    def __init__(self, prod_ids: List[int], pic_ids: List[int], count: int, pictures: List[bytes]):
+        self.prod_ids = prod_ids
+        self.pic_ids = pic_ids
+        self.count = count
+        # Contents of picture files to upload
+        self.pictures = pictures
+
+def discover(host: str, port: int, pictures: List[bytes], samples: int = 500, seed: int = 0) -> Context:
+    """
+    Samples products spread over the whole catalog (pages of keyset
+    pagination from random positions), and the pictures they have
+    """
+    session = Session(host, port, 30.0)
+    rng = random.Random(seed)
+    try:
+        count = session.get_json("/products/count")
+        first = session.get_json("/products?limit=1")["products"]
+        last = session.get_json("/products?limit=1&order=desc")["products"]
+        if not first:
+            raise RequestFailed("There are no products")
+        low, high = first[0]["prod_id"], last[0]["prod_id"]
+
+        prod_ids = set()
+        pic_ids = set()
+        for _ in range(samples):
+            page = session.get_json(f"/products?limit=20&after={rng.randint(low - 1, high - 1)}")
+            for product in page["products"]:
+                prod_ids.add(product["prod_id"])
+                if product["pic_id"]:
+                    pic_ids.add(product["pic_id"])
+    finally:
+        session.close()
+
+    return Context(sorted(prod_ids), sorted(pic_ids), count, pictures)
+
+def multipart(field: str, filename: str, content: bytes) -> tuple:
+    """Body and headers of a form with a single file"""
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n").encode() \
+        + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+def unique_picture(content: bytes, rng: random.Random) -> bytes:
+    # Bytes after the end of a JPEG or PNG are ignored by decoders, but make
+    # the MD5 different, so the upload is not deduplicated
+    return content + rng.getrandbits(128).to_bytes(16, "big")
+
+def upload_product(session: Session, rng: random.Random, context: Context) -> None:
+    """Uploads a new picture and creates a product with it, like the front end"""
+    content = unique_picture(rng.choice(context.pictures), rng)
+    body, headers = multipart("picture", "picture.jpg", content)
+    status, data = session.request("POST", "/pictures", body, headers)
+    if status != 200:
+        return
+
+    product = {
+        "prodName": f"Benchmark product {rng.getrandbits(32)}",
+        "prodDescr": "Created by the benchmark",
+        "prodPrice": rng.randint(100, 100000) / 100,
+        "prodInStock": rng.randint(0, 100),
+        "md5": json.loads(data)["md5"]
+    }
+    session.request("POST", "/products", json.dumps(product).encode(),
+        {"Content-Type": "application/json"})
+
+def make_scenarios(context: Context, max_page: int = 100) -> Dict[str, Callable]:
+    """Operations of every scenario, by name"""
+    pages = max(1, min(max_page, math.ceil(context.count / PRODUCTS_PER_PAGE)))
+
+    def list_page(session, rng):
+        # What the front end does: a page of the list, mostly the first ones
+        session.request("GET", f"/products?page={int(rng.paretovariate(1.2)) % pages}")
+
+    def keyset_page(session, rng):
+        session.request("GET", f"/products?limit=20&after={rng.choice(context.prod_ids)}")
+
+    def detail(session, rng):
+        session.request("GET", f"/products/{rng.choice(context.prod_ids)}")
+
+    def count(session, rng):
+        if rng.random() < 0.5:
+            session.request("GET", "/products/count")
+        else:
+            session.request("GET", f"/products/count?min_price={rng.randint(0, 100000)}&in_stock=1")
+
+    def search(session, rng):
+        words = ["hat", "pirate", "boots", "golden", "mask", "suit", "crown", "cape"]
+        session.request("GET", f"/products/search?q={rng.choice(words)}")
+
+    def picture(session, rng):
+        # Browsers ask for variants, in WebP if they can
+        path = f"/pictures/{rng.choice(context.pic_ids)}"
+        if rng.random() < 0.5:
+            path += f"?w={rng.choice([160, 320, 480])}"
+        session.request("GET", path, headers = {"Accept": "image/webp,*/*"})
+
+    def upload(session, rng):
+        upload_product(session, rng, context)
+
+    # Browsing, mostly, as in production: operations by weight
+    mixed_weights = [
+        (list_page, 40),
+        (detail, 25),
+        (picture, 20),
+        (count, 5),
+        (search, 5),
+        (keyset_page, 4),
+        (upload, 1)
+    ]
+    mixed_operations = [operation for operation, _ in mixed_weights]
+    weights = [weight for _, weight in mixed_weights]
+
+    def mixed(session, rng):
+        rng.choices(mixed_operations, weights)[0](session, rng)
+
+    scenarios = {
+        "list": list_page,
+        "keyset": keyset_page,
+        "detail": detail,
+        "count": count,
+        "search": search,
+        "pictures": picture,
+        "upload": upload,
+        "mixed": mixed
+    }
+    if not context.pic_ids:
+        del scenarios["pictures"]
+    if not context.pictures:
+        del scenarios["upload"]
+    return scenarios
+
+########## Reports
+
+def environment() -> dict:
+    """Where the benchmark ran, so results are only compared with care"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+            capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count()
+    }
+
+# Metrics compared between runs, and whether higher is better
+COMPARED_METRICS = {
+    "throughput": True,
+    "latencyMs.p50": False,
+    "latencyMs.p99": False,
+    "errorRate": False
+}
+
+def get_metric(summary: dict, name: str) -> float:
+    value = summary
+    for key in name.split("."):
+        value = value[key]
+    return value
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """
+    Compares the scenarios present in both reports. Returns every metric
+    that got worse by more than threshold (a fraction, e.g. 0.1). Error
+    rates are compared in percentage points, since they are usually 0
+    """
+    regressions = []
+    for name, summary in current["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = get_metric(old, metric), get_metric(summary, metric)
+            if metric == "errorRate":
+                worse = after - before > threshold / 10
+            elif higher_is_better:
+                worse = after < before * (1 - threshold)
+            else:
+                worse = after > before * (1 + threshold)
+            if worse:
+                regressions.append({
+                    "scenario": name,
+                    "metric": metric,
+                    "before": before,
+                    "after": after
+                })
+    return regressions
+
+def format_table(report: dict) -> str:
+    lines = [f"{'scenario':<10} {'ops/s':>9} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} "
+        f"{'p99 ms':>8} {'max ms':>8}"]
+    for name, summary in report["scenarios"].items():
+        latency = summary["latencyMs"]
+        lines.append(f"{name:<10} {summary['throughput']:>9.1f} {summary['errors']:>7} "
+            f"{latency['p50']:>8.1f} {latency['p90']:>8.1f} {latency['p99']:>8.1f} "
+            f"{latency['max']:>8.1f}")
+    return "\n".join(lines)
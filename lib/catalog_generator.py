@@ -0,0 +1,317 @@
+import array, hashlib, math, multiprocessing, os, random, struct, zlib
+from datetime import datetime
+from typing import Iterator, List, Tuple
+
+from lib.products_import import COPY_BUFFER_SIZE, CopyStream
+
+# Synthetic catalog, for testing at a realistic size (millions of products,
+# hundreds of thousands of pictures), used by the command line
+# (scripts/generate_catalog.py) and by the benchmark (scripts/benchmark.py).
+#
+# The same seed always gives the same catalog: names, prices, dates, which
+# products have which picture, and the picture files themselves. Pictures
+# are small PNG files, written without Pillow, each with its own content
+# (and thus MD5 hash). Some products share a picture, as if the same file had
+# been uploaded again: the duplication ratio is the fraction of pictures of
+# products that are such duplicates, so reference counts are the same as if
+# every picture went through fn_pic_upsert.
+#
+# Everything is loaded with COPY, in a single transaction, as in
+# lib/products_import.py. Files are written before, and removed if the
+# transaction fails.
+
+DEFAULT_PICTURE_SIZE = (320, 240)
+
+# Products are created at regular intervals (give or take) in this period, so
+# the oldest have the smallest ids, as in real life
+CREATED_FROM = datetime(2021, 1, 1)
+CREATED_UNTIL = datetime(2024, 1, 1)
+
+ADJECTIVES = ["Golden", "Royal", "Pirate", "Victorian", "Feathered", "Vintage",
+    "Gothic", "Elegant", "Striped", "Velvet", "Silk", "Leather", "Woolen",
+    "Embroidered", "Imperial", "Rustic", "Baroque", "Medieval", "Dandy", "Sailor"]
+NOUNS = ["hat", "boots", "crown", "monocle", "scarf", "bandana", "mask",
+    "cape", "dress", "suit", "pantaloons", "gloves", "cane", "wig", "corset",
+    "vest", "belt", "umbrella", "fan", "brooch"]
+COLORS = ["red", "green", "blue", "black", "white", "purple", "crimson",
+    "emerald", "ivory", "navy", "golden", "silver"]
+DESCRIPTIONS = [
+    "A {color} {noun} that will make you the star of the party.",
+    "Handmade {noun}, in {color}. One size fits all, or so they say.",
+    "Nobody will look at anything else once you wear this {color} {noun}.",
+    "The {noun} of a true {adjective} gentleman, now in {color}.",
+    "Our best-selling {noun}, back in {color} by popular demand."
+]
+
+class CatalogReport:
+    """What was generated, to be shown to the user"""
+    def __init__(self):
+        self.products = 0
+        self.pictures = 0
+        self.pictures_added = 0
+        self.references = 0
+        self.files_written = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "products": self.products,
+            "pictures": self.pictures,
+            "picturesAdded": self.pictures_added,
+            "references": self.references,
+            "filesWritten": self.files_written
+        }
+
+########## Pictures
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + \
+        struct.pack(">I", zlib.crc32(kind + data))
+
+def make_picture(seed: int, number: int, width: int, height: int) -> bytes:
+    """
+    A PNG file of a few colored blocks. The number is written in a text
+    chunk too, so no two pictures are the same, even if colors are
+    """
+    rng = random.Random(f"{seed}-picture-{number}")
+    blocks = rng.randint(2, 6)
+    colors = [bytes(rng.randrange(256) for _ in range(3)) for _ in range(blocks)]
+
+    # Each band of rows has the same blocks of colors, shifted by one
+    widths = [width // blocks] * (blocks - 1) + [width - (width // blocks) * (blocks - 1)]
+    raw = []
+    for band in range(blocks):
+        # Every row starts with the filter type, 0 (none)
+        row = b"\x00" + b"".join(colors[(band + n) % blocks] * w for n, w in enumerate(widths))
+        rows = height // blocks if band < blocks - 1 else height - (height // blocks) * (blocks - 1)
+        raw.append(row * rows)
+
+    # Fastest compression, a few times faster than the default, and files
+    # still take a single block on disk
+    data = zlib.compress(b"".join(raw), 1)
+
+    return b"\x89PNG\r\n\x1a\n" + \
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        png_chunk(b"tEXt", f"Comment\x00picture {number} of seed {seed}".encode()) + \
+        png_chunk(b"IDAT", data) + \
+        png_chunk(b"IEND", b"")
+
+def write_picture(job: tuple) -> Tuple[str, str, bool]:
+    """
+    Writes picture number of job (seed, number, width, height, folder), if
+    it is not there already. Returns (MD5 hash, path, whether it was written)
+    """
+    seed, number, width, height, folder = job
+    content = make_picture(seed, number, width, height)
+    md5 = hashlib.md5(content).hexdigest()
+    path = os.path.join(folder, f"{md5}.png")
+    if os.path.exists(path):
+        return md5, path, False
+
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    return md5, path, True
+
+def write_pictures(
+        count: int,
+        seed: int,
+        folder: str,
+        size: Tuple[int, int] = DEFAULT_PICTURE_SIZE,
+        processes: int = None) -> Iterator[Tuple[str, str, bool]]:
+    """
+    Writes pictures 0 to count - 1, in worker processes (all CPUs by default),
+    yielding what write_picture returns, in order
+    """
+    width, height = size
+    jobs = ((seed, number, width, height, folder) for number in range(count))
+    processes = processes or os.cpu_count()
+    if processes == 1 or count < 1000:
+        yield from map(write_picture, jobs)
+        return
+
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap(write_picture, jobs, chunksize = 256)
+
+########## Products
+
+def picture_references(pictures: int, duplication: float) -> int:
+    """Products with a picture, if duplication of them are duplicates"""
+    if not 0 <= duplication < 1:
+        raise ValueError("Duplication ratio must be at least 0 and less than 1.")
+    return round(pictures / (1 - duplication))
+
+def assign_pictures(
+        products: int,
+        pictures: int,
+        duplication: float,
+        seed: int) -> Tuple[array.array, List[int]]:
+    """
+    Returns the picture number of every product (-1 for none), and the
+    reference count of every picture. Every picture is used at least once
+    """
+    references = picture_references(pictures, duplication)
+    if references > products:
+        raise ValueError(f"{pictures} pictures with a duplication ratio of {duplication} " +
+            f"need {references} products.")
+
+    rng = random.Random(f"{seed}-assignment")
+    assigned = array.array("l", [-1]) * products
+    ref_counts = [0] * pictures
+    references_left = references
+    new_left = pictures
+
+    for product in range(products):
+        # Selection sampling (Knuth's algorithm S): exactly "references"
+        # products get a picture, spread at random over the catalog
+        if rng.random() * (products - product) >= references_left:
+            continue
+
+        created = pictures - new_left
+        if not created or rng.random() * references_left < new_left:
+            picture = created
+            new_left -= 1
+        else:
+            # Popular pictures are uploaded again more often
+            picture = int(created * rng.random() ** 2)
+
+        references_left -= 1
+        assigned[product] = picture
+        ref_counts[picture] += 1
+
+    return assigned, ref_counts
+
+def generate_products(count: int, seed: int, pic_ids: list, assigned: array.array) -> Iterator[tuple]:
+    """
+    Rows of (prod_name, prod_descr, pic_id, prod_price, prod_instock,
+    prod_created). pic_ids are the ids of the pictures, by number
+    """
+    rng = random.Random(f"{seed}-products")
+    period = (CREATED_UNTIL - CREATED_FROM) / max(count, 1)
+
+    for product in range(count):
+        adjective, noun, color = rng.choice(ADJECTIVES), rng.choice(NOUNS), rng.choice(COLORS)
+        picture = assigned[product]
+
+        yield (
+            f"{adjective} {color} {noun}",
+            rng.choice(DESCRIPTIONS).format(adjective = adjective.lower(), noun = noun, color = color),
+            pic_ids[picture] if picture >= 0 else None,
+            # In cents, most of them cheap, a few very expensive
+            max(1, int(math.exp(rng.gauss(8, 1.3)))),
+            # One in ten is sold out
+            0 if rng.random() < 0.1 else int(rng.expovariate(1 / 20)) + 1,
+            CREATED_FROM + period * (product + rng.random())
+        )
+
+########## Database
+
+INSERT_PICS = """
+    INSERT INTO pics
+    (
+        pic_md5,
+        pic_path,
+        pic_ref_count
+    )
+    SELECT pic_md5, pic_path, pic_ref_count
+    FROM generated_pics
+    ORDER BY pic_number
+    ON CONFLICT (pic_md5) DO UPDATE
+    SET pic_ref_count = pics.pic_ref_count + EXCLUDED.pic_ref_count
+    RETURNING pic_id, pic_md5, (xmax = 0) AS is_new ;
+"""
+
+def generate_catalog(
+        db,
+        products: int,
+        pictures: int,
+        duplication: float = 0.2,
+        seed: int = 0,
+        upload_folder: str = "uploads",
+        picture_size: Tuple[int, int] = DEFAULT_PICTURE_SIZE,
+        queue_jobs: bool = False,
+        processes: int = None) -> CatalogReport:
+    """
+    Adds products and pictures to the database (an existing catalog is kept),
+    and picture files to upload_folder. Generating with the same seed again
+    adds the same products again, and references the same pictures once
+    more. Raises ValueError if there are not enough products for the
+    pictures (see assign_pictures).
+
+    Pictures are not processed, so they are served as they are, unless
+    queue_jobs is given: then the server creates their variants, as for
+    uploaded pictures (which takes a while for many of them).
+    """
+    report = CatalogReport()
+    assigned, ref_counts = assign_pictures(products, pictures, duplication, seed)
+
+    os.makedirs(upload_folder, exist_ok = True)
+    md5s = []
+    written = []
+    try:
+        pics = []
+        for number, (md5, path, is_new) in enumerate(
+                write_pictures(pictures, seed, upload_folder, picture_size, processes)):
+            md5s.append(md5)
+            pics.append( (number, md5, path, ref_counts[number]) )
+            if is_new:
+                written.append(path)
+
+        with db.transaction() as cur:
+            cur.execute("""
+                CREATE TEMPORARY TABLE generated_pics
+                (
+                    pic_number      BIGINT,
+                    pic_md5         TEXT,
+                    pic_path        TEXT,
+                    pic_ref_count   INT
+                )
+                ON COMMIT DROP ;
+            """)
+            cur.copy_expert(
+                "COPY generated_pics FROM STDIN",
+                CopyStream(pics),
+                size = COPY_BUFFER_SIZE)
+            del pics
+
+            cur.execute(INSERT_PICS)
+            id_by_md5 = {}
+            new_ids = []
+            for pic_id, md5, is_new in cur.fetchall():
+                id_by_md5[md5] = pic_id
+                if is_new:
+                    new_ids.append(pic_id)
+
+            if queue_jobs and new_ids:
+                cur.execute("""
+                    INSERT INTO pic_jobs (pic_id)
+                    SELECT UNNEST(%s::bigint[])
+                    ON CONFLICT (pic_id) DO NOTHING ;
+                """, (new_ids,) )
+
+            cur.copy_expert(
+                """COPY products
+                (prod_name, prod_descr, pic_id, prod_price, prod_instock, prod_created)
+                FROM STDIN""",
+                CopyStream(generate_products(products, seed, [id_by_md5[md5] for md5 in md5s], assigned)),
+                size = COPY_BUFFER_SIZE)
+
+            # So the planner knows about the new rows right away
+            cur.execute("ANALYZE pics ;")
+            cur.execute("ANALYZE products ;")
+
+    except BaseException:
+        # Files we wrote are of no use to anybody now
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+
+    report.products = products
+    report.pictures = pictures
+    report.pictures_added = len(new_ids)
+    report.references = sum(ref_counts)
+    report.files_written = len(written)
+    return report
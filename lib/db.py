@@ -1,12 +1,32 @@
-import psycopg2, os
+import psycopg2, psycopg2.errors, psycopg2.extensions, collections, logging, os, re, secrets, hashlib, time
 from dotenv import load_dotenv
+from contextlib import contextmanager
+from typing import List
 import datetime as dt
 
 from lib.singleton import Singleton
 import lib.exceptions as exceptions
+import lib.pool as pool
+import lib.query_stats as query_stats
+
+logger = logging.getLogger(__name__)
 
 class QueryResult:
     """Basically a struct for fitting the relevant parts of the result"""
+
+    # There can be many results alive at once (one per request), and
+    # __slots__ keeps them small and their attributes fast
+    __slots__ = (
+        "datetime",
+        "status_msg",
+        "descr",
+        "row_count",
+        "rows",
+        "columns",
+        "labeled_rows",
+        "named_rows"
+    )
+
     def __init__(self, status_msg: str, descr: tuple, row_count: int, rows: list):
         # This middleware generates output which is a little more compact than
         # Node.js's PG. Here, we receive a description of the columns (descr),
@@ -23,7 +43,8 @@ class QueryResult:
 
         # I did not want to do this by default because we would be running into
         # some overhead which might not be needed every time. So, to get labeled
-        # rows, call instance method json()
+        # rows, call instance method json() (dictionaries) or named()
+        # (namedtuples). Both are built once, on first use
 
         # Typically, the API will call the DB as db.query(...).json()
 
@@ -33,23 +54,31 @@ class QueryResult:
         self.row_count = row_count
         self.rows = rows
         self.labeled_rows = None
+        self.named_rows = None
 
-    def json(self):
-        # This is not even JSON, it is a dictionary, but the name stuck
-        if self.labeled_rows:
-            return self.labeled_rows
-        
-        self.labeled_rows = []
-        number_of_cols = len(self.descr)
-        for r in self.rows:
-            row_dict = {}
-            for i in range(number_of_cols):
-                col = self.descr[i]
-                row_dict[col.name] = r[i]
-            self.labeled_rows.append(row_dict)
+        # Names of the columns, in order, taken from the description only once
+        self.columns = tuple(col.name for col in descr) if descr else ()
 
+    def index(self, column: str) -> int:
+        """Position of a column in the rows"""
+        return self.columns.index(column)
+
+    def json(self) -> list:
+        # This is not even JSON, it is a list of dictionaries, but the name
+        # stuck
+        if self.labeled_rows is None:
+            columns = self.columns
+            self.labeled_rows = [dict(zip(columns, row)) for row in self.rows or ()]
         return self.labeled_rows
 
+    def named(self) -> list:
+        # Rows as namedtuples: labeled, but still tuples, so they are
+        # cheaper than dictionaries
+        if self.named_rows is None:
+            row_type = collections.namedtuple("Row", self.columns, rename = True)
+            self.named_rows = [row_type._make(row) for row in self.rows or ()]
+        return self.named_rows
+
     def single(self):
         # If a single value was returned (single row and single column),
         # this allows to access its value
@@ -66,8 +95,160 @@ class QueryResult:
             + f"{ self.row_count } rows affected\n"
             + "-----" )
 
+# Statement registry. Queries that run all the time are declared once, by
+# name, with statement(), and DB.query() runs them with EXECUTE. Each pooled
+# connection PREPAREs a statement the first time it runs it, so from then on
+# Postgres neither parses nor (after a few runs, once it settles on a generic
+# plan) plans it again. Queries built on the fly (e.g. by ProductQuery) can
+# be prepared too, with DB.query(..., prepare = True), and are then
+# registered under a name derived from their text.
+#
+# The registry also tells which queries the app runs, see statements().
+
+REGEX_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+REGEX_PARAM = re.compile(r"\$(\d+)")
+REGEX_PLACEHOLDER = re.compile(r"%%|%s")
+
+class Statement:
+    """
+    A query declared by name, with parameters $1, $2, etc, whose types can
+    be given (e.g. ["bigint", "text"]) or left for Postgres to infer
+    """
+    def __init__(self, name: str, sql: str, types: List[str] = None):
+        if not REGEX_NAME.search(name):
+            raise ValueError(f"Invalid statement name {name}")
+
+        self.name = name
+        self.sql = sql.strip().rstrip(";").strip()
+        self.types = list(types or [])
+
+        n_params = max([int(n) for n in REGEX_PARAM.findall(self.sql)], default = 0)
+        n_params = max(n_params, len(self.types))
+
+        types = f" ({', '.join(self.types)})" if self.types else ""
+        self.prepare_sql = f"PREPARE {self.name}{types} AS {self.sql} ;"
+        params = f" ({', '.join(['%s'] * n_params)})" if n_params else ""
+        self.execute_sql = f"EXECUTE {self.name}{params} ;"
+
+    def __str__(self):
+        return self.execute_sql
+
+STATEMENTS = {}
+
+# Text given to prepared() -> its Statement, so we only convert it once
+PREPARED_TEXTS = {}
+
+def statement(name: str, sql: str, types: List[str] = None) -> Statement:
+    """
+    Declares a statement. Declaring the same name twice is only allowed with
+    the same query (e.g. when a module is imported again)
+    """
+    new = Statement(name, sql, types)
+    old = STATEMENTS.get(name)
+    if old is not None:
+        if (old.sql, old.types) != (new.sql, new.types):
+            raise ValueError(f"Statement {name} was already declared")
+        return old
+    STATEMENTS[name] = new
+    return new
+
+def to_params(fmtstr: str) -> str:
+    """
+    Turns the %s placeholders of a query written for DB.query into $1, $2,
+    etc, which is what PREPARE (and asyncpg, see lib/db_async.py) expect
+    """
+    count = [0]
+    def to_param(match):
+        if match.group(0) == "%%":
+            return "%"
+        count[0] += 1
+        return f"${count[0]}"
+
+    return REGEX_PLACEHOLDER.sub(to_param, fmtstr.strip())
+
+def prepared(fmtstr: str) -> Statement:
+    """
+    Statement for a query written for DB.query, with %s placeholders. Its
+    name comes from the text of the query, so the same query is only
+    registered (and prepared) once
+    """
+    found = PREPARED_TEXTS.get(fmtstr)
+    if found is not None:
+        return found
+
+    sql = to_params(fmtstr)
+    name = "q_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    found = STATEMENTS.get(name) or statement(name, sql)
+    PREPARED_TEXTS[fmtstr] = found
+    return found
+
+def statements() -> List[Statement]:
+    return list(STATEMENTS.values())
+
+class Cursor (psycopg2.extensions.cursor):
+    """
+    A cursor that times every statement it runs, see lib/query_stats.py.
+    Server-side (named) cursors are not timed: most of their work happens
+    while fetching, not in execute()
+    """
+    def execute(self, query, vars = None):
+        stats = query_stats.QueryStats()
+        if not stats.enabled or self.name is not None:
+            return super().execute(query, vars)
+
+        start = time.perf_counter()
+        try:
+            super().execute(query, vars)
+        except Exception:
+            stats.record(query, time.perf_counter() - start, 0, error = True)
+            raise
+        elapsed = time.perf_counter() - start
+
+        key = stats.record(query, elapsed, max(self.rowcount, 0))
+        if stats.is_slow(elapsed) and stats.should_explain(key):
+            self.log_slow(stats, query, vars, elapsed)
+
+    def log_slow(self, stats, query, vars, elapsed: float) -> None:
+        try:
+            statement = self.mogrify(query, vars).decode("utf-8", "replace")
+        except Exception:
+            statement = str(query)
+
+        # An error in EXPLAIN would abort the caller's transaction, so we
+        # only explain outside of transactions (e.g. DB.query)
+        plan = None
+        if self.connection.autocommit and stats.is_explainable(statement):
+            try:
+                with self.connection.cursor(cursor_factory = psycopg2.extensions.cursor) as cur:
+                    cur.execute("EXPLAIN " + statement)
+                    plan = [row[0] for row in cur.fetchall()]
+            except psycopg2.Error as err:
+                plan = [f"(could not explain: {err})"]
+
+        stats.log_slow(statement, elapsed, plan)
+
+class Connection (psycopg2.extensions.connection):
+    """
+    A connection that remembers which statements were prepared in it, and
+    whose cursors are timed
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.cursor_factory = Cursor
+
 class DB (metaclass = Singleton):
-    conn = None
+    # Default sizes for the connection pool. Waitress runs 4 threads by
+    # default, so a few spare connections are enough. These can be overriden
+    # with environment variables POSTGRES_POOL_MIN, POSTGRES_POOL_MAX and
+    # POSTGRES_POOL_TIMEOUT (in seconds)
+    POOL_MIN_SIZE = 1
+    POOL_MAX_SIZE = 8
+    POOL_TIMEOUT = 5.0
+
+    # Rows fetched at a time by stream(). Can be overriden with environment
+    # variable POSTGRES_FETCH_SIZE
+    FETCH_SIZE = 2000
 
     def __init__(self):
         # When running development, flask will automatically import ".env"
@@ -80,11 +261,19 @@ class DB (metaclass = Singleton):
         self.dbname = os.getenv("POSTGRES_DATABASE")
         self.port = os.getenv("POSTGRES_PORT")
 
+        self.pool_min_size = int(os.getenv("POSTGRES_POOL_MIN", self.POOL_MIN_SIZE))
+        self.pool_max_size = int(os.getenv("POSTGRES_POOL_MAX", self.POOL_MAX_SIZE))
+        self.pool_timeout = float(os.getenv("POSTGRES_POOL_TIMEOUT", self.POOL_TIMEOUT))
+        self.fetch_size = int(os.getenv("POSTGRES_FETCH_SIZE", self.FETCH_SIZE))
+
+        self.inherited_pools = []
         try:
-            self.conn = self.connect()
-            self.conn.autocommit = True
+            self.pool = self.create_pool(self.pool_min_size)
         except Exception as e:
-            print(f"Connection to database could not be established!\n{str(e)}")
+            # We will not give up here. The pool will try to connect again
+            # the next time somebody needs a connection
+            logger.error("Connection to database could not be established: %s", e)
+            self.pool = self.create_pool(0)
 
     def get_sql_env(self):
         return {
@@ -96,36 +285,206 @@ class DB (metaclass = Singleton):
             }
 
     def connect(self):
-        return psycopg2.connect(**self.get_sql_env())
+        conn = psycopg2.connect(connection_factory = Connection, **self.get_sql_env())
+        conn.autocommit = True
+        return conn
 
-    def query(
+    def create_pool(self, min_size: int) -> pool.ConnectionPool:
+        return pool.ConnectionPool(
+            self.connect,
+            min_size = min_size,
+            max_size = self.pool_max_size,
+            timeout = self.pool_timeout,
+            is_healthy = self.is_healthy
+        )
+
+    @staticmethod
+    def is_healthy(conn) -> bool:
+        # conn.closed only tells us if *we* closed the connection, or if
+        # psycopg2 already noticed it was broken. To know whether the server is
+        # still there, we need a round trip
+        if conn.closed:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1 ;")
+            cur.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def reset_pool(self) -> None:
+        """
+        Must be called in a child process after fork. Connections cannot be
+        shared between processes, so the child starts over with a new pool.
+        """
+        # The parent's pool is kept, untouched: its lock might have been held
+        # by one of the parent's threads when we forked, and if its
+        # connections were garbage collected, psycopg2 would close them,
+        # ending the parent's sessions on the server
+        self.inherited_pools.append(self.pool)
+        self.pool = self.create_pool(0)
+
+    def pool_stats(self) -> dict:
+        return self.pool.get_stats()
+
+    def pool_wait_times(self):
+        return self.pool.get_wait_times()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for exclusive use of the caller, e.g. for
+        running several statements in a single transaction. Usage:
+
+        with db.connection() as conn:
+            ...
+
+        Connection is returned to the pool when the block exits. If the
+        connection was broken in the meantime, it is discarded.
+        """
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        except psycopg2.Error:
+            self.pool.putconn(conn, discard = bool(conn.closed))
+            raise
+        except BaseException:
+            self.pool.putconn(conn)
+            raise
+        else:
+            self.pool.putconn(conn)
+
+    @contextmanager
+    def transaction(self, cursor_name: str = None):
+        """
+        Yields a cursor inside a transaction. Transaction is committed if the
+        block exits normally, and rolled back otherwise.
+
+        If cursor_name is given, the cursor is a named (server-side) one, see
+        stream()
+        """
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn:
+                    with conn.cursor(name = cursor_name) as cur:
+                        yield cur
+            finally:
+                if not conn.closed:
+                    conn.autocommit = True
+
+    def stream(
                 self,
                 fmtstr: str,
                 args: tuple = tuple(),
-                verbose: bool = False ):
+                fetch_size: int = None):
+        """
+        Generator yielding the rows of a query one by one, for results that
+        are too large for query(), which keeps all of them in memory.
+
+        Rows are kept in a named cursor on the server side, and we only fetch
+        fetch_size of them at a time, so memory stays flat no matter how many
+        rows there are. The connection is held until the generator is
+        exhausted or closed (e.g. when the client of a streamed response
+        disconnects), and the transaction is then rolled back or committed.
+        """
+        name = f"stream_{secrets.token_hex(8)}"
+        with self.transaction(cursor_name = name) as cur:
+            cur.itersize = fetch_size or self.fetch_size
+            cur.execute(fmtstr.strip(), args)
+            for row in cur:
+                yield row
+
+    def query(
+                self,
+                fmtstr,
+                args: tuple = tuple(),
+                verbose: bool = False,
+                prepare: bool = False ):
+        # fmtstr can also be a Statement (see statement()), or be turned into
+        # one with prepare = True
+
         # In case user accidentally uses sole argument without making it into
         # a tuple, we can help them and prevent an error
         if type(args) != tuple:
-            print("Warning: argument should be given as tuple")
+            logger.warning("Argument should be given as tuple")
             args = (args,)
-        
-        # Strip formated string of whitespace
-        stripped = fmtstr.strip()
-        if stripped[-1] != ";":
-            print("Warning: SQL command was not terminated with semi-colon")
 
+        if prepare:
+            fmtstr = prepared(fmtstr)
+
+        if isinstance(fmtstr, Statement):
+            stripped = fmtstr
+        else:
+            # Strip formated string of whitespace
+            stripped = fmtstr.strip()
+            if stripped[-1] != ";":
+                logger.warning("SQL command was not terminated with semi-colon")
+
+        # Every query checks out its own connection from the pool, so
+        # concurrent requests do not serialize on a single socket. If the
+        # connection turns out to be closed before we even sent the command
+        # (InterfaceError), it is safe to try again with a fresh one
+
+        try:
+            conn = self.pool.getconn()
+        except pool.PoolTimeout:
+            raise
+        except Exception as err:
+            logger.error("Could not get a connection: %s", err, exc_info = err)
+            raise exceptions.InternalServerError("Could not get connection.")
+
+        try:
+            return self.execute(conn, stripped, args, verbose)
+        except psycopg2.InterfaceError:
+            self.pool.putconn(conn, discard = True)
+            conn = None
+        finally:
+            if conn is not None:
+                self.pool.putconn(conn, discard = bool(conn.closed))
+
+        conn = self.pool.getconn()
+        try:
+            return self.execute(conn, stripped, args, verbose)
+        except psycopg2.InterfaceError:
+            raise exceptions.InternalServerError("Lost connection to database.")
+        finally:
+            self.pool.putconn(conn, discard = bool(conn.closed))
+
+    @staticmethod
+    def run(conn, cur, stripped, args: tuple) -> None:
+        if not isinstance(stripped, Statement):
+            cur.execute(stripped, args)
+            return
+
+        # Connections come from connect(), so they are a Connection
+        if stripped.name not in conn.prepared:
+            cur.execute(stripped.prepare_sql)
+            conn.prepared.add(stripped.name)
+
+        try:
+            cur.execute(stripped.execute_sql, args)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Somebody deallocated it behind our back (e.g. DISCARD ALL)
+            cur.execute(stripped.prepare_sql)
+            cur.execute(stripped.execute_sql, args)
+
+    def execute(self, conn, stripped, args: tuple, verbose: bool):
         # We need to get the cursor here. For the same connection, many
         # cursors can be active, and we need one per query, if we don't
         # want to run into race conditions
 
         try:
-            cur = self.conn.cursor()
+            cur = conn.cursor()
+        except psycopg2.InterfaceError:
+            raise
         except:
-            print("Could not get a cursor!")
+            logger.error("Could not get a cursor!")
             raise exceptions.InternalServerError("Could not get cursor.")
 
         try:
-            cur.execute(stripped, args)
+            self.run(conn, cur, stripped, args)
             query_result = QueryResult(
                 cur.statusmessage,
                 cur.description,
@@ -134,6 +493,11 @@ class DB (metaclass = Singleton):
             )
             cur.close()
             return query_result
+
+        except psycopg2.InterfaceError:
+            # Connection was already closed. Caller will deal with this
+            cur.close()
+            raise
             
         except psycopg2.IntegrityError as err:
             # If this error is raised, a constraint was violated
@@ -144,10 +508,9 @@ class DB (metaclass = Singleton):
             # filtered this. Better to examine with care.
             
             if verbose:
-                cmd = cur.mogrify(stripped, args).decode("utf-8")
-                print(f"Integrity error! SQL command <{cmd}> raised an error")
-                print(err)
-                print("Are you trying to insert non-sanitized or non-validated data?")
+                # Are you trying to insert non-sanitized or non-validated data?
+                cmd = cur.mogrify(str(stripped), args).decode("utf-8")
+                logger.warning("Integrity error: %s", err, extra = {"statement": cmd})
             cur.close()
             raise exceptions.BadRequest("Integrity error occurred interacting with database")
 
@@ -155,10 +518,12 @@ class DB (metaclass = Singleton):
             # Another kind of error occurred. Could be anything, from a disconnect
             # to a programming mistake. This is considered more serious than the
             # above.
-            print(err)
-            cmd = cur.mogrify(stripped, args).decode("utf-8")
+            try:
+                cmd = cur.mogrify(str(stripped), args).decode("utf-8")
+            except psycopg2.Error:
+                cmd = str(stripped)
             cur.close()
-            print(f"Error! SQL command <{cmd}> raised an error")
-            exceptions.printerr(err)
+            logger.error("SQL command raised an error: %s", err,
+                exc_info = err, extra = {"statement": cmd})
             raise exceptions.InternalServerError("An unknown error happened.")
         
\ No newline at end of file
@@ -0,0 +1,149 @@
+import asyncio, collections, logging, os, time
+from dotenv import load_dotenv
+
+from lib.singleton import Singleton
+from lib.db import QueryResult, Statement, to_params
+import lib.exceptions as exceptions
+import lib.pool as pool
+import lib.query_stats as query_stats
+
+# asyncpg is only needed by the asynchronous variant of the API (see
+# asgi.py). The rest of the app runs without it
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+# Same interface as lib/db.py, as far as the asynchronous API needs it, on top
+# of asyncpg: query() and stream() are coroutines, and do not block the event
+# loop while Postgres works. Queries are the same ones, written with %s
+# placeholders or declared with statement(). asyncpg prepares every query it
+# runs, once per connection, and keeps them in a cache of its own, so there
+# is no need for PREPARE / EXECUTE here.
+#
+# Rows are asyncpg Records, which can be indexed and iterated like the tuples
+# of psycopg2, so QueryResult (and serialize.dumps_rows) work the same.
+
+# Description of a column, for QueryResult. Only the name is used
+Column = collections.namedtuple("Column", ["name"])
+
+def to_sql(fmtstr) -> str:
+    if isinstance(fmtstr, Statement):
+        return fmtstr.sql
+    return to_params(fmtstr).rstrip(";").strip()
+
+class AsyncDB (metaclass = Singleton):
+    # Same defaults and environment variables as lib/db.py. Connections are
+    # only held while a query runs, so a few of them serve thousands of
+    # clients, however slowly they read
+    POOL_MIN_SIZE = 1
+    POOL_MAX_SIZE = 8
+    POOL_TIMEOUT = 5.0
+    FETCH_SIZE = 2000
+
+    def __init__(self):
+        if asyncpg is None:
+            raise ImportError("The asynchronous API needs asyncpg, run: pip install asyncpg")
+
+        load_dotenv()
+
+        self.user = os.getenv("POSTGRES_USER")
+        self.password = os.getenv("POSTGRES_PASSWORD")
+        self.host = os.getenv("POSTGRES_HOST")
+        self.dbname = os.getenv("POSTGRES_DATABASE")
+        self.port = os.getenv("POSTGRES_PORT")
+
+        self.pool_min_size = int(os.getenv("POSTGRES_POOL_MIN", self.POOL_MIN_SIZE))
+        self.pool_max_size = int(os.getenv("POSTGRES_POOL_MAX", self.POOL_MAX_SIZE))
+        self.pool_timeout = float(os.getenv("POSTGRES_POOL_TIMEOUT", self.POOL_TIMEOUT))
+        self.fetch_size = int(os.getenv("POSTGRES_FETCH_SIZE", self.FETCH_SIZE))
+
+        # Created by start(), in the event loop that will use it
+        self.pool = None
+
+    async def start(self) -> None:
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(
+            user = self.user,
+            password = self.password,
+            host = self.host,
+            database = self.dbname,
+            port = self.port,
+            min_size = self.pool_min_size,
+            max_size = self.pool_max_size)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def acquire(self):
+        try:
+            return await self.pool.acquire(timeout = self.pool_timeout)
+        except asyncio.TimeoutError:
+            raise pool.PoolTimeout("Timed out waiting for a connection.")
+
+    async def query(self, fmtstr, args: tuple = tuple()) -> QueryResult:
+        """
+        Runs the query and returns all of its rows. row_count is the number
+        of rows returned (use RETURNING to know what a write changed)
+        """
+        sql = to_sql(fmtstr)
+        stats = query_stats.QueryStats()
+
+        conn = await self.acquire()
+        start = time.perf_counter()
+        try:
+            rows = await conn.fetch(sql, *args)
+            if rows:
+                names = rows[0].keys()
+            else:
+                # No row to take the columns from. prepare() does not use
+                # the cache of statements, so we only pay for it here
+                stmt = await conn.prepare(sql)
+                names = [attribute.name for attribute in stmt.get_attributes()]
+
+        except asyncpg.IntegrityConstraintViolationError as err:
+            # Same as DB.execute: application logic should have filtered this
+            stats.record(fmtstr, time.perf_counter() - start, 0, error = True)
+            raise exceptions.BadRequest("Integrity error occurred interacting with database") from err
+
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as err:
+            stats.record(fmtstr, time.perf_counter() - start, 0, error = True)
+            logger.error("SQL command raised an error: %s", err,
+                exc_info = err, extra = {"statement": sql, "args": repr(args)})
+            raise exceptions.InternalServerError("An unknown error happened.") from err
+
+        finally:
+            await self.pool.release(conn)
+
+        elapsed = time.perf_counter() - start
+        if stats.enabled:
+            key = stats.record(fmtstr, elapsed, len(rows))
+            # No plan: EXPLAIN would hold the connection for another round
+            # trip, and the statement is in the log anyway
+            if stats.is_slow(elapsed) and stats.should_explain(key):
+                stats.log_slow(f"{sql} -- {args!r}", elapsed)
+
+        descr = tuple(Column(name) for name in names)
+        return QueryResult(None, descr, len(rows), rows)
+
+    async def stream(self, fmtstr, args: tuple = tuple(), fetch_size: int = None):
+        """
+        Asynchronous generator of the rows of a query, one by one, fetched
+        fetch_size at a time from a cursor on the server side, like
+        DB.stream. The connection is held until the generator is exhausted
+        or closed (call aclose() if you stop early)
+        """
+        sql = to_sql(fmtstr)
+        conn = await self.acquire()
+        try:
+            # Cursors only live inside a transaction
+            async with conn.transaction():
+                async for row in conn.cursor(sql, *args, prefetch = fetch_size or self.fetch_size):
+                    yield row
+        finally:
+            await self.pool.release(conn)
@@ -1,17 +1,13 @@
 from flask import Response
-import traceback, sys, datetime
+import logging
 
-# Just to make the code more readable when throwing an unknown exception
-def printerr(err):
-    LINE_LENGTH = 60
-    date_string = " " + str(datetime.datetime.now()) + " "
+logger = logging.getLogger(__name__)
 
-    # Print date in a centered format
-    margin = int((LINE_LENGTH - len(date_string)) / 2)
-    print(f"{'-' * margin}{date_string}{'-' * margin}", file = sys.stderr)
-    traceback.print_tb(err.__traceback__)
-    print(err)
-    print("-" * LINE_LENGTH, file = sys.stderr)
+# Just to make the code more readable when throwing an unknown exception. It
+# used to print the traceback between two lines with the date, now it is a
+# log record (see lib/log.py), with the traceback in field "exception"
+def printerr(err):
+    logger.error(str(err) or type(err).__name__, exc_info = err, stacklevel = 2)
 
 # Abstract class, not to be used directly
 class CustomException(Exception):
@@ -28,6 +24,10 @@ class BadRequest(CustomException):
     name = "Bad request"
     code = 400
 
+class Forbidden(CustomException):
+    name = "Forbidden"
+    code = 403
+
 class NotFound(CustomException):
     name = "Not found"
     code = 404
@@ -1,45 +1,86 @@
-import os
+import os, hashlib, logging, threading
 from werkzeug.datastructures import FileStorage
-from typing import Tuple
+from typing import Tuple, Callable, List
 
 import lib.file_utils as file_utils
 import lib.pic_utils as pic_utils
 import lib.exceptions as exceptions
 
+logger = logging.getLogger(__name__)
+
+# Pillow is optional. Without it, we fall back to the command line tools
+# (file, exiftool and ImageMagick)
+try:
+    import lib.pic_pillow as pic_pillow
+except ImportError:
+    pic_pillow = None
+
 # File max size, given in bytes (5 MB)
 # This is just a suggestion, client applications can use their own parameters,
 # perhaps by accessing app.config["MAX_CONTENT_LENGTH"]
 FILE_MAX_SIZE = 5 * 1024 * 1024
 
-def save_file(
-            file_storage: FileStorage,
-            upload_path: str,
-            max_size: int = FILE_MAX_SIZE,
-            check_size_before_saving: bool = False) -> str:
+# Uploads are read and written in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Suffix for files that are still being received. They are renamed once we
+# know they are complete and valid
+TMP_SUFFIX = ".part"
+
+# Picture processing can be done in-process, with Pillow ("pillow"), or by
+# launching command line tools ("subprocess"). Environment variable PIC_BACKEND
+# can be used to choose one of them
+BACKEND_PILLOW = "pillow"
+BACKEND_SUBPROCESS = "subprocess"
+DEFAULT_BACKEND = os.getenv(
+    "PIC_BACKEND",
+    BACKEND_PILLOW if pic_pillow else BACKEND_SUBPROCESS)
+
+def get_backend(backend: str = None) -> str:
+    backend = backend or DEFAULT_BACKEND
+    if backend not in (BACKEND_PILLOW, BACKEND_SUBPROCESS):
+        raise Exception(f"Unknown picture backend {backend}")
+    if backend == BACKEND_PILLOW and not pic_pillow:
+        raise Exception("Pillow backend was selected, but Pillow is not installed")
+    return backend
+
+def get_pic_subtype(path: str, backend: str = None) -> str:
     """
-    Returns path to saved file or raise an exception.
+    Returns the mime subtype of the picture (e.g. "png"), or None if the file
+    is not a picture
+    """
+    try:
+        if get_backend(backend) == BACKEND_PILLOW:
+            file_type, file_subtype = pic_pillow.sniff(path)
+        else:
+            file_type, file_subtype = file_utils.get_mime_type(path)
+    except Exception:
+        return None
 
-    If max_size is zero, file will get saved to disk right away, without
-    checking how big it is. Use this setting if you are already using middleware
-    that prevents the program from receiving a too big file.
-    
-    If max_size is non-zero and check_size_before_saving is True, we will seek
-    file end as a stream before saving it to disk
+    return file_subtype if file_type == "image" else None
 
-    https://werkzeug.palletsprojects.com/en/2.0.x/datastructures/#werkzeug.datastructures.FileStorage
-    https://stackoverflow.com/questions/15772975/flask-get-the-size-of-request-files-object
+def stream_file(
+            file_storage: FileStorage,
+            upload_path: str,
+            max_size: int = FILE_MAX_SIZE) -> Tuple[str, str, int]:
     """
-    new_name = file_utils.get_new_name()
+    Copies the uploaded file, chunk by chunk, to a temporary file in
+    upload_path. Returns (temporary path, MD5 hash, size in bytes).
 
+    The file is read only once: MD5 hash and size are calculated as we go, so
+    we never need to read it back from disk. If it turns out to be larger than
+    max_size, we stop reading right away and nothing is left on disk. If
+    max_size is zero, size is not checked.
+    """
     if not os.path.isdir(upload_path):
         raise Exception("Given upload path does not exist!")
-    
-    new_path = os.path.join(upload_path, new_name)
+
+    tmp_path = os.path.join(upload_path, file_utils.get_new_name() + TMP_SUFFIX)
 
     # Unix paths (with filename and extension) can go up to 4096 characters.
     # As usual, we want to leave a fat margin and not have any problems
 
-    if len(new_path) > 2048:
+    if len(tmp_path) > 2048:
         raise Exception("File path is too long!")
 
     # Flask will already check if the payload exceeds the maximum size
@@ -47,46 +88,96 @@ def save_file(
     # supposed to serve as an independent piece of software, usable by other
     # frameworks, we will check file size again.
 
-    if check_size_before_saving:
-        file_storage.seek(0, os.SEEK_END)
-        file_size = file_storage.tell()
-    else:
-        file_storage.save(new_path)
-        file_size = os.path.getsize(new_path)
-    
-    if max_size != 0 and file_size > max_size:
-        if not check_size_before_saving:
-            os.remove(new_path)
-        raise Exception("File is too large!")
-
-    elif check_size_before_saving:
-        # Now we need to rewind the file...
-        file_storage.seek(0, 0)
-        file_storage.save(new_path)
+    md5 = hashlib.md5()
+    file_size = 0
+
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in iter(lambda: file_storage.stream.read(UPLOAD_CHUNK_SIZE), b""):
+                file_size += len(chunk)
+                if max_size != 0 and file_size > max_size:
+                    raise Exception("File is too large!")
+                md5.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path, md5.hexdigest(), file_size
+
+def save_file(
+            file_storage: FileStorage,
+            upload_path: str,
+            max_size: int = FILE_MAX_SIZE,
+            check_size_before_saving: bool = False) -> str:
+    """
+    Returns path to saved file or raise an exception.
+
+    If max_size is zero, file will get saved to disk right away, without
+    checking how big it is. Use this setting if you are already using middleware
+    that prevents the program from receiving a too big file.
+
+    check_size_before_saving is kept for compatibility. Size is now always
+    checked while the file is streamed to disk, which aborts as soon as the
+    limit is exceeded, without seeking the whole stream first.
+
+    https://werkzeug.palletsprojects.com/en/2.0.x/datastructures/#werkzeug.datastructures.FileStorage
+    """
+    tmp_path, _, _ = stream_file(file_storage, upload_path, max_size)
 
     # If everything went well, we return path to saved file
+    new_path = tmp_path[:-len(TMP_SUFFIX)]
+    os.rename(tmp_path, new_path)
     return new_path
 
 
 def save_pic(
         file_storage: FileStorage,
         upload_path: str,
-        max_size: int = FILE_MAX_SIZE) -> Tuple[str, str]:
+        max_size: int = FILE_MAX_SIZE,
+        backend: str = None,
+        is_duplicate: Callable[[str], bool] = None) -> Tuple[str, str]:
+    """
+    Saves uploaded picture and returns (path, MD5 hash).
+
+    is_duplicate is an optional function, which receives the MD5 hash of the
+    upload and tells whether we already have this picture. If so, the
+    temporary file is dropped before it becomes an actual upload, and the
+    returned path is None.
+    """
+    tmp_path, md5, _ = stream_file(file_storage, upload_path, max_size)
+
+    try:
+        # MD5 hash is calculated before processing, because processing is
+        # not a deterministic process
+
+        if is_duplicate and is_duplicate(md5):
+            os.remove(tmp_path)
+            return None, md5
 
-    file_path = save_file(file_storage, upload_path, max_size)
-    if not file_utils.test_mime_type(file_path, ["image"]):
-        os.remove(file_path)
-        raise exceptions.BadRequest("File is not an image!")
+        file_subtype = get_pic_subtype(tmp_path, backend)
+        if not file_subtype:
+            raise exceptions.BadRequest("File is not an image!")
 
-    # MD5 hash is calculated before processing, because processing is
-    # not a deterministic process
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    md5 = file_utils.get_md5_hash(file_path)
+    # The original file is served until processing is done, so it needs the
+    # right extension for its content type to be guessed
+    file_path = f"{tmp_path[:-len(TMP_SUFFIX)]}.{file_subtype}"
+    os.rename(tmp_path, file_path)
 
     return (file_path, md5)
 
-def process_pic(path: str, max_size: int = 600) -> str:
+def process_pic(path: str, max_size: int = 600, backend: str = None) -> str:
     try:
+        if get_backend(backend) == BACKEND_PILLOW:
+            # Picture is decoded once and written once, already with the
+            # right extension
+            return pic_pillow.process(path, max_size)
+
         pic_utils.strip_pic_metadata(path)
         pic_utils.resize(path, max_size)
         pic_utils.convert(path)
@@ -96,8 +187,50 @@ def process_pic(path: str, max_size: int = 600) -> str:
         # so we need to rename the extension accordingly
         new_path = file_utils.rename_mime_type(path)
     except Exception as err:
-        print(err)
+        logger.warning("Could not process picture %s: %s", path, err)
         os.remove(path)
         raise Exception("An error occurred while processing picture")
 
-    return new_path
\ No newline at end of file
+    return new_path
+
+def make_variants(
+        path: str,
+        widths: List[int],
+        subtypes: List[str],
+        backend: str = None) -> list:
+    """
+    Creates smaller versions of the processed picture in path. Returns a list
+    of (width, subtype, path, size in bytes).
+
+    Only the Pillow backend creates variants. With the subprocess backend,
+    clients always get the processed picture.
+    """
+    if get_backend(backend) != BACKEND_PILLOW:
+        return []
+
+    return pic_pillow.make_variants(path, widths, subtypes)
+
+def remove_pic_files(paths: List[str]) -> None:
+    """
+    Removes the files of a picture (the picture itself and its variants).
+    Files that are already gone are not an error
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def remove_pic_files_later(paths: List[str]) -> threading.Thread:
+    """
+    Removes files in a background thread, so that deleting thousands of
+    pictures does not keep the request waiting. The thread is not a daemon,
+    so the interpreter waits for it before exiting. Returns the thread, in
+    case somebody (e.g. a test) needs to wait for it
+    """
+    thread = threading.Thread(
+        target = remove_pic_files,
+        args = (list(paths),),
+        name = "remove-pic-files")
+    thread.start()
+    return thread
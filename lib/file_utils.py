@@ -1,9 +1,12 @@
-import time, os, re, subprocess, math, random, secrets
+import time, os, re, subprocess, math, random, secrets, hashlib
 from typing import Tuple, List
 
 # Range of random values to name a file
 N_RANDOM_BYTES = 4
 
+# How much of a file we read at a time when hashing it
+MD5_CHUNK_SIZE = 64 * 1024
+
 def get_new_name() -> str:
     # Unix allows up to 255 characters in file names.
     # We will use 24 digits for a unique name and allow
@@ -91,27 +94,18 @@ def get_md5_hash(path: str) -> str:
     """
     Returns MD5 hash for file.
     """
-    # See note on "get_meme_type" on why we are doing this from command line
-    # instead of a library
-    arg = f"md5sum \"{path}\""
+    # This used to launch "md5sum", like "get_mime_type" launches "file".
+    # hashlib gives exactly the same result without spawning a process
+    md5 = hashlib.md5()
 
     try:
-        output = subprocess.check_output(
-            arg,
-            shell = True,
-            text = True,
-            stderr = subprocess.DEVNULL
-        )
-    except subprocess.CalledProcessError:
-        raise Exception("Failed to calculate MD5 hash for file!")
-
-    regex = re.compile(r"^([0-9a-f]{32}).*$")
-    match = regex.search(output)
-
-    if not match:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(MD5_CHUNK_SIZE), b""):
+                md5.update(chunk)
+    except OSError:
         raise Exception("Failed to calculate MD5 hash for file!")
 
-    return match.groups()[0]
+    return md5.hexdigest()
 
 
 def append_extension(path: str, extension: str) -> str:
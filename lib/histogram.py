@@ -0,0 +1,82 @@
+import bisect
+from typing import Iterable
+
+# Latencies are not normally distributed, and averages hide the slow requests
+# we care about. A histogram keeps how many observations fell below each of a
+# few fixed bounds, which costs a few integers no matter how many observations
+# there are, and is what Prometheus expects.
+
+# In seconds, from half a millisecond to ten seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their count and sum. Not
+    thread-safe by itself: callers hold their own lock, since they usually
+    update other counters at the same time
+    """
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: Iterable[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(bounds))
+        # One more, for everything above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self) -> "Histogram":
+        result = Histogram(self.bounds)
+        result.counts = list(self.counts)
+        result.count = self.count
+        result.sum = self.sum
+        return result
+
+    def merge(self, other: "Histogram") -> None:
+        """Adds the observations of another histogram, with the same bounds"""
+        if other.bounds != self.bounds:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def cumulative(self) -> list:
+        """(upper bound, observations up to it), the last bound being infinity"""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate of the q-quantile (e.g. 0.99), as the upper bound of the
+        bucket where it falls. Observations above the last bound are
+        reported as the last bound
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound if bound != float("inf") else self.bounds[-1]
+        return self.bounds[-1]
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): total
+                for bound, total in self.cumulative()}
+        }
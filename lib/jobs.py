@@ -0,0 +1,393 @@
+import fcntl, multiprocessing, os, secrets, shutil, threading
+from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from lib.singleton import Singleton
+from lib.db import statement
+import lib.exceptions as exceptions
+import lib.file_upload as file_upload
+import lib.file_utils as file_utils
+import lib.log as log
+
+# Picture processing (resizing, converting, etc) used to happen inside the
+# request, blocking a waitress thread for seconds. Now the request only
+# enqueues a job, which is persisted in table pic_jobs, and a dispatcher thread
+# hands jobs to a pool of worker processes.
+#
+# While a picture is being processed, pics.pic_path keeps pointing to the
+# original upload, so it can be served in the meantime. When processing
+# finishes, pic_path is switched to the new file and the original is removed.
+
+STATUS_QUEUED = "queued"
+STATUS_PROCESSING = "processing"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Run for every picture uploaded or shown, so they are prepared once per
+# connection, see lib/db.py
+INSERT_JOB = statement("insert_pic_job", """
+    INSERT INTO pic_jobs (pic_id)
+    VALUES ($1)
+    ON CONFLICT (pic_id) DO NOTHING ;
+""", ["bigint"])
+
+SELECT_JOB_STATUS = statement("select_pic_job_status", """
+    SELECT job_status
+    FROM pic_jobs
+    WHERE pic_id = $1 ;
+""", ["bigint"])
+
+def client_status(result) -> str:
+    """
+    Status of a picture's processing as shown to clients, from the result of
+    SELECT_JOB_STATUS. Pictures without a job are considered done (e.g. they
+    were uploaded before jobs existed). For clients, a job waiting in the
+    queue is already being processed
+    """
+    if not result.row_count:
+        return STATUS_DONE
+
+    status = result.single()
+    return STATUS_PROCESSING if status == STATUS_QUEUED else status
+
+def init_worker() -> None:
+    """
+    Runs first in every worker process. They are not forked from the server
+    (see JobQueue.create_executor), so they have none of its logging
+    """
+    log.Logging().start(queued = False)
+
+def process_copy(
+        path: str,
+        max_size: int,
+        backend: str,
+        variant_widths: List[int],
+        variant_formats: List[str]) -> Tuple[str, list]:
+    """
+    Runs in a worker process. Processes a copy of the picture, so that the
+    original can still be served while we work, and creates its variants.
+    Returns the new path and the list of variants
+    """
+    work_path = os.path.join(os.path.dirname(path), file_utils.get_new_name())
+    shutil.copyfile(path, work_path)
+    new_path = file_upload.process_pic(work_path, max_size, backend)
+
+    try:
+        variants = file_upload.make_variants(
+            new_path,
+            variant_widths,
+            variant_formats,
+            backend)
+    except Exception:
+        os.remove(new_path)
+        raise
+
+    return new_path, variants
+
+def parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+class Job:
+    """Basically a struct for a claimed job"""
+    def __init__(self, job_id: int, pic_id: int, pic_path: str, token: str):
+        self.job_id = job_id
+        self.pic_id = pic_id
+        self.pic_path = pic_path
+        self.token = token
+
+class JobQueue (metaclass = Singleton):
+    # Defaults, can be overriden with environment variables PIC_WORKERS,
+    # PIC_MAX_SIZE, PIC_VARIANT_WIDTHS, PIC_VARIANT_FORMATS, PIC_JOB_ATTEMPTS
+    # and PIC_JOB_LEASE (in seconds)
+    WORKERS = 2
+    PIC_MAX_SIZE = 600
+    # The front end lists the same widths in its srcset (VARIANT_WIDTHS in
+    # client/src/components/Image.jsx), change both together
+    VARIANT_WIDTHS = "160,320,480"
+    VARIANT_FORMATS = "jpeg,webp"
+    MAX_ATTEMPTS = 3
+    LEASE = 300
+    POLL_INTERVAL = 2.0
+
+    def __init__(self, db):
+        self.db = db
+        self.workers = int(os.getenv("PIC_WORKERS", self.WORKERS))
+        self.pic_max_size = int(os.getenv("PIC_MAX_SIZE", self.PIC_MAX_SIZE))
+        self.max_attempts = int(os.getenv("PIC_JOB_ATTEMPTS", self.MAX_ATTEMPTS))
+
+        # Every processed picture also gets a smaller version for each of
+        # these widths and formats, e.g. "160,320,480" and "jpeg,webp"
+        self.variant_widths = [int(width) for width in
+            parse_list(os.getenv("PIC_VARIANT_WIDTHS", self.VARIANT_WIDTHS))]
+        self.variant_formats = parse_list(
+            os.getenv("PIC_VARIANT_FORMATS", self.VARIANT_FORMATS))
+
+        # A job claimed for longer than this is considered abandoned (e.g. the
+        # server was restarted in the middle of it) and is claimed again
+        self.lease = int(os.getenv("PIC_JOB_LEASE", self.LEASE))
+
+        if self.workers < 1:
+            raise ValueError("PIC_WORKERS must be at least 1")
+
+        self.backend = file_upload.get_backend()
+        self.executor = None
+        self.thread = None
+        self.running = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+        # Functions called with the pic_id once a picture points to its
+        # processed file, e.g. to drop it from a cache
+        self.on_complete = []
+
+    def start(self, lock_path: str = None) -> None:
+        """
+        Starts the dispatcher thread. Jobs left unfinished by a previous run
+        are picked up again, so they survive restarts.
+
+        With lock_path, only the process holding a lock on that file
+        dispatches jobs, so several processes of the app (see lib/server.py)
+        do not each start PIC_WORKERS workers. The others wait for the lock,
+        and take over if that process goes away
+        """
+        if self.thread and self.thread.is_alive():
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target = self.run,
+            args = (lock_path,),
+            name = "pic-jobs-dispatcher",
+            daemon = True)
+        self.thread.start()
+
+    def run(self, lock_path: str = None) -> None:
+        lock = None
+        if lock_path:
+            lock = self.acquire(lock_path)
+            if lock is None:
+                return
+
+        try:
+            self.executor = self.create_executor()
+            self.dispatch_loop()
+        finally:
+            if lock is not None:
+                os.close(lock)
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        # Workers are started by a fork server, a process of its own with a
+        # single thread. Forking them from here would copy a process full of
+        # threads (waitress, the dispatcher, the writer of the logs), along
+        # with any lock one of them held at that moment, and a logging queue
+        # nobody writes in the child
+        return ProcessPoolExecutor(
+            max_workers = self.workers,
+            mp_context = multiprocessing.get_context("forkserver"),
+            initializer = init_worker)
+
+    def acquire(self, lock_path: str):
+        """
+        Waits for the lock, or until we are stopped (then returns None). These
+        are POSIX locks, which belong to the process: the worker processes do
+        not inherit them, and the lock goes away with us
+        """
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        while not self.stopped.is_set():
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                self.stopped.wait(self.POLL_INTERVAL)
+        os.close(fd)
+        return None
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.executor:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+
+    def enqueue(self, pic_id: int) -> None:
+        # If the picture already has a job, there is nothing to do. If the
+        # dispatcher runs in another process, it finds the job on its next
+        # round instead of being woken up
+        self.db.query(INSERT_JOB, (pic_id,) )
+        self.wake.set()
+
+    def status(self, pic_id: int) -> str:
+        """Returns the status of the picture's processing, see client_status"""
+        return client_status(self.db.query(SELECT_JOB_STATUS, (pic_id,) ))
+
+    def dispatch_loop(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                with self.lock:
+                    free = self.workers - len(self.running)
+                if free > 0:
+                    for job in self.claim(free):
+                        self.submit(job)
+            except Exception as err:
+                # Database might be down for a moment. We will try again in
+                # the next round
+                exceptions.printerr(err)
+
+            self.wake.wait(self.POLL_INTERVAL)
+            self.wake.clear()
+
+    def claim(self, limit: int) -> list:
+        # A job is claimed again when its lease expires, which counts as an
+        # attempt. If its worker keeps dying (so fail() never runs), this is
+        # where it stops
+        self.db.query("""
+            UPDATE pic_jobs
+            SET
+                job_status = 'failed',
+                job_error = 'Abandoned too many times (e.g. its worker died).',
+                job_updated = NOW()
+            WHERE
+                job_status = 'processing'
+                AND job_updated < NOW() - %s * INTERVAL '1 second'
+                AND job_attempts >= %s ;
+        """, (self.lease, self.max_attempts) )
+
+        token = secrets.token_hex(8)
+        result = self.db.query("""
+            UPDATE pic_jobs
+            SET
+                job_status = 'processing',
+                job_attempts = pic_jobs.job_attempts + 1,
+                job_token = %s::text,
+                job_updated = NOW()
+            FROM pics
+            WHERE
+                pics.pic_id = pic_jobs.pic_id
+                AND pic_jobs.job_id IN
+                (
+                    SELECT job_id
+                    FROM pic_jobs
+                    WHERE
+                        job_status = 'queued'
+                        OR (job_status = 'processing'
+                            AND job_updated < NOW() - %s * INTERVAL '1 second'
+                            AND job_attempts < %s)
+                    ORDER BY job_id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            RETURNING pic_jobs.job_id, pic_jobs.pic_id, pics.pic_path ;
+        """, (token, self.lease, self.max_attempts, limit) )
+
+        return [Job(job_id, pic_id, pic_path, token) for job_id, pic_id, pic_path in result.rows]
+
+    def submit(self, job: Job) -> None:
+        try:
+            future = self.executor.submit(
+                process_copy,
+                job.pic_path,
+                self.pic_max_size,
+                self.backend,
+                self.variant_widths,
+                self.variant_formats)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer). The job will be
+            # claimed again when the lease expires, and we need a new pool
+            self.executor = self.create_executor()
+            return
+
+        with self.lock:
+            self.running.add(job.job_id)
+        future.add_done_callback(lambda f: self.finish(job, f))
+
+    def finish(self, job: Job, future) -> None:
+        try:
+            try:
+                new_path, variants = future.result()
+            except Exception as err:
+                self.fail(job, err)
+            else:
+                self.complete(job, new_path, variants)
+        except Exception as err:
+            exceptions.printerr(err)
+        finally:
+            with self.lock:
+                self.running.discard(job.job_id)
+            self.wake.set()
+
+    def complete(self, job: Job, new_path: str, variants: list) -> None:
+        with self.db.transaction() as cur:
+            # The picture might have been deleted while we were working,
+            # in which case nothing gets updated
+            cur.execute("""
+                UPDATE pics
+                SET pic_path = %s::text
+                WHERE pic_id = %s::bigint
+                AND pic_path = %s::text
+                RETURNING pic_id ;
+            """, (new_path, job.pic_id, job.pic_path) )
+            updated = cur.rowcount
+
+            if updated:
+                for width, subtype, path, size in variants:
+                    cur.execute("""
+                        INSERT INTO pic_variants
+                        (
+                            pic_id,
+                            var_width,
+                            var_format,
+                            var_path,
+                            var_size
+                        )
+                        VALUES
+                        (
+                            %s::bigint,
+                            %s::int,
+                            %s::text,
+                            %s::text,
+                            %s::bigint
+                        )
+                        ON CONFLICT (pic_id, var_width, var_format) DO UPDATE
+                        SET
+                            var_path = EXCLUDED.var_path,
+                            var_size = EXCLUDED.var_size ;
+                    """, (job.pic_id, width, subtype, path, size) )
+
+            cur.execute("""
+                UPDATE pic_jobs
+                SET
+                    job_status = 'done',
+                    job_error = NULL,
+                    job_updated = NOW()
+                WHERE job_id = %s::bigint
+                AND job_token = %s::text ;
+            """, (job.job_id, job.token) )
+
+        # Only now that the DB points to the new file can we remove the
+        # original
+        if updated:
+            for callback in self.on_complete:
+                callback(job.pic_id)
+            os.remove(job.pic_path)
+        else:
+            file_upload.remove_pic_files([new_path] + [v[2] for v in variants])
+
+    def fail(self, job: Job, err: Exception) -> None:
+        exceptions.printerr(err)
+        self.db.query("""
+            UPDATE pic_jobs
+            SET
+                job_status = CASE
+                    WHEN job_attempts >= %s THEN 'failed'
+                    ELSE 'queued'
+                END,
+                job_error = %s::text,
+                job_updated = NOW()
+            WHERE job_id = %s::bigint
+            AND job_token = %s::text ;
+        """, (self.max_attempts, str(err), job.job_id, job.token) )
@@ -0,0 +1,222 @@
+import atexit, contextvars, datetime as dt, json, logging, logging.handlers, os, queue, re, sys, threading, time
+
+from lib.singleton import Singleton
+
+# Logging used to be print() everywhere, which writes to the terminal while
+# the request waits (and holds the GIL doing so). Now every module logs with
+# the standard logging module, to a logger named after it:
+#
+#     logger = logging.getLogger(__name__)
+#     logger.warning("Something happened", extra = {"prodId": prod_id})
+#
+# The request thread only puts the record in a queue. A background thread
+# formats it (as one JSON object per line, by default) and writes it to
+# stderr. Extra fields end up in the JSON object, along with the id of the
+# request that logged them, so all lines of a request can be found together.
+#
+# Events that can happen on every request (e.g. a hit to the front end) are
+# sampled: records with extra field "sample" (any name for the event) are let
+# through a few times per interval, the rest are counted and dropped.
+
+FORMAT_JSON = "json"
+FORMAT_TEXT = "text"
+
+# Id of the request being handled by this thread, see start_request()
+request_id = contextvars.ContextVar("request_id", default = None)
+
+# Ids sent by a proxy in X-Request-Id are kept, if they look like an id
+REGEX_REQUEST_ID = re.compile(r"^[\w.:-]{1,64}$")
+
+# Attributes every LogRecord has. Anything else was given in extra
+RESERVED = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) \
+    | {"message", "asctime", "request_id"}
+
+def start_request(incoming: str = None) -> str:
+    """Sets the id of the request this thread is about to handle"""
+    value = incoming if incoming and REGEX_REQUEST_ID.match(incoming) \
+        else os.urandom(8).hex()
+    request_id.set(value)
+    return value
+
+def end_request() -> None:
+    request_id.set(None)
+
+def get_extra(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in record.__dict__.items() if key not in RESERVED}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, which log collectors can parse"""
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": dt.datetime.fromtimestamp(record.created, dt.timezone.utc)
+                .isoformat(timespec = "milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.module}:{record.lineno}",
+            "message": record.getMessage()
+        }
+        if getattr(record, "request_id", None):
+            data["requestId"] = record.request_id
+        data.update(get_extra(record))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default = str, ensure_ascii = False)
+
+class TextFormatter(logging.Formatter):
+    """Lines for people, e.g. in development"""
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = [f"{key}={value}" for key, value in get_extra(record).items()]
+        if getattr(record, "request_id", None):
+            fields.insert(0, f"requestId={record.request_id}")
+        if fields:
+            first, newline, rest = text.partition("\n")
+            text = f"{first} [{' '.join(fields)}]{newline}{rest}"
+        return text
+
+class RequestIdFilter(logging.Filter):
+    """Tags records with the id of the current request. Runs in its thread"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        return True
+
+class Sampler(logging.Filter):
+    """
+    Lets through at most burst records of each sampled event every interval
+    seconds. The first record let through after some were dropped says how
+    many, in field "sampledOut"
+    """
+    def __init__(self, burst: int, interval: float):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.lock = threading.Lock()
+        # Event -> [start of the interval, records let through, dropped]
+        self.windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window else 0
+                window = self.windows[key] = [now, 0, 0]
+                if dropped:
+                    record.sampledOut = dropped
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records in the queue and returns. If the queue is full (the writer
+    cannot keep up), records are dropped and counted rather than making the
+    request wait
+    """
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+        self.listener = None
+        self.pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The standard handler formats the message here, in the caller's
+        # thread. The queue never leaves this process, so we leave that to
+        # the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        # Called by logging.shutdown(), e.g. at exit: whatever is left in the
+        # queue is written first. A forked child has no writer thread to stop
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+class Logging (metaclass = Singleton):
+    # Defaults, can be overriden with environment variables LOG_LEVEL,
+    # LOG_FORMAT ("json" or "text"), LOG_QUEUE_SIZE (records waiting to be
+    # written), LOG_SAMPLE_BURST and LOG_SAMPLE_INTERVAL (sampled events let
+    # through per this many seconds)
+    LEVEL = "INFO"
+    FORMAT = FORMAT_JSON
+    QUEUE_SIZE = 10000
+    SAMPLE_BURST = 10
+    SAMPLE_INTERVAL = 60.0
+
+    def __init__(self):
+        self.level = os.getenv("LOG_LEVEL", self.LEVEL).upper()
+        self.format = os.getenv("LOG_FORMAT", self.FORMAT).lower()
+        self.queue_size = int(os.getenv("LOG_QUEUE_SIZE", self.QUEUE_SIZE))
+        self.sampler = Sampler(
+            int(os.getenv("LOG_SAMPLE_BURST", self.SAMPLE_BURST)),
+            float(os.getenv("LOG_SAMPLE_INTERVAL", self.SAMPLE_INTERVAL)))
+
+        self.handler = None
+        self.pid = None
+        atexit.register(self.stop)
+
+    def start(self, stream = None, queued: bool = True) -> None:
+        """
+        Sends all logging through the queue. Called again after a fork, since
+        the writer thread of the parent does not exist in the child.
+
+        Without queued, records are written right away, by the thread that
+        logs them. That is for worker processes (see lib/jobs.py), which exit
+        without running atexit handlers, so whatever was left in the queue
+        would be lost
+        """
+        if self.pid == os.getpid():
+            return
+
+        writer = logging.StreamHandler(stream or sys.stderr)
+        writer.setFormatter(TextFormatter() if self.format == FORMAT_TEXT else JsonFormatter())
+
+        handler = QueueHandler(queue.Queue(self.queue_size)) if queued else writer
+        handler.addFilter(RequestIdFilter())
+        handler.addFilter(self.sampler)
+
+        root = logging.getLogger()
+        if self.handler is not None:
+            root.removeHandler(self.handler)
+        root.addHandler(handler)
+        root.setLevel(self.level)
+
+        self.handler = handler
+        if queued:
+            handler.listener = logging.handlers.QueueListener(handler.queue, writer)
+            handler.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self) -> None:
+        """Writes what is left in the queue"""
+        if self.handler is not None and self.pid == os.getpid():
+            self.handler.close()
+            logging.getLogger().removeHandler(self.handler)
+        self.pid = None
+
+    def queued(self) -> bool:
+        return isinstance(self.handler, QueueHandler)
+
+    def get_stats(self) -> dict:
+        return {
+            "level": self.level,
+            "format": self.format,
+            "queued": self.handler.queue.qsize() if self.queued() else 0,
+            "dropped": self.handler.dropped if self.queued() else 0
+        }
@@ -0,0 +1,88 @@
+import threading, time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+class LRUCache:
+    """
+    A bounded cache, shared by all threads of the process. When full, the
+    least recently used entry is evicted. Entries also expire after ttl
+    seconds (zero means they never expire), which bounds how stale an entry
+    can get if somebody else (e.g. another process) changed the data behind
+    our back.
+    """
+
+    # Returned by get() when the key is not in the cache, so that None can
+    # be cached like any other value
+    MISSING = object()
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0):
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # key -> (value, expiration time)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return self.MISSING
+
+            value, expires = entry
+            if expires and expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return self.MISSING
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxSize": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,402 @@
+import glob, json, os, threading, time
+from typing import Callable
+
+from lib.singleton import Singleton
+from lib.histogram import Histogram, DEFAULT_BUCKETS
+import lib.exceptions as exceptions
+
+# Metrics in the Prometheus text format, served at /metrics (see
+# api/metrics.py).
+#
+# Every process only knows its own numbers. When the app runs as several
+# processes, each of them writes its numbers to a file in METRICS_DIR every few
+# seconds, and whoever gets scraped adds up everybody's. Files of processes
+# that exited (e.g. workers replaced by a reload) are removed, so their
+# numbers go away with them: Prometheus takes a counter that goes down as a
+# reset, as it does when the whole app restarts.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Response sizes, in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f"{name}=\"{escape(value)}\"" for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Family:
+    """All the samples of a metric, by labels (a sorted tuple of pairs)"""
+    def __init__(self, name: str, kind: str, help: str):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.samples = {}
+
+class Collection:
+    """
+    Metrics of one or more processes, which can be merged, stored as JSON
+    and rendered in the Prometheus format
+    """
+    def __init__(self):
+        self.families = {}
+
+    def family(self, name: str, kind: str, help: str) -> Family:
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, kind, help)
+        return family
+
+    def add(self, name: str, kind: str, help: str, value, labels: dict = None) -> None:
+        """Adds value (a number, or a Histogram) to the sample with labels"""
+        family = self.family(name, kind, help)
+        key = tuple(sorted((labels or {}).items()))
+        if kind == HISTOGRAM:
+            if key in family.samples:
+                family.samples[key].merge(value)
+            else:
+                family.samples[key] = value.copy()
+        else:
+            family.samples[key] = family.samples.get(key, 0) + value
+
+    def counter(self, name: str, help: str, value: float, labels: dict = None) -> None:
+        self.add(name, COUNTER, help, value, labels)
+
+    def gauge(self, name: str, help: str, value: float, labels: dict = None) -> None:
+        self.add(name, GAUGE, help, value, labels)
+
+    def histogram(self, name: str, help: str, value: Histogram, labels: dict = None) -> None:
+        self.add(name, HISTOGRAM, help, value, labels)
+
+    def merge(self, other: "Collection", gauges: bool = True) -> None:
+        for family in other.families.values():
+            if family.kind == GAUGE and not gauges:
+                continue
+            for key, value in family.samples.items():
+                self.add(family.name, family.kind, family.help, value, dict(key))
+
+    def to_dict(self) -> dict:
+        result = {}
+        for family in self.families.values():
+            samples = []
+            for key, value in family.samples.items():
+                if family.kind == HISTOGRAM:
+                    value = [value.bounds, value.counts, value.count, value.sum]
+                samples.append([dict(key), value])
+            result[family.name] = [family.kind, family.help, samples]
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Collection":
+        collection = cls()
+        for name, (kind, help, samples) in data.items():
+            for labels, value in samples:
+                if kind == HISTOGRAM:
+                    bounds, counts, count, total = value
+                    value = Histogram(bounds)
+                    value.counts = list(counts)
+                    value.count = count
+                    value.sum = total
+                collection.add(name, kind, help, value, labels)
+        return collection
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for key in sorted(family.samples):
+                value = family.samples[key]
+                if family.kind != HISTOGRAM:
+                    lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                    continue
+                for bound, total in value.cumulative():
+                    le = f"le=\"{format_value(float(bound))}\""
+                    lines.append(f"{name}_bucket{format_labels(key, le)} {total}")
+                lines.append(f"{name}_sum{format_labels(key)} {format_value(value.sum)}")
+                lines.append(f"{name}_count{format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+class RequestMetrics (metaclass = Singleton):
+    """Counters of the requests handled by this process, see Middleware"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.sizes = {}
+        self.in_flight = 0
+        self.in_flight_max = 0
+
+        # Threads of the WSGI server (waitress), each of which handles one
+        # request at a time. Set by whoever starts the server
+        self.threads = 0
+
+    def started(self) -> None:
+        with self.lock:
+            self.in_flight += 1
+            self.in_flight_max = max(self.in_flight_max, self.in_flight)
+
+    def finished(self, method: str, route: str, status: str, elapsed: float, size: int) -> None:
+        with self.lock:
+            self.in_flight -= 1
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            key = (method, route)
+            durations = self.durations.get(key)
+            if durations is None:
+                durations = self.durations[key] = Histogram(DEFAULT_BUCKETS)
+                self.sizes[key] = Histogram(SIZE_BUCKETS)
+            durations.observe(elapsed)
+            self.sizes[key].observe(size)
+
+    def collect(self, collection: Collection) -> None:
+        with self.lock:
+            for (method, route, status), count in self.requests.items():
+                collection.counter(
+                    "michelangelo_http_requests_total",
+                    "Requests handled, by route, method and status.",
+                    count,
+                    {"method": method, "route": route, "status": status})
+            for (method, route), durations in self.durations.items():
+                labels = {"method": method, "route": route}
+                collection.histogram(
+                    "michelangelo_http_request_duration_seconds",
+                    "Time to handle a request, until the last byte was handed to the server.",
+                    durations,
+                    labels)
+                collection.histogram(
+                    "michelangelo_http_response_size_bytes",
+                    "Size of response bodies.",
+                    self.sizes[(method, route)],
+                    labels)
+
+            collection.gauge(
+                "michelangelo_http_requests_in_flight",
+                "Requests being handled right now.",
+                self.in_flight)
+            collection.gauge(
+                "michelangelo_http_requests_in_flight_max",
+                "Most requests handled at once since the process started.",
+                self.in_flight_max)
+            collection.gauge(
+                "michelangelo_server_threads",
+                "Threads of the WSGI server. In-flight requests over threads is their utilization.",
+                self.threads)
+
+class ResponseBody:
+    """
+    Wraps the body returned by the app, counting its bytes as the server
+    sends them. The request is only finished when the server closes the body,
+    so streamed responses (e.g. the export) are timed until the end
+    """
+    def __init__(self, body, finish: Callable[[int], None]):
+        self.body = body
+        self.finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish(self.size)
+
+class Middleware:
+    """
+    WSGI middleware recording every request in RequestMetrics. The route is
+    the URL rule Flask matched (e.g. "/products/<int:id>", so there is one
+    series per route, not per product), stored in the environ by the app
+    """
+    ROUTE_KEY = "michelangelo.route"
+    UNMATCHED = "(unmatched)"
+
+    def __init__(self, wsgi_app, metrics: RequestMetrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ["500"]
+        content_length = [0]
+        self.metrics.started()
+
+        def finish(size: int):
+            self.metrics.finished(
+                environ.get("REQUEST_METHOD", ""),
+                environ.get(self.ROUTE_KEY, self.UNMATCHED),
+                status[0],
+                time.perf_counter() - start,
+                size)
+
+        def record_status(status_line, headers, exc_info = None):
+            status[0] = status_line[:3]
+            for name, value in headers:
+                if name.lower() == "content-length" and value.isdigit():
+                    content_length[0] = int(value)
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except BaseException:
+            finish(0)
+            raise
+
+        # Files are sent by the server in its own efficient way, which
+        # wrapping them would prevent (waitress checks the exact class). Their
+        # size is the Content-Length the app gave, and the request is over
+        # when the server closes the file, once it was sent
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            close = body.close
+            finished = []
+
+            def close_and_finish():
+                try:
+                    close()
+                finally:
+                    # The server might close it more than once
+                    if not finished:
+                        finished.append(True)
+                        finish(content_length[0])
+
+            body.close = close_and_finish
+            return body
+
+        return ResponseBody(body, finish)
+
+class SnapshotWriter (metaclass = Singleton):
+    """
+    Writes the metrics of this process to a file in directory METRICS_DIR
+    every METRICS_INTERVAL seconds, so other processes can add them up. Does
+    nothing if METRICS_DIR is not set (a single process)
+    """
+    INTERVAL = 5.0
+
+    def __init__(self):
+        self.directory = os.getenv("METRICS_DIR") or None
+        self.interval = float(os.getenv("METRICS_INTERVAL", self.INTERVAL))
+        self.collect = None
+        self.thread = None
+        self.pid = None
+        self.stopped = threading.Event()
+
+    def path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"metrics-{pid}.json")
+
+    def start(self, collect: Callable[[], Collection]) -> None:
+        # After a fork, the thread of the parent is gone, and we are another
+        # process with a file of our own
+        if not self.directory:
+            return
+        if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+            return
+
+        os.makedirs(self.directory, exist_ok = True)
+        self.collect = collect
+        self.pid = os.getpid()
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target = self.write_loop,
+            name = "metrics-writer",
+            daemon = True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+    def remove(self, pid: int) -> None:
+        """Forgets the metrics of a process that exited"""
+        if not self.directory:
+            return
+        try:
+            os.remove(self.path(pid))
+        except FileNotFoundError:
+            # Somebody else was faster
+            pass
+
+    def write_loop(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        if not self.directory or self.collect is None:
+            return
+        try:
+            data = {"pid": os.getpid(), "metrics": self.collect().to_dict()}
+            path = self.path(os.getpid())
+            temp = path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(data, f)
+            # Readers never see a half-written file
+            os.replace(temp, path)
+        except Exception as err:
+            exceptions.printerr(err)
+
+    @staticmethod
+    def is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def gather(self, own: Collection) -> Collection:
+        """own (the metrics of this process), plus those of the others"""
+        if not self.directory:
+            return own
+
+        total = Collection()
+        total.merge(own)
+        processes = 1
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data["pid"] == os.getpid():
+                continue
+
+            # The server removes files of workers it reaps, but not every
+            # server does (e.g. uvicorn), nor do workers that were killed
+            # while it was not looking
+            if not self.is_alive(data["pid"]):
+                self.remove(data["pid"])
+                continue
+
+            processes += 1
+            total.merge(Collection.from_dict(data["metrics"]))
+
+        total.gauge(
+            "michelangelo_processes",
+            "Processes of the app whose metrics are included.",
+            processes)
+        return total
@@ -0,0 +1,53 @@
+import base64, json
+from typing import List
+
+import lib.exceptions as exceptions
+
+# Maximum number of rows a client can ask for in a single page
+MAX_LIMIT = 100
+
+def encode_cursor(keys: List) -> str:
+    """
+    Returns an opaque token representing the position after the last row of
+    a page. keys are the values of the columns we sort by, for that row (the
+    last one is always the primary key, to break ties)
+    """
+    # The cursor does not need to be secret, only opaque, so clients do not
+    # start relying on its format. Base64 of compact JSON does the trick, and
+    # the URL-safe alphabet saves us from escaping it in query strings
+    raw = json.dumps(keys, separators = (",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(token: str) -> List:
+    """
+    Inverse of encode_cursor. Raises BadRequest if the token was tampered with
+    """
+    try:
+        padding = "=" * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(token + padding)
+        keys = json.loads(raw.decode("utf-8"))
+    except (ValueError, TypeError) as err:
+        raise exceptions.BadRequest("Invalid cursor.") from err
+
+    if type(keys) != list or len(keys) == 0:
+        raise exceptions.BadRequest("Invalid cursor.")
+
+    return keys
+
+def parse_limit(value: str, default: int) -> int:
+    """
+    Parses the "limit" query parameter. Raises BadRequest if it is not an
+    integer between 1 and MAX_LIMIT
+    """
+    if value is None:
+        return default
+
+    try:
+        limit = int(value)
+    except ValueError as err:
+        raise exceptions.BadRequest("Invalid limit.") from err
+
+    if limit < 1 or limit > MAX_LIMIT:
+        raise exceptions.BadRequest("Invalid limit.")
+
+    return limit
@@ -0,0 +1,230 @@
+import io, os
+from typing import List, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import lib.pic_utils as pic_utils
+
+# In-process counterpart of the functions in pic_utils. The subprocess version
+# launches "file", "exiftool" (twice) and "convert" (twice) for every picture,
+# and rewrites the file on disk after each step. Here, the picture is decoded
+# only once, every step happens in memory, and the final file is written once.
+
+# Pillow format name -> mime subtype (the same "file --mime-type" would give)
+SUBTYPES = {
+    "JPEG": "jpeg",
+    "PNG": "png",
+    "GIF": "gif",
+    "WEBP": "webp",
+    "BMP": "bmp",
+    "TIFF": "tiff",
+    "AVIF": "avif"
+}
+
+JPEG_QUALITY = 85
+
+# Variants are small and meant for slow connections, so we can afford a
+# slightly lower quality
+VARIANT_QUALITY = 75
+
+EXIF_ORIENTATION = 0x0112
+
+def sniff(path: str) -> Tuple[str, str]:
+    """
+    Returns (type, subtype), like file_utils.get_mime_type, but only reads the
+    header of the file. Raises an exception if it is not a picture we support
+    """
+    try:
+        with Image.open(path) as img:
+            fmt = img.format
+    except (UnidentifiedImageError, OSError):
+        raise Exception("File is not a picture")
+
+    if fmt not in SUBTYPES:
+        raise Exception("Picture format is not supported")
+
+    return "image", SUBTYPES[fmt]
+
+def is_picture(path: str) -> bool:
+    try:
+        sniff(path)
+        return True
+    except Exception:
+        return False
+
+def get_pic_resolution(path: str) -> Tuple[int, int]:
+    with Image.open(path) as img:
+        return img.size
+
+def encode(img: Image.Image, fmt: str, **kwargs) -> bytes:
+    """
+    Encodes picture to the given format. Metadata (EXIF, XMP, ICC profiles,
+    comments) is only written by Pillow if explicitly asked for, and we never
+    ask, so this also strips the picture
+    """
+    buffer = io.BytesIO()
+
+    if fmt == "JPEG":
+        if img.mode not in ("RGB", "L"):
+            img = flatten(img)
+            # "keep" reuses the tables of the JPEG file the picture was
+            # decoded from, which a flattened copy does not have
+            kwargs = {key: value for key, value in kwargs.items() if value != "keep"}
+        kwargs.setdefault("quality", JPEG_QUALITY)
+        kwargs.setdefault("optimize", True)
+    elif fmt == "PNG":
+        kwargs.setdefault("optimize", True)
+    elif fmt == "WEBP":
+        kwargs.setdefault("method", 4)
+
+    img.save(buffer, format = fmt, **kwargs)
+    return buffer.getvalue()
+
+def flatten(img: Image.Image) -> Image.Image:
+    # JPEG has no transparency. Transparent pixels become white, which is
+    # also what ImageMagick does
+    img = img.convert("RGBA")
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask = img.getchannel("A"))
+    return background
+
+def process(
+        path: str,
+        max_size: int = 600,
+        new_type: str = "jpeg",
+        print_stats: bool = False) -> str:
+    """
+    Strips metadata, resizes so that the biggest dimension is at most max_size,
+    and converts to new_type if that results in a smaller file. Original file
+    is replaced by the result, which is named with the proper extension.
+
+    Returns the path to the new file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        fmt = img.format
+        img.load()
+    except (UnidentifiedImageError, OSError):
+        raise Exception("Cannot process file, it is not a picture")
+
+    if fmt not in SUBTYPES:
+        raise Exception("Picture format is not supported")
+
+    candidates = []
+
+    if getattr(img, "is_animated", False):
+        # Resizing or converting would throw away every frame but the first,
+        # so animated pictures are only stripped
+        candidates.append( (fmt, encode(img, fmt, save_all = True)) )
+
+    else:
+        # Once we strip metadata, the orientation tag is gone, so we need to
+        # apply it to the pixels or the picture would show up rotated
+        resized = img
+        if img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            resized = ImageOps.exif_transpose(img)
+
+        proportion = pic_utils.calculate_proportion(resized.size, max_size)
+        if proportion < 100:
+            width, height = resized.size
+            new_size = (
+                max(1, width * proportion // 100),
+                max(1, height * proportion // 100)
+            )
+            resized = resized.resize(new_size, Image.LANCZOS)
+
+        if resized is img and fmt == "JPEG":
+            # Nothing was changed in the pixels, so we can reuse the original
+            # quantization tables and avoid losing quality by re-encoding
+            # (unless encode has to flatten it, e.g. a CMYK picture)
+            candidates.append( (fmt, encode(img, fmt, quality = "keep", subsampling = "keep")) )
+        else:
+            candidates.append( (fmt, encode(resized, fmt)) )
+
+        new_fmt = new_type.upper()
+        if new_fmt != fmt:
+            candidates.append( (new_fmt, encode(resized, new_fmt)) )
+
+    best_fmt, best_data = min(candidates, key = lambda c: len(c[1]))
+
+    if print_stats:
+        for fmt, encoded in candidates:
+            print(f"{fmt}: {len(encoded)} bytes")
+        print(f"Original: {len(data)} bytes, kept {best_fmt} ({len(best_data)} bytes)")
+
+    subtype = SUBTYPES.get(best_fmt, best_fmt.lower())
+    new_path = path if path.lower().endswith(f".{subtype}") else f"{path}.{subtype}"
+
+    with open(new_path, "wb") as f:
+        f.write(best_data)
+
+    if new_path != path:
+        os.remove(path)
+
+    return new_path
+
+def can_encode(subtype: str) -> bool:
+    """Tells whether this Pillow build can write the given format"""
+    Image.init()
+    return subtype.upper() in Image.SAVE
+
+def make_variants(
+        path: str,
+        widths: List[int],
+        subtypes: List[str]) -> List[Tuple[int, str, str, int]]:
+    """
+    Creates smaller versions of a (processed) picture, one for each
+    combination of width and format, next to the original. Widths larger
+    than the picture itself are skipped, we never upscale.
+
+    Returns a list of (width, subtype, path, size in bytes)
+    """
+    variants = []
+    base, _ = os.path.splitext(path)
+
+    try:
+        with Image.open(path) as img:
+            if getattr(img, "is_animated", False):
+                return variants
+
+            img.load()
+            write_variants(img, base, widths, subtypes, variants)
+
+    except Exception:
+        # We do not want half of the variants lying around
+        for _, _, variant_path, _ in variants:
+            os.remove(variant_path)
+        raise
+
+    return variants
+
+def write_variants(
+        img: Image.Image,
+        base: str,
+        widths: List[int],
+        subtypes: List[str],
+        variants: list) -> None:
+    # Appends to variants as files are written, so that make_variants knows
+    # what to clean up if we fail halfway
+    width, height = img.size
+
+    for new_width in sorted(widths):
+        if new_width >= width:
+            break
+
+        new_height = max(1, round(height * new_width / width))
+        resized = img.resize((new_width, new_height), Image.LANCZOS)
+
+        for subtype in subtypes:
+            if not can_encode(subtype):
+                continue
+
+            data = encode(resized, subtype.upper(), quality = VARIANT_QUALITY)
+            variant_path = f"{base}-{new_width}.{subtype}"
+            with open(variant_path, "wb") as f:
+                f.write(data)
+
+            variants.append( (new_width, subtype, variant_path, len(data)) )
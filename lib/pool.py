@@ -0,0 +1,212 @@
+import threading, time
+from typing import Callable, Optional
+
+import lib.exceptions as exceptions
+from lib.histogram import Histogram
+
+class PoolTimeout(exceptions.InternalServerError):
+    """Raised when no connection could be checked out within the timeout"""
+    name = "Service unavailable"
+    code = 503
+
+class PoolStats:
+    """Counters kept by the pool, so we can size it under load"""
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.discarded = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.wait_times = Histogram()
+
+class ConnectionPool:
+    """
+    A bounded pool of connections that can be shared by many threads.
+
+    The pool is generic on purpose: it does not know anything about psycopg2.
+    It receives a function that creates a new connection, a function that
+    tells whether a connection is still usable, and a function that closes it.
+    That way, it can be tested without a running database.
+
+    Connections are handed out in LIFO order. The most recently used connection
+    is the one most likely to still be alive (and warm), and connections at the
+    bottom of the stack are the ones we can afford to lose.
+    """
+
+    def __init__(self,
+                connect: Callable,
+                min_size: int = 1,
+                max_size: int = 10,
+                timeout: float = 5.0,
+                is_healthy: Optional[Callable] = None,
+                close: Optional[Callable] = None,
+                health_check_interval: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size!")
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.is_healthy = is_healthy or (lambda conn: True)
+        self.close_conn = close or (lambda conn: conn.close())
+
+        # Checking the health of a connection usually costs a round trip to
+        # the server. If the connection was returned to the pool just now,
+        # we will trust it is fine
+        self.health_check_interval = health_check_interval
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+        # Stack of (connection, time it was returned to the pool)
+        self.idle = []
+        self.in_use = 0
+        self.waiting = 0
+        self.stats = PoolStats()
+        self.closed = False
+
+        for _ in range(self.min_size):
+            self.idle.append( (self.connect(), time.monotonic()) )
+
+    def size(self) -> int:
+        return len(self.idle) + self.in_use
+
+    def getconn(self, timeout: Optional[float] = None):
+        """
+        Returns a healthy connection, creating a new one if the pool has not
+        reached its maximum size. Raises PoolTimeout if we had to wait for
+        longer than timeout seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        with self.lock:
+            if self.closed:
+                raise exceptions.InternalServerError("Pool is closed.")
+
+            self.waiting += 1
+            try:
+                while not self.idle and self.in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats.timeouts += 1
+                        raise PoolTimeout("Timed out waiting for a connection.")
+                    self.available.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            # We reserve the slot while still holding the lock. Connecting
+            # and checking health happen outside the lock, as they might
+            # take a while
+            entry = self.idle.pop() if self.idle else None
+            self.in_use += 1
+
+            waited = time.monotonic() - start
+            self.stats.checkouts += 1
+            self.stats.wait_time_total += waited
+            self.stats.wait_time_max = max(self.stats.wait_time_max, waited)
+            self.stats.wait_times.observe(waited)
+
+        try:
+            if entry is None:
+                return self.connect()
+
+            conn, returned_at = entry
+            if time.monotonic() - returned_at < self.health_check_interval \
+                    or self.is_healthy(conn):
+                return conn
+
+            # Connection was dropped (server restart, idle timeout in a
+            # firewall, etc). Let's replace it by a new one
+            self._close_quietly(conn)
+            with self.lock:
+                self.stats.reconnects += 1
+            return self.connect()
+
+        except Exception:
+            # We could not give a connection, so the slot is free again
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """
+        Returns a connection to the pool. If discard is True, or the
+        connection is not usable anymore, it will be closed instead
+        """
+        if discard:
+            self._close_quietly(conn)
+            with self.lock:
+                self.stats.discarded += 1
+            self._release_slot()
+            return
+
+        with self.lock:
+            self.in_use -= 1
+            if self.closed:
+                close_it = True
+            else:
+                close_it = False
+                self.idle.append( (conn, time.monotonic()) )
+            self.available.notify()
+
+        if close_it:
+            self._close_quietly(conn)
+
+    def reset(self) -> None:
+        """
+        Forgets every connection without closing them. This is meant to be
+        used in a child process after fork, as the sockets belong to the
+        parent and closing them here would also break the parent's
+        connections
+        """
+        with self.lock:
+            self.idle = []
+            self.in_use = 0
+            self.stats = PoolStats()
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.available.notify_all()
+
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            checkouts = self.stats.checkouts
+            return {
+                "minSize": self.min_size,
+                "maxSize": self.max_size,
+                "inUse": self.in_use,
+                "idle": len(self.idle),
+                "waiting": self.waiting,
+                "checkouts": checkouts,
+                "timeouts": self.stats.timeouts,
+                "reconnects": self.stats.reconnects,
+                "discarded": self.stats.discarded,
+                "waitTimeTotal": self.stats.wait_time_total,
+                "waitTimeMax": self.stats.wait_time_max,
+                "waitTimeAvg": self.stats.wait_time_total / checkouts if checkouts else 0.0,
+                "waitTimes": self.stats.wait_times.as_dict()
+            }
+
+    def get_wait_times(self) -> Histogram:
+        with self.lock:
+            return self.stats.wait_times.copy()
+
+    def _release_slot(self) -> None:
+        with self.lock:
+            self.in_use -= 1
+            self.available.notify()
+
+    def _close_quietly(self, conn) -> None:
+        try:
+            self.close_conn(conn)
+        except Exception:
+            pass
@@ -0,0 +1,164 @@
+import datetime as dt
+from typing import Mapping, Tuple
+
+import lib.exceptions as exceptions
+import lib.pagination as pagination
+
+# Filters and sort order of a list of products, as given in the query string
+# of GET /products (and /products/export, /products/count):
+#
+#   min_price, max_price    in cents, like prod_price
+#   in_stock=1              only products in stock
+#   created_after           ISO 8601 date or date and time
+#   sort                    id (default), price, created or name
+#   order                   asc (default) or desc
+#
+# This only builds SQL, it does not know about Flask or the database, so it
+# can be used from anywhere (and tested on its own).
+
+# What clients can sort by -> column. Column names come from here and never
+# from the request, so they can be safely formatted into the SQL
+SORT_COLUMNS = {
+    "id": "prod_id",
+    "price": "prod_price",
+    "created": "prod_created",
+    "name": "prod_name"
+}
+
+ORDERS = ["asc", "desc"]
+
+def parse_int(args: Mapping, name: str) -> int:
+    if name not in args:
+        return None
+    try:
+        value = int(args[name])
+    except (TypeError, ValueError) as err:
+        raise exceptions.BadRequest(f"Parameter {name} must be an integer.") from err
+    if value < 0:
+        raise exceptions.BadRequest(f"Parameter {name} must not be negative.")
+    return value
+
+class ProductQuery:
+    """
+    Parses the filters and sort order from args (e.g. request.args) and
+    builds the corresponding SQL. Raises BadRequest if something is invalid
+    """
+    def __init__(self, args: Mapping):
+        self.min_price = parse_int(args, "min_price")
+        self.max_price = parse_int(args, "max_price")
+
+        in_stock = args.get("in_stock")
+        if in_stock not in (None, "", "0", "1", "false", "true"):
+            raise exceptions.BadRequest("Parameter in_stock must be 0 or 1.")
+        self.in_stock = in_stock in ("1", "true")
+
+        self.created_after = None
+        if args.get("created_after"):
+            try:
+                self.created_after = dt.datetime.fromisoformat(args["created_after"])
+            except ValueError as err:
+                raise exceptions.BadRequest("Parameter created_after must be a date.") from err
+
+        self.sort = args.get("sort", "id")
+        self.order = args.get("order", "asc").lower()
+        if self.sort not in SORT_COLUMNS or self.order not in ORDERS:
+            raise exceptions.BadRequest("Invalid sort order.")
+        self.column = SORT_COLUMNS[self.sort]
+
+        # Position after which the page starts (keyset pagination). With the
+        # default sort, it is just a prod_id, and can also be given directly
+        # as "after"
+        self.after = None
+        if "cursor" in args:
+            self.after = self.parse_keys(pagination.decode_cursor(args["cursor"]))
+        elif "after" in args:
+            if self.sort != "id":
+                raise exceptions.BadRequest("Use cursor instead of after.")
+            self.after = [parse_int(args, "after")]
+
+    def parse_keys(self, keys: list) -> list:
+        # A cursor from another sort order would make us compare apples and
+        # oranges, so we check the types of what we got
+        expected = 1 if self.sort == "id" else 2
+        if len(keys) != expected or type(keys[-1]) != int:
+            raise exceptions.BadRequest("Invalid cursor.")
+
+        if self.sort == "price" and type(keys[0]) != int:
+            raise exceptions.BadRequest("Invalid cursor.")
+        if self.sort == "name" and type(keys[0]) != str:
+            raise exceptions.BadRequest("Invalid cursor.")
+        if self.sort == "created":
+            try:
+                keys[0] = dt.datetime.fromisoformat(keys[0])
+            except (TypeError, ValueError) as err:
+                raise exceptions.BadRequest("Invalid cursor.") from err
+
+        return keys
+
+    def where(self, keyset: bool = True) -> Tuple[str, tuple]:
+        """
+        Returns the WHERE clause (possibly empty) and its arguments. If
+        keyset is False, the position of the cursor is ignored (e.g. for
+        counting, or for pagination with OFFSET)
+        """
+        conditions = []
+        args = ()
+
+        if self.min_price is not None:
+            conditions.append("prod_price >= %s::bigint")
+            args += (self.min_price,)
+        if self.max_price is not None:
+            conditions.append("prod_price <= %s::bigint")
+            args += (self.max_price,)
+        if self.in_stock:
+            conditions.append("prod_instock > 0")
+        if self.created_after is not None:
+            conditions.append("prod_created > %s::timestamp")
+            args += (self.created_after,)
+
+        if keyset and self.after is not None:
+            # Rows are sorted by (column, prod_id), prod_id breaking ties, and
+            # a row comparison lets Postgres seek right into the index
+            operator = ">" if self.order == "asc" else "<"
+            if self.sort == "id":
+                conditions.append(f"prod_id {operator} %s::bigint")
+            else:
+                conditions.append(f"({self.column}, prod_id) {operator} (%s, %s::bigint)")
+            args += tuple(self.after)
+
+        if not conditions:
+            return "", args
+        return "WHERE " + " AND ".join(conditions), args
+
+    def order_by(self) -> str:
+        if self.sort == "id":
+            return f"ORDER BY prod_id {self.order.upper()}"
+        return f"ORDER BY {self.column} {self.order.upper()}, prod_id {self.order.upper()}"
+
+    def select(self, columns: str, limit: int = None, offset: int = None) -> Tuple[str, tuple]:
+        """Returns the whole SELECT statement, and its arguments"""
+        where, args = self.where(keyset = offset is None)
+        query = f"""
+            SELECT {columns}
+            FROM products
+            {where}
+            {self.order_by()}"""
+
+        if offset is not None:
+            query += "\nOFFSET %s"
+            args += (offset,)
+        if limit is not None:
+            query += "\nLIMIT %s"
+            args += (limit,)
+
+        return query + " ;", args
+
+    def next_cursor(self, row: dict) -> str:
+        """Cursor pointing right after row, which is the last of a page"""
+        if self.sort == "id":
+            return pagination.encode_cursor([row["prod_id"]])
+
+        value = row[self.column]
+        if isinstance(value, dt.datetime):
+            value = value.isoformat()
+        return pagination.encode_cursor([value, row["prod_id"]])
@@ -0,0 +1,398 @@
+import csv, json, os, shutil
+from typing import Iterable, Iterator, List, Tuple
+
+import lib.exceptions as exceptions
+import lib.file_upload as file_upload
+import lib.file_utils as file_utils
+import lib.validation as validation
+
+# Bulk import of products from a CSV or NDJSON file, used by the command line
+# (scripts/import_products.py) and by POST /admin/products/import.
+#
+# Inserting products one by one (through the API, as scripts/populate_db.py
+# does) costs a round trip and a transaction for every product. Here, rows are
+# validated as they are read, streamed into a temporary table with COPY, and
+# merged into the real tables with a handful of statements, all in a single
+# transaction: either the whole file is imported, or nothing is.
+#
+# Columns (CSV header) or keys (NDJSON) are the same as in POST /products:
+# prodName, prodPrice, prodInStock, prodDescr and md5 (of a picture already
+# uploaded). There is also "picture", a file name inside the pictures
+# directory, if one was given.
+
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+FORMATS = [FORMAT_CSV, FORMAT_NDJSON]
+
+# We do not want a report with a million errors
+MAX_ERRORS = 100
+
+# Size of the chunks sent to Postgres during COPY
+COPY_BUFFER_SIZE = 64 * 1024
+
+def detect_format(filename: str) -> str:
+    _, extension = os.path.splitext(filename.lower())
+    if extension == ".csv":
+        return FORMAT_CSV
+    if extension in (".ndjson", ".jsonl"):
+        return FORMAT_NDJSON
+    return None
+
+class ImportReport:
+    """What happened during an import, to be shown to the user"""
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.rejected = 0
+        self.pictures_added = 0
+        self.errors = []
+
+    def add_error(self, line: int, message: str) -> None:
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append( (line, message) )
+
+    def as_dict(self) -> dict:
+        return {
+            "read": self.read,
+            "imported": self.imported,
+            "rejected": self.rejected,
+            "picturesAdded": self.pictures_added,
+            "errors": [{"line": line, "message": message}
+                for line, message in self.errors]
+        }
+
+class PictureDir:
+    """
+    Pictures referenced by an import, found in a local directory. Every file
+    is hashed only once, no matter how many products use it, and files with
+    the same content (MD5 hash) are copied to the uploads folder only once,
+    and only if the picture is not in the database yet
+    """
+    def __init__(self, directory: str, upload_folder: str, backend: str = None):
+        self.directory = os.path.realpath(directory)
+        self.upload_folder = upload_folder
+        self.backend = backend
+
+        # file name -> MD5 hash
+        self.by_name = {}
+
+        # MD5 hash -> (path, mime subtype)
+        self.files = {}
+
+    def add(self, name: str) -> str:
+        """
+        Returns the MD5 hash of the picture. Raises BadRequest if it is not a
+        picture we can accept
+        """
+        if name in self.by_name:
+            return self.by_name[name]
+
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if os.path.dirname(path) != self.directory and \
+                not path.startswith(self.directory + os.sep):
+            raise exceptions.BadRequest(f"Picture {name} is outside of the pictures directory.")
+        if not os.path.isfile(path):
+            raise exceptions.BadRequest(f"Picture {name} does not exist.")
+        if os.path.getsize(path) > file_upload.FILE_MAX_SIZE:
+            raise exceptions.BadRequest(f"Picture {name} is too large.")
+
+        subtype = file_upload.get_pic_subtype(path, self.backend)
+        if subtype is None:
+            raise exceptions.BadRequest(f"File {name} is not a picture.")
+
+        pic_md5 = file_utils.get_md5_hash(path)
+        self.by_name[name] = pic_md5
+        self.files.setdefault(pic_md5, (path, subtype))
+        return pic_md5
+
+    def copy_missing(self, existing: set) -> List[Tuple[str, str]]:
+        """
+        Copies pictures not in existing (a set of MD5 hashes) to the uploads
+        folder. Returns a list of (MD5 hash, new path)
+        """
+        copied = []
+        try:
+            for pic_md5, (path, subtype) in self.files.items():
+                if pic_md5 in existing:
+                    continue
+                new_path = os.path.join(
+                    self.upload_folder,
+                    f"{file_utils.get_new_name()}.{subtype}")
+                shutil.copyfile(path, new_path)
+                copied.append( (pic_md5, new_path) )
+        except Exception:
+            file_upload.remove_pic_files([path for _, path in copied])
+            raise
+
+        return copied
+
+def read_rows(lines: Iterable[str], fmt: str) -> Iterator[Tuple[int, dict]]:
+    """
+    Yields (line number, row) for every row in lines, which can be an open
+    file or any iterable of strings. Rows that cannot be parsed are yielded
+    as None, so the caller can report them
+    """
+    if fmt == FORMAT_CSV:
+        reader = csv.DictReader(lines)
+        for row in reader:
+            # In CSV, there is no difference between a missing value and an
+            # empty one, and the API expects optional fields to be missing
+            yield reader.line_num, {key: value for key, value in row.items()
+                if key is not None and value != ""}
+
+    elif fmt == FORMAT_NDJSON:
+        for line_num, line in enumerate(lines, start = 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_num, row if isinstance(row, dict) else None
+
+    else:
+        raise exceptions.BadRequest(f"Format must be one of {', '.join(FORMATS)}.")
+
+def validated_rows(
+        lines: Iterable[str],
+        fmt: str,
+        report: ImportReport,
+        pictures: PictureDir = None) -> Iterator[tuple]:
+    """
+    Yields (line, prod_name, prod_descr, pic_md5, prod_price, prod_instock)
+    for every valid row, in the order of the columns of the staging table.
+    Invalid rows are counted in the report and skipped
+    """
+    for line, row in read_rows(lines, fmt):
+        report.read += 1
+        if row is None:
+            report.add_error(line, "Row could not be parsed.")
+            continue
+
+        try:
+            prod_name, prod_descr, prod_price, prod_instock, pic_md5 = \
+                validation.validate_product_fields(row)
+
+            picture = row.get("picture")
+            if picture:
+                if pic_md5:
+                    raise exceptions.BadRequest("Give either md5 or picture, not both.")
+                if pictures is None:
+                    raise exceptions.BadRequest("No pictures directory was given.")
+                pic_md5 = pictures.add(picture)
+
+        except exceptions.BadRequest as err:
+            report.add_error(line, str(err) or exceptions.BadRequest.name)
+            continue
+
+        yield line, prod_name, prod_descr, pic_md5, prod_price, prod_instock
+
+def copy_value(value) -> str:
+    # Text format of COPY: NULL is \N, and backslashes, tabs and line breaks
+    # must be escaped
+    if value is None:
+        return "\\N"
+    return str(value) \
+        .replace("\\", "\\\\") \
+        .replace("\t", "\\t") \
+        .replace("\n", "\\n") \
+        .replace("\r", "\\r")
+
+class CopyStream:
+    """
+    File-like object that psycopg2's copy_expert can read from. Rows are
+    only pulled from the iterator (and thus read and validated) as Postgres
+    asks for more, so the file is never entirely in memory
+    """
+    def __init__(self, rows: Iterable[tuple]):
+        self.rows = iter(rows)
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.buffer += "\t".join(copy_value(value) for value in row) + "\n"
+
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    readline = read
+
+def import_products(
+        db,
+        lines: Iterable[str],
+        fmt: str,
+        pictures_dir: str = None,
+        upload_folder: str = "uploads",
+        backend: str = None) -> ImportReport:
+    """
+    Imports products from lines (an open file, or any iterable of strings) in
+    format fmt ("csv" or "ndjson"). If pictures_dir is given, column
+    "picture" refers to files in it. Returns an ImportReport.
+
+    New pictures are added to the processing queue, and will be processed by
+    the server (the command line import does not wait for it).
+    """
+    report = ImportReport()
+    pictures = PictureDir(pictures_dir, upload_folder, backend) if pictures_dir else None
+    copied = []
+
+    try:
+        with db.transaction() as cur:
+            cur.execute("""
+                CREATE TEMPORARY TABLE import_products
+                (
+                    line            BIGINT,
+                    prod_name       TEXT,
+                    prod_descr      TEXT,
+                    pic_md5         TEXT,
+                    prod_price      BIGINT,
+                    prod_instock    BIGINT
+                )
+                ON COMMIT DROP ;
+
+                CREATE TEMPORARY TABLE import_pics
+                (
+                    pic_md5         TEXT,
+                    pic_path        TEXT
+                )
+                ON COMMIT DROP ;
+            """)
+
+            cur.copy_expert(
+                "COPY import_products FROM STDIN",
+                CopyStream(validated_rows(lines, fmt, report, pictures)),
+                size = COPY_BUFFER_SIZE)
+
+            # Temporary tables are never analyzed automatically, and without
+            # statistics the planner assumes they are tiny
+            cur.execute("ANALYZE import_products ;")
+
+            if pictures and pictures.files:
+                cur.execute("""
+                    SELECT pic_md5
+                    FROM pics
+                    WHERE pic_md5 = ANY(%s::text[]) ;
+                """, (list(pictures.files),) )
+                existing = {row[0] for row in cur.fetchall()}
+
+                copied = pictures.copy_missing(existing)
+                cur.copy_expert(
+                    "COPY import_pics FROM STDIN",
+                    CopyStream(copied),
+                    size = COPY_BUFFER_SIZE)
+
+            # Every product is one more reference to its picture. Pictures we
+            # already had get their count increased, new ones are inserted
+            # with the right count and a processing job. If somebody uploaded
+            # the same picture in the meantime, ON CONFLICT takes care of it,
+            # and our copy is not new (xmax is only 0 for inserted rows)
+            cur.execute("""
+                WITH counts AS
+                (
+                    SELECT pic_md5, COUNT(*) AS n
+                    FROM import_products
+                    WHERE pic_md5 IS NOT NULL
+                    GROUP BY pic_md5
+                ),
+                updated AS
+                (
+                    UPDATE pics
+                    SET pic_ref_count = pics.pic_ref_count + counts.n
+                    FROM counts
+                    WHERE pics.pic_md5 = counts.pic_md5
+                    RETURNING pics.pic_md5
+                ),
+                inserted AS
+                (
+                    INSERT INTO pics
+                    (
+                        pic_md5,
+                        pic_path,
+                        pic_ref_count
+                    )
+                    SELECT
+                        import_pics.pic_md5,
+                        import_pics.pic_path,
+                        counts.n
+                    FROM import_pics
+                    JOIN counts
+                    ON counts.pic_md5 = import_pics.pic_md5
+                    WHERE import_pics.pic_md5 NOT IN (SELECT pic_md5 FROM updated)
+                    ON CONFLICT (pic_md5) DO UPDATE
+                    SET pic_ref_count = pics.pic_ref_count + EXCLUDED.pic_ref_count
+                    RETURNING pic_id, pic_md5, (xmax = 0) AS is_new
+                ),
+                jobs AS
+                (
+                    INSERT INTO pic_jobs (pic_id)
+                    SELECT pic_id
+                    FROM inserted
+                    WHERE is_new
+                    ON CONFLICT (pic_id) DO NOTHING
+                )
+                SELECT pic_md5
+                FROM inserted
+                WHERE is_new ;
+            """)
+            new_pics = {row[0] for row in cur.fetchall()}
+
+            # Rows referring to a picture we do not have are rejected, as in
+            # POST /products
+            cur.execute("""
+                SELECT line
+                FROM import_products
+                WHERE
+                    pic_md5 IS NOT NULL
+                    AND NOT EXISTS
+                    (
+                        SELECT
+                        FROM pics
+                        WHERE pics.pic_md5 = import_products.pic_md5
+                    )
+                ORDER BY line ;
+            """)
+            for (line,) in cur.fetchall():
+                report.add_error(line, "Picture does not exist.")
+
+            cur.execute("""
+                INSERT INTO products
+                (
+                    prod_name,
+                    prod_descr,
+                    pic_id,
+                    prod_price,
+                    prod_instock
+                )
+                SELECT
+                    import_products.prod_name,
+                    import_products.prod_descr,
+                    pics.pic_id,
+                    import_products.prod_price,
+                    import_products.prod_instock
+                FROM import_products
+                LEFT JOIN pics
+                ON pics.pic_md5 = import_products.pic_md5
+                WHERE
+                    import_products.pic_md5 IS NULL
+                    OR pics.pic_id IS NOT NULL
+                ORDER BY import_products.line ;
+            """)
+            report.imported = cur.rowcount
+
+    except Exception:
+        file_upload.remove_pic_files([path for _, path in copied])
+        raise
+
+    # Copies that lost the race against a concurrent upload are not needed
+    file_upload.remove_pic_files(
+        [path for pic_md5, path in copied if pic_md5 not in new_pics])
+    report.pictures_added = len(new_pics)
+
+    return report
@@ -0,0 +1,176 @@
+import logging, os, re, threading, time
+import datetime as dt
+
+from lib.singleton import Singleton
+from lib.histogram import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Which statements take the time of the database? Every statement run by a
+# cursor of ours (see Cursor in lib/db.py) is timed and counted here, under
+# its name if it comes from the statement registry, or its text otherwise
+# (which only has placeholders, not values, so it does not vary much).
+#
+# Statements slower than a threshold are also logged, with their values and
+# plan, so we can tell why.
+
+REGEX_EXECUTE = re.compile(r"^EXECUTE\s+(\w+)", re.IGNORECASE)
+REGEX_PREPARE = re.compile(r"^PREPARE\s+(\w+)", re.IGNORECASE)
+REGEX_SPACES = re.compile(r"\s+")
+
+# Only these can be explained without side effects (EXPLAIN without ANALYZE
+# does not run anything)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "EXECUTE")
+
+# Statements whose text is longer than this are kept under its beginning
+MAX_KEY_LENGTH = 200
+
+# Statements built with values formatted into the text (which we should not
+# do, but still) would have a key each. Past this many, they are all counted
+# as one
+OTHER = "(other)"
+
+# Text of a statement -> its key. The same few texts come again and again,
+# so we only work the key out once for each
+KEYS = {}
+MAX_KEYS = 2000
+
+def get_key(query) -> str:
+    key = KEYS.get(query)
+    if key is None:
+        key = make_key(query)
+        if len(KEYS) < MAX_KEYS:
+            KEYS[query] = key
+    return key
+
+def make_key(query) -> str:
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    query = str(query).strip()
+
+    match = REGEX_EXECUTE.search(query)
+    if match:
+        return match.group(1)
+
+    # Preparing is counted apart from executing
+    match = REGEX_PREPARE.search(query)
+    if match:
+        return f"{match.group(1)} (prepare)"
+
+    return REGEX_SPACES.sub(" ", query)[:MAX_KEY_LENGTH]
+
+class StatementStats:
+    """Basically a struct of counters for a single statement"""
+    __slots__ = ("calls", "errors", "rows", "times", "last_explained")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.times = Histogram()
+        self.last_explained = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "time": self.times.as_dict()
+        }
+
+class QueryStats (metaclass = Singleton):
+    # Defaults, can be overriden with environment variables QUERY_STATS (0 to
+    # disable), SLOW_QUERY_MS (0 to disable the slow query log) and
+    # SLOW_QUERY_INTERVAL (in seconds)
+    ENABLED = True
+    SLOW_QUERY_MS = 500
+    MAX_STATEMENTS = 500
+
+    # The same slow statement is explained at most once in this many
+    # seconds, so a slow endpoint under load does not flood the log (and
+    # the database with EXPLAINs)
+    SLOW_QUERY_INTERVAL = 60
+
+    def __init__(self):
+        self.enabled = os.getenv("QUERY_STATS", "1" if self.ENABLED else "0") \
+            not in ("0", "false", "no")
+        self.slow_query_time = float(os.getenv("SLOW_QUERY_MS", self.SLOW_QUERY_MS)) / 1000
+        self.slow_query_interval = float(os.getenv("SLOW_QUERY_INTERVAL", self.SLOW_QUERY_INTERVAL))
+
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.slow_queries = 0
+        self.since = dt.datetime.now()
+
+    def record(self, query, elapsed: float, rows: int, error: bool = False) -> str:
+        """Counts one run of query, which took elapsed seconds. Returns its key"""
+        key = get_key(query)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                if len(self.statements) >= self.MAX_STATEMENTS:
+                    key = OTHER
+                stats = self.statements.setdefault(key, StatementStats())
+
+            stats.calls += 1
+            stats.times.observe(elapsed)
+            if error:
+                stats.errors += 1
+            else:
+                stats.rows += rows
+        return key
+
+    def is_slow(self, elapsed: float) -> bool:
+        return bool(self.slow_query_time) and elapsed >= self.slow_query_time
+
+    def should_explain(self, key: str) -> bool:
+        """Whether a slow statement was not explained recently"""
+        now = time.monotonic()
+        with self.lock:
+            self.slow_queries += 1
+            stats = self.statements.get(key)
+            if stats is None:
+                return False
+            if stats.last_explained and now - stats.last_explained < self.slow_query_interval:
+                return False
+            stats.last_explained = now
+            return True
+
+    @staticmethod
+    def is_explainable(query: str) -> bool:
+        return query.lstrip().upper().startswith(EXPLAINABLE)
+
+    def log_slow(self, statement: str, elapsed: float, plan: list = None) -> None:
+        logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, statement, extra = {
+            "elapsedMs": round(elapsed * 1000, 1),
+            "plan": plan
+        })
+
+    def snapshot(self) -> list:
+        """(key, calls, errors, rows, copy of the latency histogram) per statement"""
+        with self.lock:
+            return [(key, stats.calls, stats.errors, stats.rows, stats.times.copy())
+                for key, stats in self.statements.items()]
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements = {}
+            self.slow_queries = 0
+            self.since = dt.datetime.now()
+
+    def get_stats(self) -> dict:
+        """Statements, those which took the most time in total first"""
+        with self.lock:
+            statements = [dict(stats.as_dict(), statement = key)
+                for key, stats in self.statements.items()]
+            slow_queries = self.slow_queries
+            since = self.since
+
+        statements.sort(key = lambda stats: stats["time"]["sum"], reverse = True)
+        return {
+            "enabled": self.enabled,
+            "since": since.isoformat(),
+            "slowQueryMs": self.slow_query_time * 1000,
+            "slowQueries": slow_queries,
+            "statements": statements
+        }
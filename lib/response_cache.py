@@ -0,0 +1,401 @@
+import gzip, hashlib, os, select, threading
+from functools import wraps
+from typing import Callable, List, Tuple
+
+from flask import current_app, request as req, Response
+
+from lib.singleton import Singleton
+from lib.lru_cache import LRUCache
+import lib.exceptions as exceptions
+
+# Redis is optional. Without it, every process keeps its own cache in memory
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Cache of whole responses of read-only endpoints (list of products, single
+# product), already serialized and compressed, so a hit touches neither the
+# database nor the JSON encoder.
+#
+# Entries are invalidated in two ways:
+#
+# - by ourselves, right after writing (POST, PATCH, DELETE), so a client
+#   always sees its own writes;
+# - by Postgres, which NOTIFYs channel "products_changed" whenever the
+#   products table changes, whoever changed it (another worker process, the
+#   bulk import, somebody with psql). See sql/07-products-notify.sql
+#
+# Any change can move products between pages of the list, so a write drops
+# every cached list, but only the entries of the products it touched. To drop
+# all lists at once (even from Redis, which we cannot iterate cheaply), every
+# entry remembers the "generation" it was cached in, and a write just
+# increments the generation. Entries of single products remember the "epoch"
+# instead, which only changes when we do not know which products changed.
+
+CHANNEL = "products_changed"
+
+# Payload of a notification meaning "anything may have changed"
+ALL_PRODUCTS = "*"
+
+# Smaller bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+BACKEND_MEMORY = "memory"
+BACKEND_REDIS = "redis"
+
+def parse_payload(payload: str) -> List[int]:
+    """
+    Product ids in a notification, e.g. "1,2,3". Returns None if every
+    product should be considered changed
+    """
+    if payload == ALL_PRODUCTS:
+        return None
+    try:
+        return [int(prod_id) for prod_id in payload.split(",") if prod_id]
+    except ValueError:
+        return None
+
+class CachedBody:
+    """Basically a struct for a response, ready to be sent"""
+    def __init__(
+            self,
+            body: bytes,
+            mimetype: str,
+            generation: int,
+            epoch: int,
+            gzipped: bytes = None,
+            etag: str = None):
+        self.body = body
+        self.mimetype = mimetype
+        self.generation = generation
+        self.epoch = epoch
+
+        if gzipped is None and len(body) >= GZIP_MIN_SIZE:
+            gzipped = gzip.compress(body)
+        self.gzipped = gzipped or None
+        self.etag = etag or hashlib.md5(body).hexdigest()
+
+class MemoryBackend:
+    """Entries are kept in this process only"""
+    name = BACKEND_MEMORY
+
+    def __init__(self, max_size: int, ttl: float):
+        self.entries = LRUCache(max_size = max_size, ttl = ttl)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.epoch = 0
+
+    def load(self, key: str) -> Tuple[CachedBody, int, int]:
+        entry = self.entries.get(key)
+        if entry is LRUCache.MISSING:
+            entry = None
+        return entry, self.generation, self.epoch
+
+    def counters(self) -> Tuple[int, int]:
+        return self.generation, self.epoch
+
+    def store(self, key: str, entry: CachedBody) -> None:
+        self.entries.set(key, entry)
+
+    def invalidate(self, keys: List[str], everything: bool) -> None:
+        with self.lock:
+            self.generation += 1
+            if everything:
+                self.epoch += 1
+        if everything:
+            self.entries.clear()
+        for key in keys:
+            self.entries.invalidate(key)
+
+    def get_stats(self) -> dict:
+        return self.entries.get_stats()
+
+class RedisBackend:
+    """
+    Entries are kept in Redis (or anything speaking its protocol), shared by
+    every process of the app, and by the app and its restarts
+    """
+    name = BACKEND_REDIS
+    PREFIX = "michelangelo:responses:"
+
+    def __init__(self, url: str, ttl: float):
+        if redis is None:
+            raise Exception("Package redis is needed for RESPONSE_CACHE_BACKEND=redis")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl) or None
+        self.generation_key = self.PREFIX + "generation"
+        self.epoch_key = self.PREFIX + "epoch"
+
+    def counters(self) -> Tuple[int, int]:
+        generation, epoch = self.client.mget(self.generation_key, self.epoch_key)
+        return int(generation or 0), int(epoch or 0)
+
+    def load(self, key: str) -> Tuple[CachedBody, int, int]:
+        # A single round trip for the entry and both counters
+        pipe = self.client.pipeline(transaction = False)
+        pipe.hgetall(self.PREFIX + key)
+        pipe.mget(self.generation_key, self.epoch_key)
+        fields, (generation, epoch) = pipe.execute()
+
+        entry = None
+        if fields:
+            entry = CachedBody(
+                fields[b"body"],
+                fields[b"mimetype"].decode(),
+                int(fields[b"generation"]),
+                int(fields[b"epoch"]),
+                gzipped = fields[b"gzipped"],
+                etag = fields[b"etag"].decode())
+        return entry, int(generation or 0), int(epoch or 0)
+
+    def store(self, key: str, entry: CachedBody) -> None:
+        pipe = self.client.pipeline(transaction = False)
+        pipe.hset(self.PREFIX + key, mapping = {
+            "body": entry.body,
+            "gzipped": entry.gzipped or b"",
+            "mimetype": entry.mimetype,
+            "etag": entry.etag,
+            "generation": entry.generation,
+            "epoch": entry.epoch
+        })
+        if self.ttl:
+            pipe.expire(self.PREFIX + key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, keys: List[str], everything: bool) -> None:
+        pipe = self.client.pipeline(transaction = False)
+        pipe.incr(self.generation_key)
+        if everything:
+            pipe.incr(self.epoch_key)
+        if keys:
+            pipe.delete(*[self.PREFIX + key for key in keys])
+        pipe.execute()
+
+    def get_stats(self) -> dict:
+        return {"ttl": self.ttl}
+
+class ResponseCache (metaclass = Singleton):
+    # Defaults, can be overriden with environment variables
+    # RESPONSE_CACHE_SIZE (entries, 0 disables the cache), RESPONSE_CACHE_TTL
+    # (in seconds), RESPONSE_CACHE_BACKEND ("memory" or "redis") and
+    # REDIS_URL.
+    #
+    # Notifications keep entries up to date, the TTL is only a safety net
+    # for the rare notification we might miss
+    SIZE = 2000
+    TTL = 300
+    BACKEND = BACKEND_MEMORY
+    REDIS_URL = "redis://localhost:6379/0"
+
+    # How long the listener waits before reconnecting to the database
+    RECONNECT_DELAY = 5.0
+
+    def __init__(self):
+        size = int(os.getenv("RESPONSE_CACHE_SIZE", self.SIZE))
+        ttl = float(os.getenv("RESPONSE_CACHE_TTL", self.TTL))
+        backend = os.getenv("RESPONSE_CACHE_BACKEND", self.BACKEND)
+
+        self.enabled = size > 0
+        if not self.enabled:
+            self.backend = None
+        elif backend == BACKEND_MEMORY:
+            self.backend = MemoryBackend(size, ttl)
+        elif backend == BACKEND_REDIS:
+            self.backend = RedisBackend(os.getenv("REDIS_URL", self.REDIS_URL), ttl)
+        else:
+            raise Exception(f"Unknown response cache backend {backend}")
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+        self.notifications = 0
+
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def product_key(prod_id: int) -> str:
+        return f"product:{prod_id}"
+
+    @staticmethod
+    def list_key() -> str:
+        # Parameters are sorted, so that "?a=1&b=2" and "?b=2&a=1" are the
+        # same entry
+        args = sorted(req.args.items(multi = True))
+        return req.path + "?" + "&".join(f"{name}={value}" for name, value in args)
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def cached(self, id_arg: str = None) -> Callable:
+        """
+        Decorator for views whose response only depends on the products
+        table and the query string. If id_arg is given, it is the URL
+        variable with the prod_id of the product the view returns, and
+        its entry is dropped only when that product changes. Otherwise,
+        the entry is dropped whenever any product changes
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+
+                if id_arg is None:
+                    key = self.list_key()
+                else:
+                    key = self.product_key(kwargs[id_arg])
+
+                try:
+                    entry, generation, epoch = self.backend.load(key)
+                except Exception as err:
+                    # If Redis is down, we can still answer without it
+                    exceptions.printerr(err)
+                    self.count("errors")
+                    return view(*args, **kwargs)
+
+                if entry is not None and self.is_fresh(entry, generation, epoch, id_arg):
+                    self.count("hits")
+                    return self.send(entry, "HIT")
+
+                self.count("misses")
+                # Views may return a tuple, e.g. (jsonify(...), 404)
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+
+                entry = CachedBody(
+                    response.get_data(),
+                    response.mimetype,
+                    generation,
+                    epoch)
+                self.store(key, entry)
+                return self.send(entry, "MISS")
+
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def is_fresh(entry: CachedBody, generation: int, epoch: int, id_arg: str) -> bool:
+        if id_arg is None:
+            return entry.generation == generation
+        return entry.epoch == epoch
+
+    def store(self, key: str, entry: CachedBody) -> None:
+        # If products changed while we were reading them, what we read may
+        # be outdated already. We only check, there is no lock, so there is
+        # still a tiny window in which an outdated entry can be stored, and
+        # then it lives until its TTL
+        try:
+            if self.backend.counters() == (entry.generation, entry.epoch):
+                self.backend.store(key, entry)
+        except Exception as err:
+            exceptions.printerr(err)
+            self.count("errors")
+
+    @staticmethod
+    def send(entry: CachedBody, status: str) -> Response:
+        if req.if_none_match.contains(entry.etag):
+            response = Response(status = 304)
+        elif entry.gzipped and "gzip" in req.accept_encodings:
+            response = Response(entry.gzipped, mimetype = entry.mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(entry.body, mimetype = entry.mimetype)
+
+        response.set_etag(entry.etag)
+        response.vary.add("Accept-Encoding")
+        response.headers["X-Cache"] = status
+        return response
+
+    def invalidate(self, prod_ids: List[int] = None) -> None:
+        """
+        Drops what changed when the given products changed, or everything
+        if prod_ids is None
+        """
+        if not self.enabled:
+            return
+        self.count("invalidations")
+        keys = [self.product_key(prod_id) for prod_id in prod_ids or []]
+        try:
+            self.backend.invalidate(keys, everything = prod_ids is None)
+        except Exception as err:
+            exceptions.printerr(err)
+            self.count("errors")
+
+    def listen(self, connect: Callable) -> None:
+        """
+        Starts a thread listening to notifications from Postgres, with its
+        own connection (from connect, e.g. DB.connect), since a connection
+        from the pool could be handed to somebody else in the meantime
+        """
+        if not self.enabled or (self.thread and self.thread.is_alive()):
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target = self.listen_loop,
+            args = (connect,),
+            name = "response-cache-listener",
+            daemon = True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def listen_loop(self, connect: Callable) -> None:
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL} ;")
+
+                # We could have missed notifications while we were not
+                # listening, so we cannot trust anything cached before
+                self.invalidate()
+
+                while not self.stopped.is_set():
+                    # Waking up every second, to notice when we are stopped
+                    if not select.select([conn], [], [], 1.0)[0]:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.count("notifications")
+                        self.invalidate(parse_payload(notify.payload))
+
+            except Exception as err:
+                # Database might be down for a moment. Meanwhile, entries
+                # still expire with their TTL
+                exceptions.printerr(err)
+                self.stopped.wait(self.RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "enabled": self.enabled,
+                "backend": self.backend.name if self.enabled else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else 0.0,
+                "errors": self.errors,
+                "invalidations": self.invalidations,
+                "notifications": self.notifications,
+                "listening": bool(self.thread and self.thread.is_alive())
+            }
+        if self.enabled:
+            stats["entries"] = self.backend.get_stats()
+        return stats
@@ -0,0 +1,292 @@
+import logging, os, select, signal, socket, sys, tempfile, time
+from typing import Callable
+
+from waitress import wasyncore
+from waitress.server import create_server
+
+from lib.singleton import Singleton
+import lib.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# Production server. A single Python process only uses one core for Python
+# code (serializing JSON, mostly), however many threads waitress has. So the
+# server can run as several processes:
+#
+# - The master process opens the listening socket and forks WEB_WORKERS
+#   workers, which accept connections from that same socket. The kernel
+#   hands each connection to one of them. The master does nothing else but
+#   replacing workers that die.
+# - Each worker runs waitress with WEB_THREADS threads. After the fork, it
+#   starts what cannot be inherited: its own connections to the database,
+#   and its own background threads (see App.after_fork). Metrics of all
+#   workers are added up through files in METRICS_DIR (see lib/metrics.py).
+#
+# Signals, sent to the master:
+#
+# - SIGTERM or SIGINT: workers stop accepting connections, finish the
+#   requests they have (for at most WEB_GRACEFUL_TIMEOUT seconds) and exit.
+# - SIGHUP: graceful reload. The master runs itself again (exec), with the
+#   same pid and the same listening socket, so new code and configuration
+#   are loaded. Old workers keep serving until the new ones are ready, then
+#   they stop as above. No connection is refused in between.
+#
+# With WEB_WORKERS=1 (the default), there is no master: waitress runs in the
+# process itself, as it always did.
+
+class Server (metaclass = Singleton):
+    # Defaults, can be overriden with environment variables WEB_WORKERS (0
+    # for one per CPU), WEB_THREADS, WEB_CONNECTION_LIMIT (per worker),
+    # WEB_BACKLOG, WEB_CHANNEL_TIMEOUT and WEB_GRACEFUL_TIMEOUT (in seconds)
+    WORKERS = 1
+    THREADS = 4
+    CONNECTION_LIMIT = 100
+    BACKLOG = 1024
+    CHANNEL_TIMEOUT = 120
+    GRACEFUL_TIMEOUT = 30
+
+    # Passed by a master to itself, when it reloads
+    ENV_LISTEN_FD = "WEB_LISTEN_FD"
+    ENV_OLD_WORKERS = "WEB_OLD_WORKERS"
+
+    # A worker that dies sooner than this after starting is replaced only
+    # after this long, so a broken worker does not make us fork in a loop
+    RESPAWN_DELAY = 1.0
+
+    def __init__(self):
+        self.workers = int(os.getenv("WEB_WORKERS", self.WORKERS)) or os.cpu_count()
+        self.threads = int(os.getenv("WEB_THREADS", self.THREADS))
+        self.connection_limit = int(os.getenv("WEB_CONNECTION_LIMIT", self.CONNECTION_LIMIT))
+        self.backlog = int(os.getenv("WEB_BACKLOG", self.BACKLOG))
+        self.channel_timeout = int(os.getenv("WEB_CHANNEL_TIMEOUT", self.CHANNEL_TIMEOUT))
+        self.graceful_timeout = float(os.getenv("WEB_GRACEFUL_TIMEOUT", self.GRACEFUL_TIMEOUT))
+
+        if self.workers < 1 or self.threads < 1:
+            raise ValueError("WEB_WORKERS and WEB_THREADS must be at least 1")
+
+        # pid -> when our worker started
+        self.children = {}
+        self.stopping = False
+        self.reloading = False
+
+    def adjustments(self) -> dict:
+        """Settings for waitress"""
+        return {
+            "threads": self.threads,
+            "connection_limit": self.connection_limit,
+            "backlog": self.backlog,
+            "channel_timeout": self.channel_timeout,
+            # select() cannot watch descriptors above 1024
+            "asyncore_use_poll": True
+        }
+
+    def open_socket(self, host: str, port: int) -> socket.socket:
+        fd = os.environ.pop(self.ENV_LISTEN_FD, None)
+        if fd is not None:
+            # We were reloaded, and the socket is still open
+            return socket.socket(fileno = int(fd))
+
+        family, kind, proto, _, address = socket.getaddrinfo(
+            host, port, type = socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(self.backlog)
+        return sock
+
+    def is_preforked(self) -> bool:
+        # A master that reloads keeps being a master
+        return self.workers > 1 or self.ENV_OLD_WORKERS in os.environ
+
+    def metrics_dir(self) -> str:
+        """Where workers write their metrics, if METRICS_DIR is not set"""
+        return os.path.join(tempfile.gettempdir(), f"michelangelo-metrics-{os.getpid()}")
+
+    def serve(self, app, host: str, port: int, after_fork: Callable[[], None]) -> None:
+        """
+        Serves app until we are told to stop. after_fork() is called in each
+        worker as soon as it starts (or before serving, without workers)
+        """
+        sock = self.open_socket(host, port)
+
+        if not self.is_preforked():
+            after_fork()
+            self.run_worker(app, sock, None)
+            return
+
+        logger.info("Starting %s workers with %s threads each", self.workers, self.threads)
+        self.run_master(app, sock, after_fork)
+
+    ########## Master
+
+    def run_master(self, app, sock: socket.socket, after_fork: Callable[[], None]) -> None:
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        # Workers write a byte here once they accept connections
+        ready_read, ready_write = os.pipe()
+
+        old_workers = [int(pid) for pid in
+            os.environ.pop(self.ENV_OLD_WORKERS, "").split(",") if pid]
+
+        for _ in range(self.workers):
+            self.spawn(app, sock, after_fork, ready_write)
+
+        if old_workers:
+            # Wait until the new workers are ready before stopping the old
+            self.wait_ready(ready_read, self.workers)
+            logger.info("Reloaded, stopping old workers %s", old_workers)
+            self.signal_all(old_workers, signal.SIGTERM)
+
+        while True:
+            self.reap(app, sock, after_fork, ready_write, old_workers)
+
+            if self.reloading:
+                self.reload(sock)
+            if self.stopping:
+                self.stop(old_workers)
+                return
+
+            time.sleep(0.2)
+
+    def spawn(self, app, sock: socket.socket, after_fork, ready_write: int) -> None:
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+
+        # Worker: the master's signal handlers do not apply. Ctrl+C reaches
+        # every process of the terminal, and it is the master that decides
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            after_fork()
+            self.run_worker(app, sock, ready_write)
+        except BaseException as err:
+            logger.exception("Worker %s failed: %s", os.getpid(), err)
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def reap(self, app, sock, after_fork, ready_write: int, old_workers: list) -> None:
+        """Replaces workers that died (unless we are stopping)"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            # Its metrics are not coming back, and its pid may be reused
+            metrics.SnapshotWriter().remove(pid)
+
+            if pid in old_workers:
+                old_workers.remove(pid)
+                continue
+
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            logger.warning("Worker %s exited with status %s, replacing it", pid, status)
+            if time.monotonic() - started < self.RESPAWN_DELAY:
+                time.sleep(self.RESPAWN_DELAY)
+            self.spawn(app, sock, after_fork, ready_write)
+
+    def wait_ready(self, ready_read: int, count: int) -> None:
+        deadline = time.monotonic() + self.graceful_timeout
+        while count > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("%s workers were not ready in time", count)
+                return
+            if select.select([ready_read], [], [], remaining)[0]:
+                count -= len(os.read(ready_read, count))
+
+    def handle_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def handle_reload(self, signum, frame) -> None:
+        self.reloading = True
+
+    @staticmethod
+    def signal_all(pids, signum: int) -> None:
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, old_workers: list) -> None:
+        pids = list(self.children) + old_workers
+        logger.info("Stopping workers %s", pids)
+        self.signal_all(pids, signal.SIGTERM)
+
+        # They should be done within their graceful timeout
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                time.sleep(0.1)
+            elif pid in pids:
+                pids.remove(pid)
+
+        self.signal_all(pids, signal.SIGKILL)
+
+    def reload(self, sock: socket.socket) -> None:
+        # Everything but the socket is closed by exec. The current workers
+        # are still our children afterwards, since the pid does not change
+        logger.info("Reloading")
+        sock.set_inheritable(True)
+        os.environ[self.ENV_LISTEN_FD] = str(sock.fileno())
+        os.environ[self.ENV_OLD_WORKERS] = ",".join(str(pid) for pid in self.children)
+        logging.shutdown()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    ########## Worker
+
+    def run_worker(self, app, sock: socket.socket, ready_write) -> None:
+        server = create_server(app, sockets = [sock], **self.adjustments())
+
+        stopped = []
+        def handle_stop(signum, frame):
+            stopped.append(time.monotonic())
+        signal.signal(signal.SIGTERM, handle_stop)
+
+        if ready_write is not None:
+            os.write(ready_write, b".")
+        logger.info("Worker %s serving on http://%s:%s",
+            os.getpid(), server.effective_host, server.effective_port)
+
+        try:
+            while not stopped or not self.is_drained(server, stopped[0]):
+                wasyncore.loop(
+                    timeout = server.adj.asyncore_loop_timeout,
+                    map = server._map,
+                    use_poll = True,
+                    count = 1)
+        finally:
+            server.task_dispatcher.shutdown()
+
+    def is_drained(self, server, stopped_at: float) -> bool:
+        """
+        Stops accepting connections, and closes those which are idle, so
+        we can exit once the last request was answered
+        """
+        server.accepting = False
+        for channel in list(server.active_channels.values()):
+            if not channel.requests and not channel.total_outbufs_len:
+                channel.will_close = True
+
+        if time.monotonic() - stopped_at > self.graceful_timeout:
+            logger.warning("Worker %s stopping with requests in progress", os.getpid())
+            return True
+        return not server.active_channels
@@ -0,0 +1,50 @@
+import math, re
+from typing import Tuple
+
+import lib.exceptions as exceptions
+
+# Validation of product data, shared by the API (api/products.py) and the bulk
+# import (lib/products_import.py), so that a product accepted by one of them is
+# always accepted by the other. Nothing here touches the database or Flask.
+
+# Using compiled version of regex for readability and (insignificant)
+# performance boost
+REGEX_MD5 = re.compile(r"^[0-9a-f]{32}$")
+
+def parse_price(value) -> int:
+    # Prices are stored in cents
+    return math.floor(float(value) * 100)
+
+def validate_product_fields(data: dict) -> Tuple[str, str, int, int, str]:
+    """
+    Validates the fields of a new product, as sent to POST /products.
+    Returns (prod_name, prod_descr, prod_price, prod_instock, pic_md5), with
+    price in cents. Raises BadRequest with a message saying what is wrong
+    """
+    try:
+        prod_name = data["prodName"]
+        if not isinstance(prod_name, str) or len(prod_name) == 0:
+            raise exceptions.BadRequest("Name must be non-empty string.")
+
+        prod_price = parse_price(data["prodPrice"])
+        prod_instock = int(data["prodInStock"])
+
+    except KeyError as err:
+        raise exceptions.BadRequest(f"Field {err} is missing.") from err
+    except (TypeError, ValueError, OverflowError) as err:
+        raise exceptions.BadRequest("Numeric fields contain invalid value.") from err
+
+    # Not mandatory fields
+    prod_descr = data.get("prodDescr", None)
+    pic_md5 = data.get("md5", None)
+
+    if prod_descr is not None and not isinstance(prod_descr, str):
+        raise exceptions.BadRequest("Description must be a string.")
+
+    if pic_md5 and not (isinstance(pic_md5, str) and REGEX_MD5.search(pic_md5)):
+        raise exceptions.BadRequest("Field 'MD5 hash' has invalid value.")
+
+    if prod_price <= 0 or prod_instock < 0:
+        raise exceptions.BadRequest("Numeric fields contain invalid value.")
+
+    return prod_name, prod_descr, prod_price, prod_instock, pic_md5
@@ -0,0 +1,264 @@
+# This file must be run as a module
+# e.g., from /michelangelo directory, run
+# "python3.8 -m scripts.benchmark --output results.json"
+#
+# Benchmark of the API. By default, it creates a throwaway database (with the
+# POSTGRES_* credentials of .env, which must be allowed to create databases),
+# fills it with a synthetic catalog (see lib/catalog_generator.py), starts
+# app.py in production mode on it, and runs every scenario (see
+# lib/benchmark.py) one after the other.
+# The database and the working directory of the server (with its uploads and
+# server.log) are removed afterwards, unless --keep is given.
+#
+# With --url, an already running server is benchmarked instead, with the
+# data it has. Careful: scenario "upload" creates products.
+#
+# Results are printed and, with --output, written as JSON. Given a previous
+# result with --compare, regressions are listed and the exit status is 1.
+
+import argparse, json, os, shutil, signal, socket, subprocess, sys, tempfile, time
+import urllib.parse
+
+import psycopg2
+from dotenv import load_dotenv
+
+import lib.benchmark as benchmark
+import lib.catalog_generator as catalog_generator
+import lib.db as db
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SQL_DIR = os.path.join(ROOT_DIR, "sql")
+TEST_FILES = os.path.join(ROOT_DIR, "tests", "test_files")
+
+# Pictures uploaded by the benchmark (made unique, see unique_picture)
+PICTURES = ["ladybird.jpg", "bears.jpg", "bears_png.png"]
+
+DEFAULT_PORT = 7798
+
+########## Throwaway database
+
+def connect(dbname: str):
+    conn = psycopg2.connect(
+        user = os.getenv("POSTGRES_USER"),
+        password = os.getenv("POSTGRES_PASSWORD"),
+        host = os.getenv("POSTGRES_HOST"),
+        port = os.getenv("POSTGRES_PORT"),
+        dbname = dbname)
+    # CREATE DATABASE cannot run inside a transaction
+    conn.autocommit = True
+    return conn
+
+def create_database(name: str, psql: str) -> None:
+    conn = connect("postgres")
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE DATABASE {name} ;")
+    conn.close()
+
+    # Same as install_db in install.py. psql goes on after a failed
+    # statement, like CREATE EXTENSION pg_trgm where it is not available
+    env = dict(os.environ,
+        PGPASSWORD = os.getenv("POSTGRES_PASSWORD", ""),
+        PGOPTIONS = "-c client_min_messages=warning")
+    for file in sorted(os.listdir(SQL_DIR)):
+        if file.endswith(".sql"):
+            subprocess.run([psql,
+                "-q",
+                "-U", os.getenv("POSTGRES_USER"),
+                "-h", os.getenv("POSTGRES_HOST"),
+                "-p", os.getenv("POSTGRES_PORT"),
+                "-d", name,
+                "-f", os.path.join(SQL_DIR, file)],
+                env = env, check = True,
+                stdout = subprocess.DEVNULL)
+
+def drop_database(name: str) -> None:
+    conn = connect("postgres")
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS {name} ;")
+    conn.close()
+
+def generate_catalog(name: str, workdir: str, args) -> None:
+    """Products and pictures of the throwaway database, see lib/catalog_generator.py"""
+    os.environ["POSTGRES_DATABASE"] = name
+    database = db.DB()
+    try:
+        catalog_generator.generate_catalog(
+            database,
+            args.products,
+            args.pictures,
+            duplication = args.duplication,
+            seed = args.seed,
+            upload_folder = os.path.join(workdir, "uploads"))
+    finally:
+        # Or the database could not be dropped
+        database.pool.close()
+
+########## Server
+
+def wait_for_port(port: int, proc: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"The server exited with status {proc.returncode}")
+        try:
+            socket.create_connection(("localhost", port), timeout = 1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The server is not listening on port {port}")
+
+def start_server(app: str, port: int, dbname: str, env: list, workdir: str) -> subprocess.Popen:
+    """
+    Runs app (app.py or app_async.py) in production mode. It runs in workdir,
+    so uploads and logs stay there
+    """
+    server_env = dict(os.environ,
+        FLASK_ENV = "production",
+        PORT = str(port),
+        POSTGRES_DATABASE = dbname,
+        # Flask sends files relative to the app's folder, not to workdir
+        UPLOAD_FOLDER = os.path.join(workdir, "uploads"),
+        LOG_LEVEL = "WARNING")
+    for assignment in env:
+        key, _, value = assignment.partition("=")
+        server_env[key] = value
+
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, app)],
+        cwd = workdir, env = server_env, stdout = log, stderr = subprocess.STDOUT)
+    log.close()
+    try:
+        wait_for_port(port, proc, 60)
+    except RuntimeError:
+        stop_server(proc)
+        raise
+    return proc
+
+def stop_server(proc: subprocess.Popen) -> None:
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(60)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+########## Main
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Benchmark of the API")
+    parser.add_argument("--url",
+        help = "benchmark this running server instead (e.g. http://localhost:5000)")
+    parser.add_argument("--app", default = "app.py",
+        help = "app to run, app.py or app_async.py (default: app.py)")
+    parser.add_argument("--scenarios", default = ",".join([
+        "list", "keyset", "detail", "count", "search", "pictures", "upload", "mixed"]),
+        help = "comma-separated scenarios to run (default: all)")
+    parser.add_argument("--concurrency", type = int, default = 16,
+        help = "simulated clients (default: 16)")
+    parser.add_argument("--duration", type = float, default = 20,
+        help = "seconds measured per scenario (default: 20)")
+    parser.add_argument("--warmup", type = float, default = 3,
+        help = "seconds of each scenario before measuring (default: 3)")
+    parser.add_argument("--products", type = int, default = 100000,
+        help = "products in the throwaway database (default: 100000)")
+    parser.add_argument("--pictures", type = int, default = 10000,
+        help = "pictures in the throwaway database (default: 10000)")
+    parser.add_argument("--duplication", type = float, default = 0.2,
+        help = "fraction of products with a picture that share it (default: 0.2)")
+    parser.add_argument("--seed", type = int, default = 0,
+        help = "seed of the data and of the requests (default: 0)")
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT,
+        help = f"port of the server started (default: {DEFAULT_PORT})")
+    parser.add_argument("--env", action = "append", default = [],
+        help = "KEY=VALUE for the server started, e.g. WEB_WORKERS=4 (repeatable)")
+    parser.add_argument("--psql", default = "psql",
+        help = "psql command, to create the tables (default: psql)")
+    parser.add_argument("--keep", action = "store_true",
+        help = "do not drop the throwaway database, nor remove the server's files")
+    parser.add_argument("--output", help = "write the results to this JSON file")
+    parser.add_argument("--compare", help = "JSON file of results to compare with")
+    parser.add_argument("--threshold", type = float, default = 10,
+        help = "change (in %%) that is a regression (default: 10)")
+    return parser.parse_args()
+
+def read_pictures() -> list:
+    pictures = []
+    for name in PICTURES:
+        with open(os.path.join(TEST_FILES, name), "rb") as f:
+            pictures.append(f.read())
+    return pictures
+
+def run_scenarios(args, host: str, port: int) -> dict:
+    context = benchmark.discover(host, port, read_pictures(), seed = args.seed)
+    scenarios = benchmark.make_scenarios(context)
+
+    report = {
+        "version": benchmark.FORMAT_VERSION,
+        "environment": benchmark.environment(),
+        "config": {
+            "app": None if args.url else args.app,
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "seed": args.seed,
+            "products": context.count,
+            "sampledProducts": len(context.prod_ids),
+            "sampledPictures": len(context.pic_ids),
+            "env": args.env
+        },
+        "scenarios": {}
+    }
+    for name in args.scenarios.split(","):
+        if name not in scenarios:
+            print(f"Skipping scenario {name}: unknown, or no data for it", file = sys.stderr)
+            continue
+        print(f"Running scenario {name}...", file = sys.stderr)
+        report["scenarios"][name] = benchmark.run(host, port, scenarios[name],
+            args.concurrency, args.duration, args.warmup, args.seed)
+    return report
+
+def main():
+    args = parse_args()
+    load_dotenv()
+
+    if args.url:
+        url = urllib.parse.urlsplit(args.url)
+        report = run_scenarios(args, url.hostname, url.port or 80)
+    else:
+        dbname = f"michelangelo_bench_{os.getpid()}"
+        workdir = tempfile.mkdtemp(prefix = "michelangelo-bench-")
+        print(f"Creating database {dbname}, working in {workdir}", file = sys.stderr)
+        create_database(dbname, args.psql)
+        try:
+            generate_catalog(dbname, workdir, args)
+            proc = start_server(args.app, args.port, dbname, args.env, workdir)
+            try:
+                report = run_scenarios(args, "localhost", args.port)
+            finally:
+                stop_server(proc)
+        finally:
+            if not args.keep:
+                drop_database(dbname)
+                shutil.rmtree(workdir)
+
+    print(benchmark.format_table(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = benchmark.compare(baseline, report, args.threshold / 100)
+        for regression in regressions:
+            print(f"Regression in {regression['scenario']}: {regression['metric']} "
+                f"went from {regression['before']:.4g} to {regression['after']:.4g}")
+        if regressions:
+            return 1
+        print(f"No regression beyond {args.threshold:g}%")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
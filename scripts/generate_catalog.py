@@ -0,0 +1,66 @@
+# This file must be run as a module
+# e.g., from /michelangelo directory, run
+# "python3.8 -m scripts.generate_catalog --products 1000000 --pictures 100000"
+#
+# Fills the database (the one in .env) with a synthetic catalog, for testing
+# at a realistic size, see lib/catalog_generator.py. Products already in the
+# database are kept. The server does not need to be running.
+
+import argparse, sys, time
+
+import lib.catalog_generator as catalog_generator
+import lib.db as db
+
+def parse_size(value: str):
+    width, _, height = value.partition("x")
+    return int(width), int(height)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Synthetic catalog generator")
+    parser.add_argument("--products", type = int, default = 1000000,
+        help = "products to create (default: 1000000)")
+    parser.add_argument("--pictures", type = int, default = 100000,
+        help = "different pictures to create (default: 100000)")
+    parser.add_argument("--duplication", type = float, default = 0.2,
+        help = "fraction of products with a picture that share it with " +
+            "another one (default: 0.2)")
+    parser.add_argument("--seed", type = int, default = 0,
+        help = "same seed, same catalog (default: 0)")
+    parser.add_argument("--uploads", default = "uploads",
+        help = "uploads folder of the server (default: uploads)")
+    parser.add_argument("--picture-size", type = parse_size,
+        default = catalog_generator.DEFAULT_PICTURE_SIZE,
+        help = "width and height of pictures, e.g. 320x240 (default)")
+    parser.add_argument("--processes", type = int,
+        help = "processes writing pictures (default: one per CPU)")
+    parser.add_argument("--queue-jobs", action = "store_true",
+        help = "have the server create variants of the pictures, as if uploaded")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    start = time.monotonic()
+    try:
+        report = catalog_generator.generate_catalog(
+            db.DB(),
+            args.products,
+            args.pictures,
+            duplication = args.duplication,
+            seed = args.seed,
+            upload_folder = args.uploads,
+            picture_size = args.picture_size,
+            queue_jobs = args.queue_jobs,
+            processes = args.processes)
+    except ValueError as err:
+        print(err, file = sys.stderr)
+        return 2
+    elapsed = time.monotonic() - start
+
+    print(f"Created {report.products} products in {elapsed:.1f} seconds, " +
+        f"{report.references} of them with one of {report.pictures} pictures " +
+        f"({report.pictures_added} new in the database, {report.files_written} files written).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
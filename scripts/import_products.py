@@ -0,0 +1,57 @@
+# This file must be run as a module
+# e.g., from /michelangelo directory, run
+# "python3.8 -m scripts.import_products products.csv --pictures path/to/pictures"
+#
+# Imports products from a CSV or NDJSON file straight into the database (see
+# lib/products_import.py for the columns). The server does not need to be
+# running, but new pictures will only be processed once it is.
+
+import argparse, sys, time
+
+import lib.db as db
+import lib.products_import as products_import
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Bulk import of products")
+    parser.add_argument("file", help = "CSV or NDJSON file, - for standard input")
+    parser.add_argument("--format", choices = products_import.FORMATS,
+        help = "file format (default: guessed from the extension)")
+    parser.add_argument("--pictures",
+        help = "directory with the pictures named in column \"picture\"")
+    parser.add_argument("--uploads", default = "uploads",
+        help = "uploads folder of the server (default: uploads)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    fmt = args.format or products_import.detect_format(args.file)
+    if fmt is None:
+        print("Cannot guess the format of the file, use --format", file = sys.stderr)
+        return 2
+
+    database = db.DB()
+
+    start = time.monotonic()
+    if args.file == "-":
+        report = products_import.import_products(
+            database, sys.stdin, fmt, args.pictures, args.uploads)
+    else:
+        with open(args.file, newline = "", encoding = "utf-8") as f:
+            report = products_import.import_products(
+                database, f, fmt, args.pictures, args.uploads)
+    elapsed = time.monotonic() - start
+
+    for line, message in report.errors:
+        print(f"Line {line}: {message}", file = sys.stderr)
+    if report.rejected > len(report.errors):
+        print(f"(and {report.rejected - len(report.errors)} more errors)", file = sys.stderr)
+
+    print(f"Read {report.read} rows in {elapsed:.1f} seconds. " +
+        f"Imported {report.imported} products, rejected {report.rejected}, " +
+        f"added {report.pictures_added} pictures.")
+
+    return 0 if not report.rejected else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -83,4 +83,24 @@ ON CONFLICT(pic_md5) DO
     pic_ref_count = pics.pic_ref_count + 1
 RETURNING pic_id, pic_ref_count ;
 $$
-LANGUAGE SQL;
\ No newline at end of file
+LANGUAGE SQL;
+
+CREATE OR REPLACE FUNCTION fn_pic_increase_ref_count
+(my_pic_md5 TEXT)
+RETURNS TABLE
+(
+    pic_id BIGINT,
+    pic_ref_count INT
+)
+AS
+$$
+-- Used when a picture we already have is uploaded again. Returns no rows if
+-- there is no picture with this MD5 hash
+UPDATE pics
+SET
+    pic_ref_count = pics.pic_ref_count + 1
+WHERE
+    pics.pic_md5 = my_pic_md5
+RETURNING pics.pic_id, pics.pic_ref_count ;
+$$
+LANGUAGE SQL;
@@ -12,3 +12,9 @@ CREATE TABLE IF NOT EXISTS products (
     CHECK (prod_price > 0),
     CHECK (prod_instock >= 0)
 );
+
+-- Deleting a picture cascades to its products, and deleting products has to
+-- find their pictures. Without this index, each of those is a full scan of
+-- products
+CREATE INDEX IF NOT EXISTS products_pic_id_idx
+ON products (pic_id);
@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS pic_jobs (
+    job_id          BIGSERIAL NOT NULL PRIMARY KEY,
+    pic_id          BIGINT NOT NULL UNIQUE
+                    REFERENCES pics(pic_id) ON DELETE CASCADE,
+    job_status      TEXT NOT NULL DEFAULT 'queued',
+    job_attempts    INT NOT NULL DEFAULT 0,
+    job_error       TEXT,
+    -- Random token given to whoever claimed the job. If a worker takes too
+    -- long and the job is claimed again, the late worker cannot overwrite
+    -- the result
+    job_token       TEXT,
+    job_created     TIMESTAMP NOT NULL DEFAULT NOW(),
+    job_updated     TIMESTAMP NOT NULL DEFAULT NOW(),
+
+    CHECK (job_status IN ('queued', 'processing', 'done', 'failed')),
+    CHECK (job_attempts >= 0)
+);
+
+-- Workers only ever look for unfinished jobs, so there is no point in
+-- indexing the (many) finished ones
+CREATE INDEX IF NOT EXISTS pic_jobs_pending_idx
+    ON pic_jobs (job_id)
+    WHERE job_status IN ('queued', 'processing');
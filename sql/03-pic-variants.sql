@@ -0,0 +1,66 @@
+-- Smaller versions of a picture, in several widths and formats (e.g. WebP),
+-- so clients do not have to download the full picture for a thumbnail
+CREATE TABLE IF NOT EXISTS pic_variants (
+    pic_id          BIGINT NOT NULL
+                    REFERENCES pics(pic_id) ON DELETE CASCADE,
+    var_width       INT NOT NULL,
+    var_format      TEXT NOT NULL,
+    var_path        TEXT NOT NULL UNIQUE,
+    var_size        BIGINT NOT NULL,
+
+    PRIMARY KEY (pic_id, var_width, var_format),
+    CHECK (var_width > 0),
+    CHECK (CHAR_LENGTH(var_path) > 0)
+);
+
+-- Defined here, and not with the other functions in 00-pics.sql, because the
+-- body of a SQL function is checked when it is created, and it reads
+-- pic_variants
+CREATE OR REPLACE FUNCTION fn_pic_decrease_ref_counts
+(my_pic_ids BIGINT[])
+RETURNS TABLE
+(
+    pic_id BIGINT,
+    pic_path TEXT,
+    var_paths TEXT[]
+)
+AS
+$$
+-- Set-based version of fn_pic_decrease_ref_count, used when many products are
+-- deleted at once. An id may appear several times in my_pic_ids (products
+-- sharing a picture), each time counts as one reference. Returns the pictures
+-- that were deleted because their reference count dropped to zero, along with
+-- the paths of their variants, so their files can be removed
+WITH counts AS
+(
+    SELECT ids.id, COUNT(*) AS n
+    FROM UNNEST(my_pic_ids) AS ids(id)
+    WHERE ids.id IS NOT NULL
+    GROUP BY ids.id
+),
+updated AS
+(
+    UPDATE pics
+    SET pic_ref_count = pics.pic_ref_count - counts.n
+    FROM counts
+    WHERE
+        pics.pic_id = counts.id
+        AND pics.pic_ref_count > counts.n
+    RETURNING pics.pic_id
+)
+DELETE
+FROM pics
+USING counts
+WHERE
+    pics.pic_id = counts.id
+    AND pics.pic_ref_count <= counts.n
+RETURNING
+    pics.pic_id,
+    pics.pic_path,
+    ARRAY(
+        SELECT var_path
+        FROM pic_variants
+        WHERE pic_variants.pic_id = pics.pic_id
+    ) ;
+$$
+LANGUAGE SQL;
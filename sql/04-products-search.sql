@@ -0,0 +1,30 @@
+-- Search over products (GET /products/search). This file can be run more than
+-- once, and on an existing database: indexes are built CONCURRENTLY, so the
+-- table is not locked for writes while they are built. psql runs every
+-- statement in its own transaction, as CREATE INDEX CONCURRENTLY requires.
+--
+-- Adding the generated column does rewrite the table once, which takes a lock
+-- for as long as that lasts (seconds for a million products).
+
+-- Words of name and description, the name being more important. Generated
+-- columns are always up to date, and the expression is computed only when a
+-- row is written, not for every search
+ALTER TABLE products
+ADD COLUMN IF NOT EXISTS prod_tsv TSVECTOR
+GENERATED ALWAYS AS
+(
+    SETWEIGHT(TO_TSVECTOR('english', prod_name), 'A') ||
+    SETWEIGHT(TO_TSVECTOR('english', COALESCE(prod_descr, '')), 'B')
+) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_tsv_idx
+ON products USING GIN (prod_tsv);
+
+-- Trigrams make search tolerant to typos ("pirat hta"). pg_trgm comes with
+-- PostgreSQL (package postgresql-contrib in some distributions) and can be
+-- installed by the owner of the database. If it is not available, these two
+-- statements fail, and search works with full-text only
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_name_trgm_idx
+ON products USING GIN (prod_name gin_trgm_ops);
@@ -0,0 +1,18 @@
+-- Indexes for sorting and filtering products (see lib/product_query.py). Every
+-- sort order is (column, prod_id), prod_id breaking ties, so with these the
+-- list is read in order straight from the index, without sorting, and a
+-- keyset cursor seeks right into it. The same indexes serve range filters
+-- on the column (price range, created after). Scanned backwards, they also
+-- serve descending order.
+--
+-- Like sql/04-products-search.sql, indexes are built CONCURRENTLY, so this
+-- file can be run on a live database, and more than once.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_price_idx
+ON products (prod_price, prod_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_created_idx
+ON products (prod_created, prod_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_name_idx
+ON products (prod_name, prod_id);
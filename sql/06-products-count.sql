@@ -0,0 +1,87 @@
+-- Number of products, kept up to date by triggers, so GET /products/count
+-- does not need to scan the whole table. Triggers run once per statement, and
+-- transition tables tell them how many rows were inserted or deleted, so bulk
+-- inserts and deletes cost a single update of the counter.
+--
+-- Every write to products updates this single row, so concurrent writers wait
+-- for each other until they commit. Products are written rarely compared to
+-- how often they are read, so that is a good trade here.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS products_count (
+    -- There is only one row
+    id              BOOLEAN NOT NULL PRIMARY KEY DEFAULT TRUE,
+    prod_count      BIGINT NOT NULL,
+
+    CHECK (id),
+    CHECK (prod_count >= 0)
+);
+
+CREATE OR REPLACE FUNCTION fn_products_count_insert()
+RETURNS TRIGGER
+AS
+$$
+BEGIN
+    UPDATE products_count
+    SET prod_count = prod_count + (SELECT COUNT(*) FROM inserted);
+    RETURN NULL;
+END
+$$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION fn_products_count_delete()
+RETURNS TRIGGER
+AS
+$$
+BEGIN
+    UPDATE products_count
+    SET prod_count = prod_count - (SELECT COUNT(*) FROM deleted);
+    RETURN NULL;
+END
+$$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION fn_products_count_truncate()
+RETURNS TRIGGER
+AS
+$$
+BEGIN
+    UPDATE products_count
+    SET prod_count = 0;
+    RETURN NULL;
+END
+$$
+LANGUAGE PLPGSQL;
+
+-- Nobody may write to products between counting and creating the triggers,
+-- or the counter would be off for good
+LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS products_count_insert ON products;
+CREATE TRIGGER products_count_insert
+AFTER INSERT ON products
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_count_insert();
+
+DROP TRIGGER IF EXISTS products_count_delete ON products;
+CREATE TRIGGER products_count_delete
+AFTER DELETE ON products
+REFERENCING OLD TABLE AS deleted
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_count_delete();
+
+DROP TRIGGER IF EXISTS products_count_truncate ON products;
+CREATE TRIGGER products_count_truncate
+AFTER TRUNCATE ON products
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_count_truncate();
+
+INSERT INTO products_count (prod_count)
+SELECT COUNT(*)
+FROM products
+ON CONFLICT (id) DO UPDATE
+SET prod_count = EXCLUDED.prod_count;
+
+COMMIT;
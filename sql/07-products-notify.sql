@@ -0,0 +1,72 @@
+-- Tells every listener (the response cache of each app process, see
+-- lib/response_cache.py) which products changed, on channel
+-- "products_changed". The payload is a comma-separated list of prod_ids, or
+-- "*" when too many products changed at once (bulk import, delete all) to
+-- list them; a notification payload is limited to 8000 bytes anyway.
+--
+-- Notifications are only delivered when the transaction commits, so nobody
+-- drops their cache before the change is visible. Triggers run once per
+-- statement, so a bulk insert sends a single notification.
+
+CREATE OR REPLACE FUNCTION fn_products_notify()
+RETURNS TRIGGER
+AS
+$$
+DECLARE
+    payload TEXT;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        payload := '*';
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT
+            CASE
+                WHEN COUNT(*) <= 100 THEN STRING_AGG(prod_id::text, ',')
+                ELSE '*'
+            END
+        INTO payload
+        FROM changed_old ;
+    ELSE
+        SELECT
+            CASE
+                WHEN COUNT(*) <= 100 THEN STRING_AGG(prod_id::text, ',')
+                ELSE '*'
+            END
+        INTO payload
+        FROM changed_new ;
+    END IF;
+
+    -- Statements touching no rows at all change nothing
+    IF payload IS NOT NULL THEN
+        PERFORM pg_notify('products_changed', payload);
+    END IF;
+    RETURN NULL;
+END
+$$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS products_notify_insert ON products;
+CREATE TRIGGER products_notify_insert
+AFTER INSERT ON products
+REFERENCING NEW TABLE AS changed_new
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_notify();
+
+DROP TRIGGER IF EXISTS products_notify_update ON products;
+CREATE TRIGGER products_notify_update
+AFTER UPDATE ON products
+REFERENCING NEW TABLE AS changed_new
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_notify();
+
+DROP TRIGGER IF EXISTS products_notify_delete ON products;
+CREATE TRIGGER products_notify_delete
+AFTER DELETE ON products
+REFERENCING OLD TABLE AS changed_old
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_notify();
+
+DROP TRIGGER IF EXISTS products_notify_truncate ON products;
+CREATE TRIGGER products_notify_truncate
+AFTER TRUNCATE ON products
+FOR EACH STATEMENT
+EXECUTE FUNCTION fn_products_notify();
@@ -1,4 +1,4 @@
-import requests, unittest, subprocess, datetime
+import requests, unittest, subprocess, datetime, csv, io, json
 
 import lib.db as db
 import lib.file_utils as file_utils
@@ -73,6 +73,12 @@ def delete_pictures_orphan():
     check_status_code(r.status_code)
     return r.text
 
+def export_products(fmt, params = ""):
+    endpoint = f"/products/export?format={fmt}{params}"
+    r = requests.get(URL + endpoint, stream = True)
+    check_status_code(r.status_code)
+    return r.text
+
 class FileUploadTest(unittest.TestCase):
     db = db.DB()
     upload_path = rel_path("../uploads")
@@ -133,13 +139,20 @@ class FileUploadTest(unittest.TestCase):
         db_pics = self.select_pictures()
         ls_pics = self.ls_uploaded_pics()
 
+        # Processed pictures also have variants (smaller versions) on disk
+        var_paths = self.db.query("""
+            SELECT var_path
+            FROM pic_variants ;
+        """).rows
+        db_files = [os.path.basename(pic["pic_path"]) for pic in db_pics] \
+            + [os.path.basename(path) for path, in var_paths]
+
         # If the number of files is not the same, we stop here
-        if len(db_pics) != len(ls_pics):
+        if len(db_files) != len(ls_pics):
             self.assertTrue(False)
             return
         
-        for pic in db_pics:
-            basename = os.path.basename(pic["pic_path"])
+        for basename in db_files:
             self.assertIn(basename, ls_pics)
 
         # Since we have already fetched everything, might as well return
@@ -258,6 +271,41 @@ class FileUploadTest(unittest.TestCase):
         later_db_pics, _ = self.assert_db_filesystem_integrity()
         self.assertEqual(len(orig_db_pics), len(later_db_pics))
 
+    def test_export_products(self):
+        # Whatever is in the database should come out in the export, in both
+        # formats, ordered by prod_id
+        for i in range(3):
+            post_product(f"Exported product {i}", 1.5, i, prod_descr = "Line 1\nLine, 2")
+
+        prods = self.select_products()
+
+        exported = [json.loads(line) for line in export_products("ndjson").splitlines()]
+        self.assertEqual([p["prod_id"] for p in exported], [p["prod_id"] for p in prods])
+
+        rows = list(csv.DictReader(io.StringIO(export_products("csv"))))
+        self.assertEqual([int(r["prod_id"]) for r in rows], [p["prod_id"] for p in prods])
+        self.assertEqual(rows[-1]["prod_descr"], "Line 1\nLine, 2")
+
+        # Same filters as the list
+        after = prods[0]["prod_id"]
+        exported = export_products("ndjson", f"&after={after}&limit=1").splitlines()
+        self.assertEqual(len(exported), 1)
+        self.assertEqual(json.loads(exported[0])["prod_id"], prods[1]["prod_id"])
+
+    def test_search_products(self):
+        _, prod_id = post_product("Rustic velvet waistcoat", 25, 3,
+            prod_descr = "Buttons made of genuine brass")
+        post_product("Plain shirt", 5, 3, prod_descr = "Nothing to see here")
+
+        for search in ["velvet waistcoat", "waistc", "brass buttons"]:
+            r = requests.get(URL + "/products/search", params = {"q": search})
+            check_status_code(r.status_code)
+            found = [p["prod_id"] for p in r.json()["products"]]
+            self.assertEqual(found, [prod_id])
+
+        r = requests.get(URL + "/products/search", params = {"q": "!!!"})
+        self.assertEqual(r.status_code, 400)
+
     def test_bulk_post_products(self):
         # Let's post a lot of products (without pics) and see how much time
         # it takes
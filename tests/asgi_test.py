@@ -0,0 +1,191 @@
+import asyncio, unittest
+from flask import Flask, Response, request
+
+import lib.asgi as asgi
+import lib.db as db
+from lib.db_async import AsyncDB, asyncpg
+from tests.test_common import *
+
+# The ASGI application is called directly, the way a server would, with a
+# small app of its own. Only AsyncDBTest needs the database
+
+async def call(app, method: str, path: str, body: bytes = b"", headers: list = None) -> dict:
+    """Sends a request to app, returns {"status", "headers", "body", "chunks"}"""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers or []],
+        "http_version": "1.1",
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 1234)
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    response = {"chunks": []}
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {name.decode(): value.decode() for name, value in message["headers"]}
+        elif message["body"]:
+            response["chunks"].append(message["body"])
+
+    await app(scope, receive, send)
+    response["body"] = b"".join(response["chunks"])
+    return response
+
+def make_app() -> asgi.App:
+    flask_app = Flask(__name__)
+
+    @flask_app.post("/echo")
+    def echo():
+        return request.get_data()
+
+    app = asgi.App(fallback = asgi.WsgiFallback(flask_app, threads = 2, max_body = 100))
+
+    @app.get("/items/<int:id>")
+    async def get_item(req, id):
+        return Response(f"{id} {req.args.get('q')}")
+
+    @app.get("/items/export")
+    async def export_items(req):
+        async def chunks():
+            for n in range(3):
+                yield f"{n}\n"
+        return asgi.StreamingResponse(chunks(), mimetype = "text/plain")
+
+    @app.get("/fail")
+    async def fail(req):
+        raise ValueError("boom")
+
+    return app
+
+class AsgiTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.app = make_app()
+
+    def test_compile_path(self):
+        regex = asgi.compile_path("/items/<int:id>/sizes/<int:size>")
+        self.assertEqual(regex.match("/items/12/sizes/3").groupdict(), {"id": "12", "size": "3"})
+        self.assertIsNone(regex.match("/items/x/sizes/3"))
+        self.assertIsNone(regex.match("/items/12/sizes/3/more"))
+
+    async def test_handler(self):
+        response = await call(self.app, "GET", "/items/42?q=hat", headers = [("X-Request-Id", "abc")])
+        printv(response)
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["body"], b"42 hat")
+        self.assertEqual(response["headers"]["x-request-id"], "abc")
+
+    async def test_head(self):
+        response = await call(self.app, "HEAD", "/items/42")
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["body"], b"")
+
+    async def test_streaming(self):
+        response = await call(self.app, "GET", "/items/export")
+        self.assertEqual(response["chunks"], [b"0\n", b"1\n", b"2\n"])
+        self.assertEqual(response["headers"]["content-type"], "text/plain; charset=utf-8")
+
+    async def test_error(self):
+        with self.assertLogs("lib.exceptions", "ERROR"):
+            response = await call(self.app, "GET", "/fail")
+        self.assertEqual(response["status"], 500)
+
+    async def test_fallback(self):
+        response = await call(self.app, "POST", "/echo", b"hello",
+            headers = [("Content-Type", "text/plain"), ("Content-Length", "5")])
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["body"], b"hello")
+
+        # Not found by the Flask app either
+        response = await call(self.app, "GET", "/nothing")
+        self.assertEqual(response["status"], 404)
+
+        # Too large for the fallback, whether the length is announced or not
+        response = await call(self.app, "POST", "/echo", b"x" * 101,
+            headers = [("Content-Length", "101")])
+        self.assertEqual(response["status"], 413)
+        response = await call(self.app, "POST", "/echo", b"x" * 101)
+        self.assertEqual(response["status"], 413)
+
+    async def test_without_fallback(self):
+        app = asgi.App()
+        response = await call(app, "GET", "/items/1")
+        self.assertEqual(response["status"], 404)
+
+@unittest.skipIf(asyncpg is None, "asyncpg is not installed")
+class AsyncDBTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # Products of our own, so the test does not depend on what is in the
+        # database
+        result = db.DB().query("""
+            INSERT INTO products (prod_name, prod_price, prod_instock)
+            SELECT 'AsyncDB test product ' || i, 100 + i, i
+            FROM GENERATE_SERIES(1, 5) AS i
+            RETURNING prod_id ;
+        """)
+        self.prod_ids = [prod_id for prod_id, in result.rows]
+
+    def tearDown(self):
+        db.DB().query("DELETE FROM products WHERE prod_id = ANY(%s) ;", (self.prod_ids,) )
+
+    async def asyncSetUp(self):
+        self.db = AsyncDB()
+        await self.db.start()
+
+    async def asyncTearDown(self):
+        await self.db.close()
+
+    async def test_same_as_db(self):
+        # Same query, with %s placeholders, gives the same rows as lib/db.py
+        query = """
+            SELECT prod_id, prod_name, prod_price, prod_created
+            FROM products
+            WHERE prod_id = ANY(%s)
+            ORDER BY prod_id ;
+        """
+        expected = db.DB().query(query, (self.prod_ids,) )
+        result = await self.db.query(query, (self.prod_ids,) )
+        printv(result.json())
+        self.assertEqual(len(result.rows), 5)
+        self.assertEqual(result.columns, expected.columns)
+        self.assertEqual([tuple(row) for row in result.rows], expected.rows)
+
+    async def test_empty_result(self):
+        # Columns are known even without rows
+        result = await self.db.query(
+            "SELECT prod_id, prod_name FROM products WHERE prod_id = %s ;", (-1,) )
+        self.assertEqual(result.rows, [])
+        self.assertEqual(result.columns, ("prod_id", "prod_name"))
+
+    async def test_statement(self):
+        statement = db.statement("asgi_test_count", "SELECT $1::bigint + 1 ;")
+        self.assertEqual((await self.db.query(statement, (41,) )).single(), 42)
+
+    async def test_stream(self):
+        rows = [row async for row in self.db.stream(
+            "SELECT n FROM GENERATE_SERIES(1, %s) AS n ;", (25,), fetch_size = 10)]
+        self.assertEqual([row[0] for row in rows], list(range(1, 26)))
+
+    async def test_stream_closed_early(self):
+        # The connection goes back to the pool when we stop reading
+        rows = self.db.stream("SELECT n FROM GENERATE_SERIES(1, 1000) AS n ;", fetch_size = 10)
+        async for row in rows:
+            break
+        await rows.aclose()
+        self.assertEqual(self.db.pool.get_idle_size(), self.db.pool.get_size())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import http.server, threading, unittest
+
+import lib.benchmark as benchmark
+from tests.test_common import *
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, as the benchmark expects
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status = 404 if self.path == "/missing" else 200
+        body = b"hello"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def make_summary(throughput: float, p50: float, p99: float, error_rate: float = 0.0) -> dict:
+    return {
+        "throughput": throughput,
+        "errorRate": error_rate,
+        "latencyMs": {"p50": p50, "p99": p99}
+    }
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile(values, 100), 100)
+        self.assertEqual(benchmark.percentile([7], 99), 7)
+        self.assertEqual(benchmark.percentile([], 50), 0.0)
+
+    def test_summarize(self):
+        summary = benchmark.summarize([0.001, 0.002, 0.003, 0.010], 1, {200: 3, 500: 1}, 2.0)
+        printv(summary)
+        self.assertEqual(summary["operations"], 4)
+        self.assertEqual(summary["errorRate"], 0.25)
+        self.assertEqual(summary["throughput"], 2.0)
+        self.assertAlmostEqual(summary["latencyMs"]["mean"], 4.0)
+        self.assertAlmostEqual(summary["latencyMs"]["p50"], 2.0)
+        self.assertAlmostEqual(summary["latencyMs"]["max"], 10.0)
+        self.assertEqual(summary["statuses"], {"200": 3, "500": 1})
+
+    def test_compare(self):
+        baseline = {"scenarios": {
+            "list": make_summary(1000, 5, 20),
+            "detail": make_summary(1000, 5, 20)
+        }}
+        current = {"scenarios": {
+            # Within the threshold
+            "list": make_summary(950, 5.4, 21),
+            # Slower, and failing
+            "detail": make_summary(800, 5, 30, error_rate = 0.05),
+            # Not in the baseline
+            "count": make_summary(1, 1000, 1000)
+        }}
+        regressions = benchmark.compare(baseline, current, 0.1)
+        printv(regressions)
+        self.assertEqual(
+            [(r["scenario"], r["metric"]) for r in regressions],
+            [("detail", "throughput"), ("detail", "latencyMs.p99"), ("detail", "errorRate")])
+        self.assertEqual(benchmark.compare(baseline, baseline, 0.1), [])
+
+    def test_run(self):
+        server = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+        thread = threading.Thread(target = server.serve_forever, daemon = True)
+        thread.start()
+        try:
+            def operation(session, rng):
+                session.request("GET", "/missing" if rng.random() < 0.2 else "/")
+
+            summary = benchmark.run("localhost", server.server_port, operation,
+                concurrency = 2, duration = 0.5, warmup = 0.1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        printv(summary)
+        self.assertGreater(summary["operations"], 10)
+        self.assertEqual(summary["errors"], summary["statuses"]["404"])
+        self.assertEqual(summary["operations"],
+            summary["statuses"]["200"] + summary["statuses"]["404"])
+        self.assertGreater(summary["latencyMs"]["p99"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
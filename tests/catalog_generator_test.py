@@ -0,0 +1,128 @@
+import hashlib, io, os, random, shutil, tempfile, unittest
+
+import lib.catalog_generator as catalog_generator
+import lib.db as db
+from lib.file_upload import pic_pillow
+from tests.test_common import *
+
+class CatalogGeneratorTest(unittest.TestCase):
+
+    def test_picture(self):
+        picture = catalog_generator.make_picture(1, 7, 64, 48)
+        self.assertTrue(picture.startswith(b"\x89PNG"))
+        self.assertEqual(picture, catalog_generator.make_picture(1, 7, 64, 48))
+        self.assertNotEqual(picture, catalog_generator.make_picture(1, 8, 64, 48))
+        self.assertNotEqual(picture, catalog_generator.make_picture(2, 7, 64, 48))
+
+        if pic_pillow:
+            from PIL import Image
+            with Image.open(io.BytesIO(picture)) as image:
+                image.load()
+                self.assertEqual(image.size, (64, 48))
+
+    def test_write_pictures(self):
+        folder = tempfile.mkdtemp()
+        try:
+            written = list(catalog_generator.write_pictures(5, 0, folder, (32, 32)))
+            self.assertEqual(len({md5 for md5, _, _ in written}), 5)
+            for md5, path, is_new in written:
+                self.assertTrue(is_new)
+                with open(path, "rb") as f:
+                    self.assertEqual(hashlib.md5(f.read()).hexdigest(), md5)
+
+            # Already there
+            again = list(catalog_generator.write_pictures(5, 0, folder, (32, 32)))
+            self.assertEqual([md5 for md5, _, _ in again], [md5 for md5, _, _ in written])
+            self.assertFalse(any(is_new for _, _, is_new in again))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_assign_pictures(self):
+        assigned, ref_counts = catalog_generator.assign_pictures(1000, 100, 0.5, seed = 3)
+        printv(ref_counts)
+
+        # 100 pictures, and as many duplicates
+        self.assertEqual(sum(ref_counts), 200)
+        self.assertEqual(sum(1 for picture in assigned if picture >= 0), 200)
+        self.assertTrue(all(count >= 1 for count in ref_counts))
+        self.assertGreater(max(ref_counts), 1)
+        for picture, count in enumerate(ref_counts):
+            self.assertEqual(assigned.count(picture), count)
+
+        self.assertEqual(catalog_generator.assign_pictures(1000, 100, 0.5, seed = 3),
+            (assigned, ref_counts))
+
+        # Without duplicates, every picture is used once
+        _, ref_counts = catalog_generator.assign_pictures(100, 100, 0, seed = 3)
+        self.assertEqual(ref_counts, [1] * 100)
+
+        with self.assertRaises(ValueError):
+            catalog_generator.assign_pictures(100, 60, 0.5, seed = 3)
+        with self.assertRaises(ValueError):
+            catalog_generator.assign_pictures(100, 10, 1, seed = 3)
+
+    def test_products(self):
+        assigned, _ = catalog_generator.assign_pictures(500, 20, 0.2, seed = 0)
+        pic_ids = list(range(1000, 1020))
+        rows = list(catalog_generator.generate_products(500, 0, pic_ids, assigned))
+        printv(rows[:3])
+        self.assertEqual(rows, list(catalog_generator.generate_products(500, 0, pic_ids, assigned)))
+
+        created = [row[5] for row in rows]
+        self.assertEqual(created, sorted(created))
+        self.assertGreaterEqual(created[0], catalog_generator.CREATED_FROM)
+        self.assertLess(created[-1], catalog_generator.CREATED_UNTIL)
+
+        for (name, descr, pic_id, price, in_stock, _), picture in zip(rows, assigned):
+            self.assertTrue(name and descr)
+            self.assertEqual(pic_id, pic_ids[picture] if picture >= 0 else None)
+            self.assertGreater(price, 0)
+            self.assertGreaterEqual(in_stock, 0)
+
+    def test_generate_catalog(self):
+        # Against the database, and cleaned up afterwards
+        database = db.DB()
+        folder = tempfile.mkdtemp()
+        last_prod_id = database.query("SELECT COALESCE(MAX(prod_id), 0) FROM products ;").single()
+        last_pic_id = database.query("SELECT COALESCE(MAX(pic_id), 0) FROM pics ;").single()
+        seed = random.randrange(2 ** 32)
+        try:
+            report = catalog_generator.generate_catalog(
+                database, 60, 10, duplication = 0.5, seed = seed,
+                upload_folder = folder, picture_size = (16, 16))
+            printv(report.as_dict())
+            self.assertEqual(report.products, 60)
+            self.assertEqual(report.pictures_added, 10)
+            self.assertEqual(report.files_written, 10)
+
+            # Reference counts are those fn_pic_upsert would have given
+            result = database.query("""
+                SELECT pics.pic_ref_count, COUNT(products.prod_id)
+                FROM pics
+                JOIN products
+                ON products.pic_id = pics.pic_id
+                WHERE pics.pic_id > %s
+                GROUP BY pics.pic_id ;
+            """, (last_pic_id,) )
+            self.assertEqual(len(result.rows), 10)
+            for ref_count, products in result.rows:
+                self.assertEqual(ref_count, products)
+            self.assertEqual(sum(products for _, products in result.rows), 20)
+
+            self.assertEqual(database.query(
+                "SELECT COUNT(*) FROM products WHERE prod_id > %s ;", (last_prod_id,) ).single(), 60)
+        finally:
+            # Pictures go away with their last product
+            database.query("""
+                SELECT fn_pic_decrease_ref_counts(ARRAY_AGG(pic_id))
+                FROM products
+                WHERE prod_id > %s ;
+            """, (last_prod_id,) )
+            database.query("DELETE FROM products WHERE prod_id > %s ;", (last_prod_id,) )
+            shutil.rmtree(folder)
+
+        self.assertEqual(database.query(
+            "SELECT COUNT(*) FROM pics WHERE pic_id > %s ;", (last_pic_id,) ).single(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -125,5 +125,46 @@ class FileUploadTest(unittest.TestCase):
         self.assertRegex(file_basename, self.get_filename_regex())
         self.tmp_files.append(file_path)
 
+    def test_save_pic_md5(self):
+        # MD5 hash is calculated while streaming, and must be the same as
+        # hashing the file afterwards
+        file = self.open_file("test_files/logo.png")
+        file_path, md5 = save_pic(file, rel_path("test_files"))
+        self.tmp_files.append(file_path)
+
+        self.assertTrue(file_path.endswith(".png"))
+        self.assertEqual(md5, file_utils.get_md5_hash(rel_path("test_files/logo.png")))
+        self.assertEqual(md5, file_utils.get_md5_hash(file_path))
+
+    def test_save_pic_not_a_pic(self):
+        files_before = sorted(os.listdir(rel_path("test_files")))
+        file = self.get_valid_file()
+        with self.assertRaisesRegex(Exception, "File is not an image!"):
+            save_pic(file, rel_path("test_files"))
+        self.assertListEqual(files_before, sorted(os.listdir(rel_path("test_files"))))
+
+    def test_save_pic_duplicate(self):
+        # If we already have the picture, nothing should be left on disk
+        files_before = sorted(os.listdir(rel_path("test_files")))
+        seen = []
+        def is_duplicate(md5):
+            seen.append(md5)
+            return True
+
+        file = self.open_file("test_files/logo.png")
+        file_path, md5 = save_pic(file, rel_path("test_files"), is_duplicate = is_duplicate)
+
+        self.assertIsNone(file_path)
+        self.assertListEqual(seen, [md5])
+        self.assertListEqual(files_before, sorted(os.listdir(rel_path("test_files"))))
+
+    def test_stream_file_large_file(self):
+        # Nothing, not even the temporary file, should be left behind
+        files_before = sorted(os.listdir(rel_path("test_files")))
+        file = self.get_large_file()
+        with self.assertRaisesRegex(Exception, "File is too large!"):
+            stream_file(file, rel_path("test_files"), max_size = FILE_MAX_SIZE)
+        self.assertListEqual(files_before, sorted(os.listdir(rel_path("test_files"))))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
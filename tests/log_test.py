@@ -0,0 +1,111 @@
+import io, json, logging, queue, unittest
+
+from lib.log import *
+from tests.test_common import *
+
+# Formatting, sampling and the queue behind logging. Neither the database nor
+# the server are needed
+
+def make_record(message: str = "Hello %s", args: tuple = ("world",), **extra) -> logging.LogRecord:
+    record = logging.LogRecord("tests", logging.WARNING, __file__, 1, message, args, None)
+    record.__dict__.update(extra)
+    return record
+
+class FormatterTest(unittest.TestCase):
+
+    def test_json(self):
+        try:
+            raise ValueError("boom")
+        except ValueError as err:
+            record = make_record(prodId = 42, request_id = "abc")
+            record.exc_info = (type(err), err, err.__traceback__)
+
+        data = json.loads(JsonFormatter().format(record))
+        printv(data)
+        self.assertEqual(data["message"], "Hello world")
+        self.assertEqual(data["level"], "WARNING")
+        self.assertEqual(data["requestId"], "abc")
+        self.assertEqual(data["prodId"], 42)
+        self.assertIn("ValueError: boom", data["exception"])
+
+    def test_text(self):
+        text = TextFormatter().format(make_record(prodId = 42, request_id = "abc"))
+        printv(text)
+        self.assertTrue(text.endswith("WARNING tests: Hello world [requestId=abc prodId=42]"))
+
+class SamplerTest(unittest.TestCase):
+
+    def test_sample(self):
+        sampler = Sampler(burst = 2, interval = 3600)
+        passed = [sampler.filter(make_record(sample = "event")) for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+
+        # Other events, and records that are not sampled, are not affected
+        self.assertTrue(sampler.filter(make_record(sample = "other")))
+        self.assertTrue(sampler.filter(make_record()))
+
+        # The next interval says how many were dropped
+        sampler.windows["event"][0] -= 3600
+        record = make_record(sample = "event")
+        self.assertTrue(sampler.filter(record))
+        self.assertEqual(record.sampledOut, 3)
+
+class QueueHandlerTest(unittest.TestCase):
+
+    def test_full(self):
+        handler = QueueHandler(queue.Queue(2))
+        for _ in range(5):
+            handler.handle(make_record())
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_request_id(self):
+        handler = QueueHandler(queue.Queue())
+        handler.addFilter(RequestIdFilter())
+
+        value = start_request("from-nginx")
+        handler.handle(make_record())
+        end_request()
+        handler.handle(make_record())
+
+        self.assertEqual(value, "from-nginx")
+        self.assertEqual(handler.queue.get().request_id, "from-nginx")
+        self.assertIsNone(handler.queue.get().request_id)
+        # Anything that does not look like an id is replaced
+        self.assertNotEqual(start_request("bad id\n"), "bad id\n")
+        end_request()
+
+class LoggingTest(unittest.TestCase):
+
+    def test_start(self):
+        output = io.StringIO()
+        logs = Logging()
+        logs.start(output)
+        try:
+            logging.getLogger("tests").warning("Written by %s", "the listener", extra = {"n": 1})
+        finally:
+            # Stopping writes what is left in the queue
+            logs.stop()
+
+        printv(output.getvalue())
+        data = json.loads(output.getvalue())
+        self.assertEqual(data["message"], "Written by the listener")
+        self.assertEqual(data["n"], 1)
+
+    def test_start_not_queued(self):
+        output = io.StringIO()
+        logs = Logging()
+        logs.start(output, queued = False)
+        try:
+            # Written before returning, with nothing to wait for
+            logging.getLogger("tests").warning("Written right away", extra = {"n": 2})
+            printv(output.getvalue())
+            data = json.loads(output.getvalue())
+            self.assertEqual(data["message"], "Written right away")
+            self.assertEqual(data["n"], 2)
+            self.assertEqual(logs.get_stats()["queued"], 0)
+        finally:
+            logs.stop()
+
+if __name__ == "__main__":
+    unittest.main()
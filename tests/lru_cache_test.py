@@ -0,0 +1,75 @@
+import threading, time, unittest
+
+from lib.lru_cache import *
+from tests.test_common import *
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(max_size = 2)
+        self.assertIs(cache.get("a"), LRUCache.MISSING)
+
+        cache.set("a", 1)
+        cache.set("b", None)
+        self.assertEqual(cache.get("a"), 1)
+
+        # None is a value like any other
+        self.assertIsNone(cache.get("b"))
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_eviction(self):
+        cache = LRUCache(max_size = 2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # "a" was used recently, so "b" is the one to go
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIs(cache.get("b"), LRUCache.MISSING)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(max_size = 2, ttl = 0.05)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertIs(cache.get("a"), LRUCache.MISSING)
+        self.assertEqual(cache.get_stats()["expirations"], 1)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        cache.invalidate("nonexistent")
+        self.assertIs(cache.get("a"), LRUCache.MISSING)
+        self.assertEqual(cache.get("b"), 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get_stats()["invalidations"], 2)
+
+    def test_threads(self):
+        cache = LRUCache(max_size = 10)
+
+        def worker(n):
+            for i in range(NUMBER_OF_TESTS):
+                cache.set((n, i % 20), i)
+                cache.get((n, (i + 1) % 20))
+
+        threads = [threading.Thread(target = worker, args = (n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(cache), 10)
+
+if __name__ == "__main__":
+    unittest.main()
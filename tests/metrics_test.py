@@ -0,0 +1,131 @@
+import io, json, os, subprocess, tempfile, unittest
+from wsgiref.util import FileWrapper
+
+from lib.histogram import Histogram
+from lib.metrics import *
+from tests.test_common import *
+
+# Prometheus metrics and the middleware that counts requests. Neither the
+# database nor the server are needed
+
+def app_ok(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"hello", b" world"]
+
+def app_error(environ, start_response):
+    raise RuntimeError("boom")
+
+class CollectionTest(unittest.TestCase):
+
+    def test_render(self):
+        collection = Collection()
+        collection.counter("requests_total", "Requests.", 3, {"route": "/a\"b"})
+        collection.gauge("in_flight", "In flight.", 2)
+        histogram = Histogram([0.1, 1.0])
+        histogram.observe(0.5)
+        collection.histogram("duration_seconds", "Duration.", histogram, {"route": "/"})
+
+        text = collection.render()
+        printv(text)
+        self.assertIn("# TYPE requests_total counter\n", text)
+        self.assertIn("requests_total{route=\"/a\\\"b\"} 3\n", text)
+        self.assertIn("in_flight 2\n", text)
+        self.assertIn("duration_seconds_bucket{route=\"/\",le=\"0.1\"} 0\n", text)
+        self.assertIn("duration_seconds_bucket{route=\"/\",le=\"1\"} 1\n", text)
+        self.assertIn("duration_seconds_bucket{route=\"/\",le=\"+Inf\"} 1\n", text)
+        self.assertIn("duration_seconds_count{route=\"/\"} 1\n", text)
+
+    def test_merge(self):
+        first, second = Collection(), Collection()
+        for collection in (first, second):
+            histogram = Histogram([1.0])
+            histogram.observe(0.5)
+            collection.counter("requests_total", "Requests.", 1, {"route": "/"})
+            collection.gauge("in_flight", "In flight.", 1)
+            collection.histogram("duration_seconds", "Duration.", histogram)
+
+        # Through JSON, as between processes
+        second = Collection.from_dict(json.loads(json.dumps(second.to_dict())))
+        first.merge(second, gauges = False)
+
+        self.assertEqual(first.families["requests_total"].samples[(("route", "/"),)], 2)
+        self.assertEqual(first.families["in_flight"].samples[()], 1)
+        self.assertEqual(first.families["duration_seconds"].samples[()].count, 2)
+
+class MiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+        self.metrics.__init__()
+
+    def call(self, app, environ = None):
+        environ = dict({"REQUEST_METHOD": "GET"}, **(environ or {}))
+        body = Middleware(app, self.metrics)(environ, lambda status, headers, exc_info = None: None)
+        data = b"".join(body)
+        # Servers close the body once it was sent, which finishes the request
+        self.assertEqual(self.metrics.in_flight, 1)
+        body.close()
+        return data
+
+    def test_request(self):
+        data = self.call(app_ok, {Middleware.ROUTE_KEY: "/products"})
+        self.assertEqual(data, b"hello world")
+        self.assertEqual(self.metrics.in_flight, 0)
+        self.assertEqual(self.metrics.requests, {("GET", "/products", "200"): 1})
+        self.assertEqual(self.metrics.sizes[("GET", "/products")].sum, 11)
+
+    def test_file_wrapper(self):
+        # Sent by the server as it is, and finished when it closes it
+        def app_file(environ, start_response):
+            start_response("200 OK", [("Content-Length", "11")])
+            return environ["wsgi.file_wrapper"](io.BytesIO(b"hello world"))
+
+        environ = {"REQUEST_METHOD": "GET", "wsgi.file_wrapper": FileWrapper}
+        body = Middleware(app_file, self.metrics)(environ, lambda status, headers, exc_info = None: None)
+        self.assertIs(type(body), FileWrapper)
+        self.assertEqual(self.metrics.in_flight, 1)
+        body.close()
+        body.close()
+        self.assertEqual(self.metrics.in_flight, 0)
+        self.assertEqual(self.metrics.requests, {("GET", Middleware.UNMATCHED, "200"): 1})
+        self.assertEqual(self.metrics.sizes[("GET", Middleware.UNMATCHED)].sum, 11)
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError):
+            Middleware(app_error, self.metrics)({"REQUEST_METHOD": "POST"}, None)
+        self.assertEqual(self.metrics.in_flight, 0)
+        self.assertEqual(self.metrics.requests, {("POST", Middleware.UNMATCHED, "500"): 1})
+
+class SnapshotWriterTest(unittest.TestCase):
+
+    def test_gather(self):
+        writer = SnapshotWriter()
+        saved = writer.directory
+        with tempfile.TemporaryDirectory() as directory:
+            writer.directory = directory
+            try:
+                # A process that exited: it does not count, and its file
+                # is removed
+                process = subprocess.Popen(["true"])
+                process.wait()
+                other = Collection()
+                other.counter("requests_total", "Requests.", 5)
+                other.gauge("in_flight", "In flight.", 3)
+                with open(writer.path(process.pid), "w") as f:
+                    json.dump({"pid": process.pid, "metrics": other.to_dict()}, f)
+
+                own = Collection()
+                own.counter("requests_total", "Requests.", 1)
+                own.gauge("in_flight", "In flight.", 1)
+                total = writer.gather(own)
+                self.assertFalse(os.path.exists(writer.path(process.pid)))
+            finally:
+                writer.directory = saved
+
+        printv(total.render())
+        self.assertEqual(total.families["requests_total"].samples[()], 1)
+        self.assertEqual(total.families["in_flight"].samples[()], 1)
+        self.assertEqual(total.families["michelangelo_processes"].samples[()], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+from lib.pagination import *
+import lib.exceptions as exceptions
+from tests.test_common import *
+
+class PaginationTest(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        for keys in ([1], [123456789012], ["2021-11-02T10:00:00", 42], [19.99, 7]):
+            with self.subTest(keys = keys):
+                token = encode_cursor(keys)
+                printv(f"{keys} -> {token}")
+                self.assertNotIn("=", token)
+                self.assertListEqual(decode_cursor(token), keys)
+
+    def test_cursor_invalid(self):
+        for token in ("", "not a cursor", encode_cursor([])[:-1], "e30"):
+            with self.subTest(token = token):
+                with self.assertRaises(exceptions.BadRequest):
+                    decode_cursor(token)
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit(None, 8), 8)
+        self.assertEqual(parse_limit("20", 8), 20)
+        self.assertEqual(parse_limit(str(MAX_LIMIT), 8), MAX_LIMIT)
+
+        for value in ("0", "-1", str(MAX_LIMIT + 1), "abc"):
+            with self.subTest(value = value):
+                with self.assertRaises(exceptions.BadRequest):
+                    parse_limit(value, 8)
+
+if __name__ == "__main__":
+    unittest.main()
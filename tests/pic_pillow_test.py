@@ -0,0 +1,122 @@
+import unittest, shutil
+
+from PIL import Image
+
+from lib.pic_pillow import *
+import lib.file_utils as file_utils
+from tests.test_common import *
+
+class PicPillowTest(unittest.TestCase):
+
+    # Processing replaces the original file, so we always work on a copy
+
+    tmp_files = []
+
+    def copy_file(self, path):
+        original = rel_path(path)
+        copy_path = os.path.join(os.path.dirname(original), file_utils.get_new_name())
+        shutil.copyfile(original, copy_path)
+        self.tmp_files.append(copy_path)
+        return copy_path
+
+    def tearDown(self):
+        printv("Removing temporary files")
+        for file in self.tmp_files:
+            if os.path.exists(file):
+                os.remove(file)
+        self.tmp_files.clear()
+
+    def test_sniff(self):
+        self.assertTupleEqual(sniff(rel_path("test_files/logo.png")), ("image", "png"))
+        self.assertTupleEqual(sniff(rel_path("test_files/bears.jpg")), ("image", "jpeg"))
+
+        # Extension should not matter
+        self.assertTupleEqual(sniff(rel_path("test_files/logo.txt")), ("image", "png"))
+
+        with self.assertRaisesRegex(Exception, "File is not a picture"):
+            sniff(rel_path("test_files/normal_file.txt"))
+
+    def test_get_pic_resolution(self):
+        self.assertTupleEqual(get_pic_resolution(rel_path("test_files/bears.jpg")), (1698, 1131))
+        self.assertTupleEqual(get_pic_resolution(rel_path("test_files/logo.png")), (120, 90))
+
+    def test_process_jpg(self):
+        path = self.copy_file("test_files/bears.jpg")
+        new_path = process(path, 800, print_stats = VERBOSE)
+        self.tmp_files.append(new_path)
+
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(new_path.endswith(".jpeg"))
+
+        # Same proportion (47%) as the subprocess version, see
+        # pic_utils_test.test_calculate_proportion
+        with Image.open(new_path) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertTupleEqual(img.size, (798, 531))
+            self.assertNotIn("exif", img.info)
+            self.assertNotIn("icc_profile", img.info)
+
+    def test_process_cmyk_jpg(self):
+        # Small enough to be kept as it is, but it has to be converted to RGB,
+        # so the original quantization tables cannot be reused
+        path = self.copy_file("test_files/bears.jpg")
+        with Image.open(path) as img:
+            img.resize((300, 200)).convert("CMYK").save(path, "JPEG")
+
+        new_path = process(path, 800, print_stats = VERBOSE)
+        self.tmp_files.append(new_path)
+
+        with Image.open(new_path) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(img.mode, "RGB")
+            self.assertTupleEqual(img.size, (300, 200))
+
+    def test_process_png(self):
+        # A large PNG photograph is smaller as a JPEG
+        path = self.copy_file("test_files/bears_png.png")
+        new_path = process(path, 800, print_stats = VERBOSE)
+        self.tmp_files.append(new_path)
+
+        with Image.open(new_path) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertTupleEqual(img.size, (798, 531))
+
+    def test_process_small_png(self):
+        # Small logo with transparency, nothing to resize, and PNG is smaller
+        # than JPEG
+        path = self.copy_file("test_files/logo.png")
+        new_path = process(path, 800, print_stats = VERBOSE)
+        self.tmp_files.append(new_path)
+
+        self.assertTrue(new_path.endswith(".png"))
+        with Image.open(new_path) as img:
+            self.assertTupleEqual(img.size, (120, 90))
+
+    def test_process_not_a_pic(self):
+        path = self.copy_file("test_files/normal_file.txt")
+        with self.assertRaisesRegex(Exception, "Cannot process file, it is not a picture"):
+            process(path)
+
+    def test_make_variants(self):
+        path = self.copy_file("test_files/bears.jpg")
+        new_path = process(path, 600)
+        self.tmp_files.append(new_path)
+
+        # 800 is wider than the picture, so it should be skipped
+        variants = make_variants(new_path, [160, 320, 800], ["jpeg", "webp"])
+        self.tmp_files.extend(variant[2] for variant in variants)
+
+        self.assertListEqual(
+            [(width, subtype) for width, subtype, _, _ in variants],
+            [(160, "jpeg"), (160, "webp"), (320, "jpeg"), (320, "webp")])
+
+        for width, subtype, variant_path, size in variants:
+            with self.subTest(width = width, subtype = subtype):
+                self.assertTrue(variant_path.endswith(f"-{width}.{subtype}"))
+                self.assertEqual(os.path.getsize(variant_path), size)
+                with Image.open(variant_path) as img:
+                    self.assertEqual(img.size[0], width)
+                    self.assertEqual(img.format, subtype.upper())
+
+if __name__ == "__main__":
+    unittest.main()
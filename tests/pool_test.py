@@ -0,0 +1,113 @@
+import threading, time, unittest
+
+from lib.pool import *
+from tests.test_common import *
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection, so we do not need a database"""
+    def __init__(self):
+        self.closed = False
+        self.healthy = True
+
+    def close(self):
+        self.closed = True
+
+class PoolTest(unittest.TestCase):
+
+    def get_pool(self, **kwargs):
+        self.created = []
+
+        def connect():
+            conn = FakeConnection()
+            self.created.append(conn)
+            return conn
+
+        return ConnectionPool(
+            connect,
+            is_healthy = lambda conn: conn.healthy,
+            **kwargs)
+
+    def test_min_size(self):
+        pool = self.get_pool(min_size = 3, max_size = 5)
+        self.assertEqual(len(self.created), 3)
+        self.assertEqual(pool.get_stats()["idle"], 3)
+
+    def test_invalid_size(self):
+        with self.assertRaisesRegex(ValueError, "Invalid pool size!"):
+            self.get_pool(min_size = 3, max_size = 2)
+
+    def test_reuse(self):
+        pool = self.get_pool(min_size = 0, max_size = 2)
+        conn_1 = pool.getconn()
+        pool.putconn(conn_1)
+        conn_2 = pool.getconn()
+        self.assertIs(conn_1, conn_2)
+        self.assertEqual(len(self.created), 1)
+
+    def test_timeout(self):
+        pool = self.get_pool(min_size = 0, max_size = 1, timeout = 0.05)
+        conn = pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        self.assertEqual(pool.get_stats()["timeouts"], 1)
+        pool.putconn(conn)
+
+    def test_wait_for_connection(self):
+        # A thread holding the only connection returns it after a while. The
+        # main thread should get it, and the wait should show up in the stats
+        pool = self.get_pool(min_size = 1, max_size = 1, timeout = 2)
+        conn = pool.getconn()
+
+        def give_back():
+            time.sleep(0.1)
+            pool.putconn(conn)
+
+        thread = threading.Thread(target = give_back)
+        thread.start()
+        self.assertIs(pool.getconn(), conn)
+        thread.join()
+
+        stats = pool.get_stats()
+        printv(stats)
+        self.assertGreater(stats["waitTimeMax"], 0.05)
+        self.assertEqual(stats["inUse"], 1)
+
+    def test_reconnect(self):
+        pool = self.get_pool(min_size = 1, max_size = 1, health_check_interval = 0)
+        self.created[0].healthy = False
+        conn = pool.getconn()
+        self.assertIsNot(conn, self.created[0])
+        self.assertTrue(self.created[0].closed)
+        self.assertEqual(pool.get_stats()["reconnects"], 1)
+
+    def test_discard(self):
+        pool = self.get_pool(min_size = 0, max_size = 1, timeout = 0.05)
+        conn = pool.getconn()
+        pool.putconn(conn, discard = True)
+        self.assertTrue(conn.closed)
+
+        # Slot must have been released
+        self.assertIsNot(pool.getconn(), conn)
+
+    def test_concurrency(self):
+        pool = self.get_pool(min_size = 0, max_size = 4, timeout = 5)
+        max_in_use = []
+
+        def worker():
+            for _ in range(NUMBER_OF_TESTS):
+                conn = pool.getconn()
+                max_in_use.append(pool.get_stats()["inUse"])
+                pool.putconn(conn)
+
+        threads = [threading.Thread(target = worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(max(max_in_use), 4)
+        self.assertLessEqual(len(self.created), 4)
+        self.assertEqual(pool.get_stats()["inUse"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
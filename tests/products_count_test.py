@@ -0,0 +1,73 @@
+import unittest
+
+import lib.db as db
+from api.products import estimate_rows
+from tests.test_common import *
+
+# Checks that the triggers from sql/06-products-count.sql keep products_count
+# equal to COUNT(*), whatever way rows come and go. This needs the database,
+# but the server does not need to be running. Everything happens in a
+# transaction that is rolled back.
+
+class ProductsCountTest(unittest.TestCase):
+    db = db.DB()
+
+    def assert_count(self, cur):
+        cur.execute("SELECT prod_count FROM products_count ;")
+        counter = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM products ;")
+        actual = cur.fetchone()[0]
+        printv(f"counter = {counter}, actual = {actual}")
+        self.assertEqual(counter, actual)
+
+    def test_triggers(self):
+        with self.db.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cur:
+                    self.assert_count(cur)
+
+                    # A single row, then a bulk insert
+                    cur.execute("""
+                        INSERT INTO products (prod_name, prod_price, prod_instock)
+                        VALUES ('Test product', 100, 1) ;
+                    """)
+                    self.assert_count(cur)
+
+                    cur.execute("""
+                        INSERT INTO products (prod_name, prod_price, prod_instock)
+                        SELECT 'Test product ' || i, 100 + i, i % 3
+                        FROM GENERATE_SERIES(1, 500) AS i ;
+                    """)
+                    self.assert_count(cur)
+
+                    # Updates do not change the count
+                    cur.execute("""
+                        UPDATE products SET prod_instock = 0
+                        WHERE prod_name LIKE 'Test product%' ;
+                    """)
+                    self.assert_count(cur)
+
+                    cur.execute("""
+                        DELETE FROM products
+                        WHERE prod_name LIKE 'Test product 1%' ;
+                    """)
+                    self.assert_count(cur)
+
+                    # A statement touching no rows at all
+                    cur.execute("DELETE FROM products WHERE prod_id < 0 ;")
+                    self.assert_count(cur)
+
+                    cur.execute("TRUNCATE products CASCADE ;")
+                    self.assert_count(cur)
+            finally:
+                conn.rollback()
+                conn.autocommit = True
+
+    def test_estimate_rows(self):
+        plan = [{"Plan": {"Node Type": "Seq Scan", "Plan Rows": 1234}}]
+        self.assertEqual(estimate_rows(plan), 1234)
+        self.assertEqual(estimate_rows('[{"Plan": {"Plan Rows": 5}}]'), 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import io, os, shutil, tempfile, unittest
+
+from lib.products_import import *
+import lib.exceptions as exceptions
+import lib.validation as validation
+from tests.test_common import *
+
+class ValidationTest(unittest.TestCase):
+
+    def test_valid(self):
+        fields = validation.validate_product_fields({
+            "prodName": "Monocle",
+            "prodPrice": "34.5",
+            "prodInStock": "1",
+            "md5": "a" * 32
+        })
+        self.assertEqual(fields, ("Monocle", None, 3450, 1, "a" * 32))
+
+    def test_invalid(self):
+        invalid = [
+            {"prodPrice": "1", "prodInStock": "1"},
+            {"prodName": "", "prodPrice": "1", "prodInStock": "1"},
+            {"prodName": "x", "prodPrice": "abc", "prodInStock": "1"},
+            {"prodName": "x", "prodPrice": "inf", "prodInStock": "1"},
+            {"prodName": "x", "prodPrice": "0", "prodInStock": "1"},
+            {"prodName": "x", "prodPrice": "1", "prodInStock": "-1"},
+            {"prodName": "x", "prodPrice": "1", "prodInStock": "1", "md5": "abc"}
+        ]
+        for data in invalid:
+            with self.assertRaises(exceptions.BadRequest):
+                validation.validate_product_fields(data)
+
+class ProductsImportTest(unittest.TestCase):
+
+    def test_detect_format(self):
+        self.assertEqual(detect_format("products.CSV"), FORMAT_CSV)
+        self.assertEqual(detect_format("products.ndjson"), FORMAT_NDJSON)
+        self.assertIsNone(detect_format("products.txt"))
+
+    def test_csv_rows(self):
+        lines = io.StringIO(
+            "prodName,prodPrice,prodInStock,prodDescr\n"
+            "Hat,1.50,3,\n"
+            "\"Long\ndress\",2,0,Nice\n"
+            ",1,1,\n")
+        report = ImportReport()
+        rows = list(validated_rows(lines, FORMAT_CSV, report))
+
+        self.assertEqual(rows, [
+            (2, "Hat", None, None, 150, 3),
+            (4, "Long\ndress", "Nice", None, 200, 0)
+        ])
+        self.assertEqual(report.read, 3)
+        self.assertEqual(report.rejected, 1)
+        self.assertEqual(report.errors[0][0], 5)
+
+    def test_ndjson_rows(self):
+        lines = [
+            '{"prodName": "Hat", "prodPrice": 1.5, "prodInStock": 3}\n',
+            '\n',
+            'not json\n',
+            '[1, 2]\n',
+            '{"prodName": "Cape", "prodPrice": 9, "prodInStock": 1, "picture": "x.jpg"}\n'
+        ]
+        report = ImportReport()
+        rows = list(validated_rows(lines, FORMAT_NDJSON, report))
+
+        self.assertEqual(rows, [(1, "Hat", None, None, 150, 3)])
+        self.assertEqual([line for line, _ in report.errors], [3, 4, 5])
+
+    def test_copy_stream(self):
+        rows = [
+            (1, "tab\there", None),
+            (2, "back\\slash\nnewline", "ok")
+        ]
+        data = ""
+        stream = CopyStream(rows)
+        while True:
+            chunk = stream.read(5)
+            if not chunk:
+                break
+            data += chunk
+
+        self.assertEqual(data,
+            "1\ttab\\there\t\\N\n"
+            "2\tback\\\\slash\\nnewline\tok\n")
+
+    def test_picture_dir(self):
+        pictures = rel_path("test_files")
+        uploads = tempfile.mkdtemp()
+        try:
+            picture_dir = PictureDir(pictures, uploads)
+            md5 = picture_dir.add("bears.jpg")
+            self.assertEqual(picture_dir.add("bears.jpg"), md5)
+
+            with self.assertRaises(exceptions.BadRequest):
+                picture_dir.add("normal_file.txt")
+            with self.assertRaises(exceptions.BadRequest):
+                picture_dir.add("nonexistent.jpg")
+            with self.assertRaises(exceptions.BadRequest):
+                picture_dir.add("../test_common.py")
+
+            # Pictures we already have are not copied
+            self.assertEqual(picture_dir.copy_missing({md5}), [])
+
+            copied = picture_dir.copy_missing(set())
+            self.assertEqual(len(copied), 1)
+            self.assertEqual(copied[0][0], md5)
+            self.assertTrue(copied[0][1].endswith(".jpeg"))
+            self.assertTrue(os.path.isfile(copied[0][1]))
+        finally:
+            shutil.rmtree(uploads)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import json, unittest
+
+import lib.db as db
+import lib.pagination as pagination
+from lib.product_query import *
+from api.products import PRODUCT_COLUMNS
+from tests.test_common import *
+
+# Checks that the queries built by ProductQuery are answered by reading the
+# right index in order, without sorting. This needs the database (with
+# sql/05-products-sort.sql applied), but the server does not need to be
+# running. Test products are inserted in a transaction that is rolled back.
+
+N_PRODUCTS = 20000
+
+class QueryPlanTest(unittest.TestCase):
+    db = db.DB()
+
+    def get_plan(self, cur, args: dict) -> dict:
+        query, query_args = ProductQuery(args).select(PRODUCT_COLUMNS, limit = 21)
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, query_args)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
+    def get_nodes(self, plan: dict) -> list:
+        nodes = [plan]
+        for child in plan.get("Plans", []):
+            nodes.extend(self.get_nodes(child))
+        return nodes
+
+    def assert_index_order(self, cur, args: dict, index: str):
+        nodes = self.get_nodes(self.get_plan(cur, args))
+        printv(f"{args}: {[(n['Node Type'], n.get('Index Name')) for n in nodes]}")
+
+        self.assertNotIn("Sort", [node["Node Type"] for node in nodes], args)
+        self.assertIn(index, [node.get("Index Name") for node in nodes
+            if node["Node Type"] in ("Index Scan", "Index Only Scan")], args)
+
+    def test_query_plans(self):
+        cases = [
+            ({}, "products_pkey"),
+            ({"after": "100"}, "products_pkey"),
+            ({"order": "desc", "in_stock": "1"}, "products_pkey"),
+            ({"sort": "price"}, "products_price_idx"),
+            ({"sort": "price", "order": "desc"}, "products_price_idx"),
+            ({"sort": "price", "min_price": "500", "max_price": "900"}, "products_price_idx"),
+            ({"sort": "price", "in_stock": "1"}, "products_price_idx"),
+            ({"sort": "price", "cursor": pagination.encode_cursor([5000, 10])}, "products_price_idx"),
+            ({"sort": "created", "order": "desc"}, "products_created_idx"),
+            ({"sort": "created", "created_after": "2021-11-01"}, "products_created_idx"),
+            ({"sort": "name"}, "products_name_idx"),
+            ({"sort": "name", "order": "desc",
+                "cursor": pagination.encode_cursor(["Test product 5", 10])}, "products_name_idx")
+        ]
+
+        with self.db.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cur:
+                    # With an almost empty table, reading everything and
+                    # sorting is the best plan, so we need some rows
+                    cur.execute("""
+                        INSERT INTO products
+                        (
+                            prod_name,
+                            prod_price,
+                            prod_instock,
+                            prod_created
+                        )
+                        SELECT
+                            'Test product ' || i,
+                            100 + i %% 10000,
+                            i %% 5,
+                            NOW() - i * INTERVAL '1 minute'
+                        FROM GENERATE_SERIES(1, %s) AS i ;
+
+                        ANALYZE products ;
+                    """, (N_PRODUCTS,) )
+
+                    for args, index in cases:
+                        with self.subTest(args = args):
+                            self.assert_index_order(cur, args, index)
+            finally:
+                conn.rollback()
+                conn.autocommit = True
+
+class ProductQueryTest(unittest.TestCase):
+
+    def test_where(self):
+        query = ProductQuery({"min_price": "100", "in_stock": "1", "sort": "price",
+            "order": "desc", "cursor": pagination.encode_cursor([300, 7])})
+        where, args = query.where()
+        self.assertEqual(where, "WHERE prod_price >= %s::bigint AND prod_instock > 0 " +
+            "AND (prod_price, prod_id) < (%s, %s::bigint)")
+        self.assertEqual(args, (100, 300, 7))
+
+        # Keyset is ignored when paginating with OFFSET
+        where, args = query.where(keyset = False)
+        self.assertEqual(args, (100,))
+
+    def test_next_cursor(self):
+        query = ProductQuery({"sort": "created"})
+        row = {"prod_id": 3, "prod_created": dt.datetime(2021, 11, 5, 12, 30, 0, 15)}
+        cursor = query.next_cursor(row)
+
+        # Whatever we give must be understood when it comes back
+        query = ProductQuery({"sort": "created", "cursor": cursor})
+        self.assertEqual(query.after, [row["prod_created"], 3])
+
+    def test_invalid(self):
+        invalid = [
+            {"sort": "prod_price; DROP TABLE products"},
+            {"order": "sideways"},
+            {"max_price": "-1"},
+            {"in_stock": "yes please"},
+            {"created_after": "tomorrow"},
+            {"sort": "name", "after": "3"},
+            {"sort": "name", "cursor": pagination.encode_cursor([3, 3])},
+            {"sort": "created", "cursor": pagination.encode_cursor(["x", 3])}
+        ]
+        for args in invalid:
+            with self.assertRaises(exceptions.BadRequest, msg = args):
+                ProductQuery(args)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import lib.db as db
+from lib.histogram import Histogram
+from lib.query_stats import *
+from tests.test_common import *
+
+# Histograms and statement counters. The last test needs the database, but
+# the server does not need to be running
+
+class HistogramTest(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram([0.1, 1.0])
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        # Bounds are inclusive, like Prometheus' "le"
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1.0, 3), (float("inf"), 4)])
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 1.0)
+        self.assertEqual(histogram.quantile(0.99), 1.0)
+        self.assertEqual(histogram.as_dict()["buckets"]["+Inf"], 4)
+
+    def test_merge(self):
+        first, second = Histogram([1.0]), Histogram([1.0])
+        first.observe(0.5)
+        second.observe(5.0)
+        first.merge(second)
+        self.assertEqual(first.cumulative(), [(1.0, 1), (float("inf"), 2)])
+
+        with self.assertRaises(ValueError):
+            first.merge(Histogram([2.0]))
+
+    def test_empty(self):
+        self.assertEqual(Histogram().quantile(0.99), 0.0)
+
+class QueryStatsTest(unittest.TestCase):
+    stats = QueryStats()
+
+    def setUp(self):
+        self.stats.reset()
+
+    def test_get_key(self):
+        self.assertEqual(get_key("EXECUTE select_product (%s) ;"), "select_product")
+        self.assertEqual(get_key("PREPARE select_product (bigint) AS SELECT 1 ;"),
+            "select_product (prepare)")
+        self.assertEqual(get_key(b"  SELECT *\n    FROM products\n  WHERE prod_id = %s ;"),
+            "SELECT * FROM products WHERE prod_id = %s ;")
+
+    def test_record(self):
+        self.stats.record("SELECT 1 ;", 0.002, 1)
+        self.stats.record("SELECT  1 ;", 0.004, 1)
+        self.stats.record("SELECT 1 ;", 0.1, 0, error = True)
+
+        statements = self.stats.get_stats()["statements"]
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(statements[0]["calls"], 3)
+        self.assertEqual(statements[0]["errors"], 1)
+        self.assertEqual(statements[0]["rows"], 2)
+
+    def test_too_many_statements(self):
+        for i in range(QueryStats.MAX_STATEMENTS + 10):
+            self.stats.record(f"SELECT {i} ;", 0.001, 1)
+        statements = {s["statement"]: s for s in self.stats.get_stats()["statements"]}
+        self.assertEqual(len(statements), QueryStats.MAX_STATEMENTS + 1)
+        self.assertEqual(statements[OTHER]["calls"], 10)
+
+    def test_slow_query(self):
+        database = db.DB()
+        saved = self.stats.slow_query_time
+        self.stats.slow_query_time = 1e-9
+        try:
+            with self.assertLogs("lib.query_stats", "WARNING") as logs:
+                database.query("SELECT %s::int + 1 AS answer ;", (41,))
+                # Explained only once in a while
+                database.query("SELECT %s::int + 1 AS answer ;", (41,))
+        finally:
+            self.stats.slow_query_time = saved
+
+        printv(logs.output)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("SELECT 41::int + 1", logs.records[0].getMessage())
+        self.assertIn("Result", logs.records[0].plan[0])
+
+        stats = self.stats.get_stats()
+        statements = {s["statement"]: s for s in stats["statements"]}
+        self.assertEqual(stats["slowQueries"], 2)
+        self.assertEqual(statements["SELECT %s::int + 1 AS answer ;"]["rows"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
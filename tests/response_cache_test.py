@@ -0,0 +1,124 @@
+import gzip, time, unittest
+from flask import Flask, jsonify
+
+import lib.db as db
+from lib.response_cache import *
+from tests.test_common import *
+
+# The cache is tested with a small Flask app of its own, whose views count
+# how many times they actually ran. Only the notification test needs the
+# database (with sql/07-products-notify.sql applied)
+
+class ResponseCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.cache = ResponseCache()
+        cls.calls = []
+        app = Flask(__name__)
+
+        @app.get("/items")
+        @cls.cache.cached()
+        def get_items():
+            cls.calls.append("list")
+            return jsonify([{"name": "x" * 100}] * 20)
+
+        @app.get("/items/<int:id>")
+        @cls.cache.cached(id_arg = "id")
+        def get_item(id):
+            cls.calls.append(id)
+            if id == 404:
+                return jsonify({}), 404
+            return jsonify({"id": id})
+
+        cls.client = app.test_client()
+
+    def setUp(self):
+        self.cache.invalidate()
+        self.calls.clear()
+
+    def test_hit(self):
+        first = self.client.get("/items?b=2&a=1")
+        second = self.client.get("/items?a=1&b=2")
+        self.assertEqual(first.headers["X-Cache"], "MISS")
+        self.assertEqual(second.headers["X-Cache"], "HIT")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(self.calls, ["list"])
+
+        # Different parameters, different entry
+        self.client.get("/items?a=2")
+        self.assertEqual(self.calls, ["list", "list"])
+
+    def test_gzip_and_etag(self):
+        plain = self.client.get("/items")
+        compressed = self.client.get("/items", headers = {"Accept-Encoding": "gzip"})
+        self.assertEqual(compressed.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+        self.assertIn("Accept-Encoding", compressed.headers["Vary"])
+
+        response = self.client.get("/items",
+            headers = {"If-None-Match": plain.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+        # Small bodies are sent as they are
+        small = self.client.get("/items/1", headers = {"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", small.headers)
+
+    def test_errors_not_cached(self):
+        response = self.client.get("/items/404")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/items/404")
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("X-Cache", response.headers)
+        self.assertEqual(self.calls, [404, 404])
+
+    def test_invalidate(self):
+        for url in ["/items", "/items/1", "/items/2"]:
+            self.client.get(url)
+
+        # A product changed: lists and that product are dropped
+        self.cache.invalidate([1])
+        for url in ["/items", "/items/1", "/items/2"]:
+            self.client.get(url)
+        self.assertEqual(self.calls, ["list", 1, 2, "list", 1])
+
+        # Nobody knows what changed: everything is dropped
+        self.cache.invalidate()
+        self.client.get("/items/2")
+        self.assertEqual(self.calls[-1], 2)
+
+    def test_parse_payload(self):
+        self.assertEqual(parse_payload("1,22,333"), [1, 22, 333])
+        self.assertEqual(parse_payload(""), [])
+        self.assertIsNone(parse_payload(ALL_PRODUCTS))
+        self.assertIsNone(parse_payload("1,oops"))
+
+    def test_notification(self):
+        database = db.DB()
+        invalidations = self.cache.get_stats()["invalidations"]
+        self.cache.listen(database.connect)
+
+        # Waiting for the listener to connect, it drops everything once it
+        # is listening
+        deadline = time.monotonic() + 5
+        while self.cache.get_stats()["invalidations"] == invalidations:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        self.client.get("/items/7")
+        self.client.get("/items/8")
+        database.query("SELECT pg_notify(%s, %s) ;", (CHANNEL, "7"))
+
+        deadline = time.monotonic() + 5
+        while self.cache.get_stats()["notifications"] == 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        self.client.get("/items/7")
+        self.client.get("/items/8")
+        printv(f"calls: {self.calls}")
+        self.assertEqual(self.calls, [7, 8, 7])
+        self.cache.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import datetime as dt, decimal, importlib, sys, unittest, uuid
+from collections import namedtuple
+from flask import Flask, jsonify
+
+import lib.serialize as serialize
+from lib.db import QueryResult
+from tests.test_common import *
+
+# lib/serialize.py must give exactly what jsonify gives, with or without
+# orjson
+
+VALUES = [
+    [],
+    {"b": 1, "a": [1.5, None, True, "text"]},
+    {"naive": dt.datetime(2021, 11, 5, 12, 30, 15, 999)},
+    {"aware": dt.datetime(2021, 11, 5, 12, 30, tzinfo = dt.timezone(dt.timedelta(hours = -3)))},
+    {"utc": dt.datetime(2000, 2, 29, 23, 59, 59, tzinfo = dt.timezone.utc)},
+    {"date": dt.date(1999, 12, 31)},
+    {"price": decimal.Decimal("10.50"), "id": uuid.UUID(int = 1)},
+    [{"nested": [{"deep": dt.datetime(2021, 1, 1)}]}]
+]
+
+class SerializeTest(unittest.TestCase):
+    app = Flask(__name__)
+
+    def assert_same_as_jsonify(self, module):
+        with self.app.app_context():
+            for value in VALUES:
+                with self.subTest(value = value):
+                    expected = jsonify(value).get_data()
+                    self.assertEqual(module.response(value).get_data(), expected)
+
+    def test_jsonify(self):
+        self.assert_same_as_jsonify(serialize)
+
+    def test_without_orjson(self):
+        # Blocking the import, the module falls back to the standard library
+        saved = sys.modules.get("orjson")
+        sys.modules["orjson"] = None
+        try:
+            fallback = importlib.reload(serialize)
+            self.assertIsNone(fallback.orjson)
+            self.assert_same_as_jsonify(fallback)
+        finally:
+            if saved is None:
+                del sys.modules["orjson"]
+            else:
+                sys.modules["orjson"] = saved
+            importlib.reload(serialize)
+
+    def test_rows(self):
+        columns = ("id", "created")
+        rows = [(1, dt.datetime(2021, 11, 5)), (2, None)]
+        labeled = [dict(zip(columns, row)) for row in rows]
+
+        with self.app.app_context():
+            self.assertEqual(
+                serialize.rows_response(columns, rows).get_data(),
+                jsonify(labeled).get_data())
+
+        lines = serialize.dumps_lines(columns, rows).split(b"\n")
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1], serialize.dumps(labeled[1]))
+        self.assertEqual(lines[2], b"")
+
+class QueryResultTest(unittest.TestCase):
+    Column = namedtuple("Column", "name")
+
+    def get_result(self, rows: list) -> QueryResult:
+        descr = (self.Column("prod_id"), self.Column("prod_name"))
+        return QueryResult("SELECT", descr, len(rows), rows)
+
+    def test_labels(self):
+        result = self.get_result([(1, "foo"), (2, "bar")])
+        self.assertEqual(result.columns, ("prod_id", "prod_name"))
+        self.assertEqual(result.index("prod_name"), 1)
+        self.assertEqual(result.json(), [
+            {"prod_id": 1, "prod_name": "foo"},
+            {"prod_id": 2, "prod_name": "bar"}])
+        self.assertIs(result.json(), result.json())
+
+        named = result.named()
+        self.assertEqual(named[1].prod_name, "bar")
+        self.assertEqual(tuple(named[0]), (1, "foo"))
+
+    def test_empty(self):
+        result = self.get_result([])
+        self.assertEqual(result.json(), [])
+        self.assertIs(result.json(), result.json())
+        self.assertEqual(result.named(), [])
+
+        # Statements without rows, e.g. UPDATE
+        result = QueryResult("UPDATE 1", None, 1, None)
+        self.assertEqual(result.json(), [])
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            self.get_result([]).whatever = 1
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os, signal, socket, subprocess, sys, time, unittest
+import urllib.request
+
+from tests.test_common import *
+
+# The preforking server, with an app that only says which process answered.
+# Neither the database nor the app's server are needed
+
+PORT = 7811
+
+SCRIPT = f"""
+import os
+from lib.server import Server
+
+def app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid()).encode()]
+
+Server().serve(app, "localhost", {PORT}, lambda: None)
+"""
+
+def get() -> str:
+    with urllib.request.urlopen(f"http://localhost:{PORT}/", timeout = 5) as response:
+        return response.read().decode()
+
+def wait_for_server():
+    for _ in range(50):
+        try:
+            with socket.create_connection(("localhost", PORT), timeout = 1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("Server did not start")
+
+class ServerTest(unittest.TestCase):
+
+    def start(self, workers: int) -> subprocess.Popen:
+        env = dict(os.environ, WEB_WORKERS = str(workers), WEB_GRACEFUL_TIMEOUT = "5")
+        process = subprocess.Popen([sys.executable, "-c", SCRIPT], env = env)
+        wait_for_server()
+        return process
+
+    def test_workers(self):
+        master = self.start(2)
+        try:
+            pids = {get() for _ in range(50)}
+            printv(pids)
+            self.assertNotIn(str(master.pid), pids)
+
+            # A worker that dies is replaced
+            os.kill(int(pids.pop()), signal.SIGKILL)
+            time.sleep(1.5)
+            self.assertTrue(get())
+        finally:
+            master.send_signal(signal.SIGTERM)
+            self.assertEqual(master.wait(timeout = 15), 0)
+
+        with self.assertRaises(OSError):
+            get()
+
+    def test_single_process(self):
+        process = self.start(1)
+        try:
+            self.assertEqual(get(), str(process.pid))
+        finally:
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(timeout = 15), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import lib.db as db
+from lib.db import Statement, statement, prepared
+from tests.test_common import *
+
+# Statement registry and prepared statements (lib/db.py). The last tests need
+# the database, but the server does not need to be running
+
+class StatementTest(unittest.TestCase):
+
+    def test_sql(self):
+        st = Statement("test_select", """
+            SELECT prod_name
+            FROM products
+            WHERE prod_id = $1 AND prod_price > $2 ;
+        """, ["bigint", "bigint"])
+        self.assertTrue(st.prepare_sql.startswith("PREPARE test_select (bigint, bigint) AS SELECT"))
+        self.assertEqual(st.execute_sql, "EXECUTE test_select (%s, %s) ;")
+
+        st = Statement("test_no_params", "SELECT 1 ;")
+        self.assertEqual(st.prepare_sql, "PREPARE test_no_params AS SELECT 1 ;")
+        self.assertEqual(st.execute_sql, "EXECUTE test_no_params ;")
+
+    def test_invalid_name(self):
+        with self.assertRaises(ValueError):
+            Statement("drop table products; --", "SELECT 1")
+
+    def test_declare_twice(self):
+        first = statement("test_twice", "SELECT $1 ;", ["int"])
+        self.assertIs(statement("test_twice", "SELECT $1 ;", ["int"]), first)
+        with self.assertRaises(ValueError):
+            statement("test_twice", "SELECT $1 + 1 ;", ["int"])
+
+    def test_prepared(self):
+        st = prepared("SELECT %s::int, 'a' LIKE 'a%%' LIMIT %s ;")
+        self.assertEqual(st.sql, "SELECT $1::int, 'a' LIKE 'a%' LIMIT $2")
+        self.assertEqual(st.execute_sql, f"EXECUTE {st.name} (%s, %s) ;")
+
+        # Same text, same statement
+        self.assertIs(prepared("SELECT %s::int, 'a' LIKE 'a%%' LIMIT %s ;"), st)
+        self.assertIn(st, db.statements())
+
+class PreparedStatementTest(unittest.TestCase):
+    db = db.DB()
+
+    def test_query(self):
+        st = statement("test_add", "SELECT $1 + $2 ;", ["int", "int"])
+        self.assertEqual(self.db.query(st, (1, 2)).single(), 3)
+        self.assertEqual(self.db.query(st, (3, 4)).single(), 7)
+
+        result = self.db.query("SELECT %s::text || 'b%%' ;", ("a",), prepare = True)
+        self.assertEqual(result.single(), "ab%")
+
+    def test_prepared_once(self):
+        st = statement("test_once", "SELECT $1::text ;")
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                for value in ["a", "b"]:
+                    self.db.run(conn, cur, st, (value,))
+                    self.assertEqual(cur.fetchone()[0], value)
+
+                cur.execute("""
+                    SELECT COUNT(*)
+                    FROM pg_prepared_statements
+                    WHERE name = 'test_once' ;
+                """)
+                self.assertEqual(cur.fetchone()[0], 1)
+
+                # Somebody drops our statements, we prepare it again
+                cur.execute("DEALLOCATE ALL ;")
+                self.db.run(conn, cur, st, ("c",))
+                self.assertEqual(cur.fetchone()[0], "c")
+
+if __name__ == "__main__":
+    unittest.main()